@@ -0,0 +1,255 @@
+"""
+Arithmetic checks for the worked answers in mark schemes.
+
+Mark schemes of Calculation questions show their working as chains like
+``I = 12 / 4 = 3 A`` or ``E = 0.5 × 2 × 3² = 9 J``.  ``extract`` finds every
+step whose left side is pure arithmetic and whose right side is a stated
+number, ``compile_expression`` turns the arithmetic into a small stack
+program through a whitelisted AST (numbers, + - × ÷ ^, sqrt/trig/log, π;
+nothing is ever passed to eval), and ``evaluate`` runs a whole batch of
+programs at once on a NumPy stack machine: one vectorised step per
+instruction position rather than one Python loop per expression.
+
+A step passes when the computed value rounds to the stated number (is
+within half a unit in its last significant place), so answers given to
+3 s.f. pass and wrong ones do not.  Anything that cannot be parsed with
+certainty (symbols, units inside the expression, fractions or percentages
+as answers) is skipped rather than failed.
+"""
+import ast
+import collections
+import math
+import re
+
+import numpy as np
+
+Check = collections.namedtuple("Check", "expression stated value ok")
+
+# Stack machine instructions
+NOP, PUSH, ADD, SUB, MUL, DIV, POW, NEG, SQRT, SIN, COS, TAN, LOG10, LN, EXP = range(15)
+_BINARY = {ast.Add: ADD, ast.Sub: SUB, ast.Mult: MUL, ast.Div: DIV, ast.Pow: POW}
+_FUNCTIONS = {"sqrt": SQRT, "sin": SIN, "cos": COS, "tan": TAN, "log": LOG10, "ln": LN, "exp": EXP}
+_CONSTANTS = {"pi": math.pi}
+_TRIG = (SIN, COS, TAN)
+
+# Longest program compiled (longer working is skipped)
+MAX_PROGRAM = 64
+
+_MARKS = re.compile(r"\[\s*\d+\s*(?:marks?)?\s*\]|\(\s*\d+\s*marks?\s*\)|\b[MABC]\d\b", re.IGNORECASE)
+_SUPERSCRIPTS = str.maketrans("⁰¹²³⁴⁵⁶⁷⁸⁹⁻", "0123456789-")
+# Characters (and names) arithmetic may be written with
+_ARITHMETIC = re.compile(r"(?:sqrt|sin|cos|tan|log|ln|exp|[\d\s.,+\-−–*/×÷·xX^()√π⁰¹²³⁴⁵⁶⁷⁸⁹⁻])+$")
+_NUMBER = re.compile(r"\s*(-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?)(?:\s*(?:×|x|\*)\s*10\s*(?:\^\s*\(?\s*([-−–]?\d+)\s*\)?"
+                     r"|([⁻⁰¹²³⁴⁵⁶⁷⁸⁹]+))|[eE]([-+]?\d+))?")
+_OPERATOR_CHARS = "+-−–*/×÷·^(√"
+
+
+def _normalize(expression):
+    """Python arithmetic for an expression as written in a mark scheme"""
+    text = expression.strip()
+    text = re.sub(r"(?<=\d),(?=\d{3}\b)", "", text)
+    text = text.replace("−", "-").replace("–", "-").replace("÷", "/").replace("·", "*").replace("×", "*")
+    text = re.sub(r"([\d)])\s*[xX]\s*(?=[\d(])", r"\1*", text)
+    text = re.sub(r"([⁻⁰¹²³⁴⁵⁶⁷⁸⁹]+)", lambda m: f"**({m.group(1).translate(_SUPERSCRIPTS)})", text)
+    text = text.replace("^", "**").replace("π", "pi")
+    text = re.sub(r"\b(sqrt|sin|cos|tan|log|ln|exp)\s+(\d+(?:\.\d+)?)", r"\1(\2)", text)
+    text = re.sub(r"√\s*(\d+(?:\.\d+)?)", r"sqrt(\1)", text).replace("√", "sqrt")
+    # Implicit multiplication: 2π, 2(3 + 4), (1 + 2)(3 + 4)
+    text = re.sub(r"(\d|\))\s*(\(|pi\b|sqrt|sin|cos|tan|log|ln|exp)", r"\1*\2", text)
+    return text
+
+
+def compile_expression(expression):
+    """Stack program [(instruction, constant)] for arithmetic, or None if it is anything else"""
+    try:
+        tree = ast.parse(_normalize(expression), mode="eval").body
+    except (SyntaxError, ValueError):
+        return None
+    program = []
+
+    def emit(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            program.append((PUSH, float(node.value)))
+        elif isinstance(node, ast.Name) and node.id in _CONSTANTS:
+            program.append((PUSH, _CONSTANTS[node.id]))
+        elif isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            emit(node.left)
+            emit(node.right)
+            program.append((_BINARY[type(node.op)], 0.0))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            emit(node.operand)
+            if isinstance(node.op, ast.USub):
+                program.append((NEG, 0.0))
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS
+              and len(node.args) == 1 and not node.keywords):
+            emit(node.args[0])
+            program.append((_FUNCTIONS[node.func.id], 0.0))
+        else:
+            raise ValueError(ast.dump(node))
+
+    try:
+        emit(tree)
+    except (ValueError, RecursionError):
+        return None
+    if len(program) > MAX_PROGRAM:
+        return None
+    return program
+
+
+def evaluate(programs, degrees=True):
+    """
+    Values of a batch of stack programs as a float array (NaN where a
+    program fails, e.g. dividing by zero).  Trigonometry is in degrees
+    unless ``degrees`` is False.
+    """
+    count = len(programs)
+    if not count:
+        return np.zeros(0)
+    length = max(len(program) for program in programs)
+    codes = np.zeros((count, length), dtype=np.int8)
+    constants = np.zeros((count, length))
+    for i, program in enumerate(programs):
+        if program:
+            codes[i, :len(program)], constants[i, :len(program)] = zip(*program)
+
+    stack = np.zeros((count, length + 1))
+    depth = np.zeros(count, dtype=np.intp)
+    rows = np.arange(count)
+    angle = np.pi / 180 if degrees else 1.0
+    with np.errstate(all="ignore"):
+        for step in range(length):
+            code = codes[:, step]
+            push = rows[code == PUSH]
+            stack[push, depth[push]] = constants[push, step]
+            depth[push] += 1
+
+            binary = rows[(code >= ADD) & (code <= POW)]
+            if binary.size:
+                top = depth[binary]
+                a, b, op = stack[binary, top - 2], stack[binary, top - 1], code[binary]
+                stack[binary, top - 2] = np.select(
+                    [op == ADD, op == SUB, op == MUL, op == DIV],
+                    [a + b, a - b, a * b, a / b],
+                    np.power(a, b),
+                )
+                depth[binary] -= 1
+
+            unary = rows[code >= NEG]
+            if unary.size:
+                top = depth[unary] - 1
+                x, op = stack[unary, top], code[unary]
+                stack[unary, top] = np.select(
+                    [op == NEG, op == SQRT, op == SIN, op == COS, op == TAN, op == LOG10, op == LN],
+                    [-x, np.sqrt(x), np.sin(x * angle), np.cos(x * angle), np.tan(x * angle),
+                     np.log10(x), np.log(x)],
+                    np.exp(x),
+                )
+    values = stack[:, 0]
+    values[~np.isfinite(values)] = np.nan
+    return values
+
+
+def _stated(text):
+    """
+    (value, tolerance, matched text) of the number at the start of
+    ``text``, or None.  The tolerance is half a unit in its last place.
+    """
+    match = _NUMBER.match(text)
+    if not match:
+        return None
+    rest = text[match.end():].lstrip()
+    # A fraction, percentage or further arithmetic is not a plain stated answer
+    # (a full stop or comma ending the sentence is fine)
+    if rest[:1] and (rest[0] in _OPERATOR_CHARS + "%:" or rest[0].isdigit()
+                     or (rest[0] in ".," and rest[1:2].isdigit())):
+        return None
+    mantissa = match.group(1).replace(",", "")
+    exponent = match.group(2) or match.group(4)
+    if match.group(3):
+        exponent = match.group(3).translate(_SUPERSCRIPTS)
+    exponent = int(exponent.replace("−", "-").replace("–", "-")) if exponent else 0
+
+    # The last significant place; trailing zeros of integers only count as
+    # rounding when at least two significant figures are left (1230, not 10)
+    if "." in mantissa:
+        unit = 10.0 ** -len(mantissa.split(".")[1])
+    else:
+        digits = mantissa.lstrip("-")
+        significant = digits.rstrip("0")
+        unit = 10.0 ** (len(digits) - len(significant)) if len(significant) >= 2 else 1.0
+    scale = 10.0 ** exponent
+    return float(mantissa) * scale, unit * scale / 2, match.group(0).strip()
+
+
+def _expression(segment):
+    """The arithmetic at the end of ``segment`` if it stands alone, else None"""
+    match = _ARITHMETIC.search(segment)
+    if not match:
+        return None
+    start = match.start()
+    # Skip leading operators and spaces, e.g. the "× " left over after units
+    while start < len(segment) and not (segment[start].isdigit() or segment[start] in "(√π"
+                                        or segment.startswith(("sqrt", "sin", "cos", "tan", "log", "ln", "exp"), start)
+                                        or (segment[start] in "-−–" and segment[start + 1:start + 2].isdigit())):
+        start += 1
+    expression = segment[start:].strip()
+    before = segment[:start].rstrip()
+    # Working that continues into units or symbols ("2 kg × 9.8") is not checkable
+    if before and (before[-1] in _OPERATOR_CHARS + ")" or before[-1].isdigit()):
+        return None
+    if not re.search(r"[\d)π]\s*[-−–+*/×÷·xX^(√]|[⁰¹²³⁴⁵⁶⁷⁸⁹]|\b(?:sqrt|sin|cos|tan|log|ln|exp)\b|√", expression):
+        return None
+    return expression
+
+
+def extract(text):
+    """(expression, stated number text, stated value, tolerance) for each checkable step"""
+    steps = []
+    for line in re.split(r"[\n;]", _MARKS.sub(" ", text or "")):
+        segments = re.split(r"=|≈", line)
+        for left, right in zip(segments, segments[1:]):
+            expression = _expression(left)
+            stated = _stated(right) if expression else None
+            if stated is not None:
+                value, tolerance, number = stated
+                steps.append((expression, number, value, tolerance))
+    return steps
+
+
+def verify(texts):
+    """
+    Check every step in each of ``texts``; returns a list of Check lists
+    (one per text, unparseable steps left out), evaluated as one batch.
+    """
+    steps = [extract(text) for text in texts]
+    flat, owners = [], []
+    for owner, text_steps in enumerate(steps):
+        for step in text_steps:
+            program = compile_expression(step[0])
+            if program is not None:
+                flat.append((step, program))
+                owners.append(owner)
+
+    results = [[] for _ in texts]
+    if not flat:
+        return results
+    stated = np.array([step[2] for step, _ in flat])
+    tolerance = np.array([step[3] for step, _ in flat])
+    values = evaluate([program for _, program in flat])
+    ok = np.abs(values - stated) <= tolerance * (1 + 1e-9) + 1e-12
+
+    # Trigonometry the model worked in radians
+    retry = [i for i, (_, program) in enumerate(flat)
+             if not ok[i] and any(code in _TRIG for code, _ in program)]
+    if retry:
+        radians = evaluate([flat[i][1] for i in retry], degrees=False)
+        for i, value in zip(retry, radians):
+            if abs(value - stated[i]) <= tolerance[i] * (1 + 1e-9) + 1e-12:
+                values[i], ok[i] = value, True
+
+    for (step, _), owner, value, passed in zip(flat, owners, values, ok):
+        # Steps that cannot be evaluated (NaN) are skipped, not failed
+        if not np.isnan(value):
+            results[owner].append(Check(step[0], step[1], float(value), bool(passed)))
+    return results
@@ -0,0 +1,376 @@
+"""
+Standalone HTTP service for question generation, diagrams and PDFs.
+
+    python api_server.py --port 8000 --workers 4
+
+Endpoints (JSON request bodies, JSON errors as {"error": "..."}):
+
+    POST /v1/questions  {"subject", "level", "topics", "num_questions", "difficulty",
+                         "question_type", "model", "target_marks"}  ->  {"questions": [...]}
+    POST /v1/diagram    {"description": text or spec, "index", "width", "height", "seed"}  ->  PNG
+    GET  /v1/diagram?description=...&index=1&width=600&height=400                           ->  PNG
+    POST /v1/pdf        {"questions": [...]}  ->  PDF
+    GET  /healthz
+
+Questions are planned and generated like the app's papers (balanced over
+topics, difficulties and formats, long papers in chunks, up to
+EXAMPREP_MAX_QUESTIONS) and come back with their diagrams as descriptions,
+each with the /v1/diagram URL that draws it; /v1/pdf draws the diagram_descriptions of
+the questions it is given.  Only the LLM endpoint (GROQ_API_URL) is
+called; everything else is qp1 running in this process.
+
+JSON and PDF responses are gzipped for clients that accept it (PNGs are
+already compressed).  Diagrams and PDFs are deterministic, so their ETag is
+computed from the request before any work is done and a matching
+If-None-Match is answered 304 without rendering.  PDFs carry the date they
+were generated on, which is part of their ETag.
+
+``--workers N`` binds once and forks N processes accepting on the same
+socket (Unix only); each serves requests on threads.  The question bank and
+the caches are shared through SQLite (see cache_backend), and the
+shared-key rate limits are split evenly between the workers.
+"""
+import argparse
+import functools
+import gzip
+import hashlib
+import json
+import os
+import signal
+import sys
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+import diagram_spec
+from app_loader import import_app
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 5 * 1024 * 1024
+# Limits on what a single request may ask for (questions: qp1.MAX_QUESTIONS)
+MAX_PDF_QUESTIONS = 200
+MAX_DIAGRAM_SIZE = 2000
+# Smaller responses are not worth compressing
+GZIP_MIN_BYTES = 512
+
+
+@functools.lru_cache(maxsize=None)
+def app():
+    return import_app()
+
+
+class BadRequest(Exception):
+    """Invalid request input, answered with a 400"""
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def _etag(*parts):
+    return '"' + hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest() + '"'
+
+
+def _integer(value, name, low, high, default):
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be an integer")
+    if not low <= number <= high:
+        raise BadRequest(f"{name} must be between {low} and {high}")
+    return number
+
+
+def _choice(value, name, choices, default):
+    if value is None:
+        return default
+    if value not in choices:
+        raise BadRequest(f"{name} must be one of: {', '.join(choices)}")
+    return value
+
+
+def _text(value, name):
+    if not isinstance(value, str) or not value.strip():
+        raise BadRequest(f"{name} must be a non-empty string")
+    return value.strip()
+
+
+def diagram_url(description, index):
+    """GET /v1/diagram URL for a description or spec"""
+    if isinstance(description, dict):
+        description = json.dumps(description, sort_keys=True, separators=(",", ":"))
+    return f"/v1/diagram?index={index}&description={quote(description)}"
+
+
+def diagram_request(params):
+    """(description, index, width, height, seed) from request parameters"""
+    description = params.get("description")
+    # Specs arrive as objects in POST bodies and as JSON text in query strings
+    if isinstance(description, str) and description.lstrip().startswith("{"):
+        try:
+            description = json.loads(description)
+        except json.JSONDecodeError:
+            pass
+    if isinstance(description, dict):
+        description = diagram_spec.validate(description)
+        if description is None:
+            raise BadRequest("description is not a valid diagram spec")
+    else:
+        description = _text(description, "description")[:2000]
+    index = _integer(params.get("index"), "index", 1, 99, 1)
+    width = _integer(params.get("width"), "width", 100, MAX_DIAGRAM_SIZE, 600)
+    height = _integer(params.get("height"), "height", 100, MAX_DIAGRAM_SIZE, 400)
+    seed = _integer(params.get("seed"), "seed", 0, 2 ** 63 - 1, None)
+    return description, index, width, height, seed
+
+
+def generate(body):
+    """Handle POST /v1/questions"""
+    qp1 = app()
+    topics = body.get("topics")
+    if isinstance(topics, str):
+        topics = [topics]
+    if not isinstance(topics, list) or not topics or not all(isinstance(t, str) and t.strip() for t in topics):
+        raise BadRequest("topics must be a non-empty list of strings")
+    questions = qp1.generate_paper(
+        _text(body.get("subject"), "subject"),
+        _text(body.get("level"), "level"),
+        [t.strip() for t in topics],
+        _integer(body.get("num_questions"), "num_questions", 1, qp1.MAX_QUESTIONS, 5),
+        _choice(body.get("difficulty"), "difficulty", ["Easy", "Medium", "Hard", "Mixed"], "Mixed"),
+        _choice(body.get("question_type"), "question_type", list(qp1.QUESTION_FORMATS) + ["Mixed"], "Mixed"),
+        _choice(body.get("model"), "model", qp1.GROQ_MODELS, qp1.GROQ_MODELS[1]),
+        use_bank=False,
+        target_marks=_integer(body.get("target_marks"), "target_marks", 1, 1000, None),
+        render=False,
+    )
+
+    # Move [DIAGRAM: ...] tags out of the text, as they would be for rendering
+    plan = qp1.plan_question_diagrams(questions)
+    for question in questions:
+        question['diagrams'] = []
+    for q_index, i, desc in plan:
+        questions[q_index]['diagrams'].append({"index": i, "description": desc, "url": diagram_url(desc, i)})
+    return {"questions": questions}
+
+
+def pdf_questions(body):
+    """Question dicts for POST /v1/pdf"""
+    questions = body.get("questions")
+    if not isinstance(questions, list) or not 1 <= len(questions) <= MAX_PDF_QUESTIONS:
+        raise BadRequest(f"questions must be a list of 1 to {MAX_PDF_QUESTIONS} questions")
+    cleaned = []
+    for question in questions:
+        if not isinstance(question, dict):
+            raise BadRequest("every question must be an object")
+        _text(question.get("question"), "question")
+        # Drawn into the PDF as text, so anything but a string is rejected here
+        for field in ("mark_scheme", "topic", "difficulty"):
+            if question.get(field) is not None and not isinstance(question[field], str):
+                raise BadRequest(f"{field} must be a string")
+        descriptions = question.get("diagram_descriptions") or []
+        # Diagrams listed as /v1/questions returns them
+        if not descriptions and question.get("diagrams"):
+            descriptions = [d.get("description") for d in question["diagrams"] if isinstance(d, dict)]
+        if not isinstance(descriptions, list):
+            raise BadRequest("diagram_descriptions must be a list")
+        question = {k: v for k, v in question.items() if k != "diagrams"}
+        # Specs are drawn as given, so check them like the model's own
+        question["diagram_descriptions"], _ = diagram_spec.clean_descriptions(
+            [d for d in descriptions if isinstance(d, (str, dict)) and d])
+        cleaned.append(question)
+    return cleaned
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ExamPrep/1.0"
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[{os.getpid()}] {self.address_string()} {format % args}\n")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/healthz":
+            return self._send_json(200, {"status": "ok", "pid": os.getpid()})
+        if url.path == "/v1/diagram":
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            return self._handle(lambda: self._diagram(params))
+        self._send_json(404, {"error": f"unknown path {url.path}"})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        routes = {
+            "/v1/questions": lambda body: self._send_json(200, generate(body)),
+            "/v1/diagram": self._diagram,
+            "/v1/pdf": self._pdf,
+        }
+        if path not in routes:
+            # Unread bodies would be taken for the next request on the connection
+            self.close_connection = True
+            return self._send_json(404, {"error": f"unknown path {path}"})
+        self._handle(lambda: routes[path](self._read_json()))
+
+    def _handle(self, handler):
+        qp1 = app()
+        try:
+            handler()
+        except BadRequest as e:
+            self._send_json(400, {"error": str(e)})
+        except qp1.GenerationError as e:
+            self._send_json(502, {"error": str(e)})
+        except Exception as e:
+            qp1.PROFILER.count("server.errors")
+            self.log_error("%s: %s", type(e).__name__, e)
+            self._send_json(500, {"error": "internal error"})
+
+    def _read_json(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_BODY_BYTES:
+            self.close_connection = True
+            raise BadRequest(f"request body must be at most {MAX_BODY_BYTES} bytes")
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise BadRequest("request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise BadRequest("request body must be a JSON object")
+        return body
+
+    def _not_modified(self, etag):
+        """Answer 304 if the client already has ``etag``"""
+        tags = [t.strip().removeprefix("W/") for t in self.headers.get("If-None-Match", "").split(",")]
+        if etag not in tags and "*" not in tags:
+            return False
+        app().PROFILER.count("server.not_modified")
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def _diagram(self, params):
+        qp1 = app()
+        description, index, width, height, seed = diagram_request(params)
+        etag = _etag(qp1.diagram_cache_key(description, index, width, height, seed))
+        if self._not_modified(etag):
+            return
+        png = qp1.render_diagram(description, index, width, height, seed)
+        self._send(200, png, "image/png", etag=etag, compress=False)
+
+    def _pdf(self, body):
+        qp1 = app()
+        questions = pdf_questions(body)
+        # The PDF shows the day it was generated on
+        etag = _etag(date.today().isoformat(), json.dumps(questions, sort_keys=True))
+        if self._not_modified(etag):
+            return
+        qp1.render_question_diagrams(questions)
+        pdf = qp1.cached_pdf(questions).getvalue()
+        self._send(200, pdf, "application/pdf", etag=etag,
+                   headers={"Content-Disposition": 'attachment; filename="exam_questions.pdf"'})
+
+    def _send_json(self, status, body):
+        self._send(status, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def _send(self, status, data, content_type, etag=None, compress=True, headers=None):
+        accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        compress = compress and accepts_gzip and len(data) >= GZIP_MIN_BYTES
+        if compress:
+            data = gzip.compress(data, compresslevel=6)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Vary", "Accept-Encoding")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(host="127.0.0.1", port=8000):
+    """Bind the service (qp1 is imported first, so forked workers share it)"""
+    app()
+    return _Server((host, port), _Handler)
+
+
+def _serve_worker(server, workers):
+    qp1 = app()
+    # Each worker has its own limiter; together they keep to the shared limits
+    qp1.GROQ_RPM = max(1, qp1.GROQ_RPM // workers)
+    qp1.GROQ_TPM = max(1, qp1.GROQ_TPM // workers)
+    qp1.get_rate_limiter.clear()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # Workers race to accept on the shared socket; the losers just go back to waiting
+    server.socket.setblocking(False)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve(server, workers=1):
+    """Serve forever, in this process or in ``workers`` forked ones"""
+    if workers <= 1 or not hasattr(os, "fork"):
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_worker(server, workers)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+    server.server_close()
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        os.waitpid(child, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve question generation, diagrams and PDFs over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("EXAMPREP_WORKERS", "1")),
+                        help="processes serving the socket (forked, Unix only)")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"Serving on http://{host}:{port} with {max(1, args.workers)} worker(s)", flush=True)
+    try:
+        serve(server, args.workers)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+Import the Streamlit app (qp1) outside ``streamlit run``.
+
+The scripts, the HTTP and async APIs and the benchmarks all use qp1 as a
+library.  Imported that way Streamlit runs in bare mode and logs a warning
+for every cache and session state access, so those loggers are silenced.
+"""
+import logging
+
+# Loggers that warn about running without a ScriptRunContext
+BARE_MODE_LOGGERS = (
+    "streamlit",
+    "streamlit.runtime.scriptrunner_utils.script_run_context",
+    "streamlit.runtime.state.session_state_proxy",
+    "streamlit.runtime.caching.cache_data_api",
+)
+
+
+def import_app():
+    """Import qp1 outside ``streamlit run`` without the bare-mode warnings"""
+    import streamlit  # noqa: F401  (sets up the streamlit loggers)
+
+    for name in BARE_MODE_LOGGERS:
+        logging.getLogger(name).disabled = True
+
+    import qp1
+    return qp1
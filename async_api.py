@@ -0,0 +1,202 @@
+"""
+Async API for serving question generation from an event loop.
+
+    questions = await agenerate_questions("Physics", "IGCSE", ["Waves"], 5)
+    pdf = await acreate_pdf(questions)
+
+Groq requests go through pooled ``httpx.AsyncClient`` connections and wait
+for the shared rate limiter with ``asyncio.sleep``, so hundreds of
+generations can be in flight on a single loop.  Each loop gets a few
+clients used in turn rather than one big one: httpcore's pool does work
+proportional to waiting requests times connections on every change, which
+made 200 concurrent requests through a single 200-connection client take
+~7s against a 0.5s mock (~1s when sharded).  Blocking work (parsing and
+banking, diagram rendering, PDF building) runs in a thread pool; pass a
+``concurrent.futures.ProcessPoolExecutor`` as ``executor`` to render on
+other cores instead.  The prompt, parsing, bank and diagram code are qp1's.
+"""
+import asyncio
+import functools
+import itertools
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from app_loader import import_app
+
+# Connections kept open to the API per event loop, split over CLIENT_SHARDS clients
+MAX_CONNECTIONS = int(os.getenv("EXAMPREP_ASYNC_CONNECTIONS", "128"))
+CLIENT_SHARDS = 8
+# Threads for rendering and PDF building
+RENDER_WORKERS = int(os.getenv("EXAMPREP_RENDER_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+
+_clients = weakref.WeakKeyDictionary()
+_executor = None
+
+
+@functools.lru_cache(maxsize=None)
+def app():
+    return import_app()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(RENDER_WORKERS, thread_name_prefix="render")
+    return _executor
+
+
+def get_client():
+    """The next pooled HTTP client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    shards = _clients.get(loop)
+    if shards is None:
+        per_client = max(1, -(-MAX_CONNECTIONS // CLIENT_SHARDS))
+        clients = [
+            httpx.AsyncClient(
+                timeout=httpx.Timeout(120, connect=10),
+                limits=httpx.Limits(max_connections=per_client, max_keepalive_connections=per_client),
+            )
+            for _ in range(CLIENT_SHARDS)
+        ]
+        shards = _clients[loop] = (clients, itertools.cycle(clients))
+    return next(shards[1])
+
+
+async def aclose():
+    """Close the running loop's HTTP clients (e.g. on server shutdown)"""
+    shards = _clients.pop(asyncio.get_running_loop(), None)
+    for client in shards[0] if shards else ():
+        await client.aclose()
+
+
+async def _in_executor(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor or get_executor(), func, *args)
+
+
+async def apost_chat_completion(payload, api_key, session_id=None, on_queue=None,
+                                expected_completion_tokens=None):
+    """Async qp1.post_chat_completion: same rate limiting and 429 handling"""
+    qp1 = app()
+    headers = qp1.api_headers(api_key)
+    limiter = qp1.request_limiter(api_key)
+    estimated_tokens = qp1.request_token_estimate(payload, expected_completion_tokens)
+
+    for attempt in range(qp1.MAX_RATE_LIMIT_RETRIES + 1):
+        if limiter is not None:
+            await limiter.acquire_async(session_id or "default", estimated_tokens,
+                                        on_wait=on_queue, timeout=qp1.RATE_LIMIT_TIMEOUT)
+
+        try:
+            with qp1.span("api"):
+                response = await get_client().post(qp1.GROQ_API_URL, headers=headers, json=payload)
+            rate_limited = response.status_code == 429 and attempt < qp1.MAX_RATE_LIMIT_RETRIES
+            if not rate_limited:
+                response.raise_for_status()
+                result = response.json()
+        except BaseException:
+            # No usage came back (errors, timeouts, cancellation): free the reservation
+            qp1.release_reservation(limiter, estimated_tokens)
+            raise
+
+        if rate_limited:
+            await asyncio.sleep(qp1.rate_limited_delay(limiter, estimated_tokens, response.headers, attempt))
+            continue
+        qp1.settle_usage(limiter, estimated_tokens, result)
+        return result
+
+
+async def acomplete_with_fallback(payload, api_key, models, **kwargs):
+    """Async qp1.complete_with_fallback"""
+    qp1 = app()
+    for position, model in enumerate(models):
+        try:
+            return await apost_chat_completion(dict(payload, model=model), api_key, **kwargs)
+        except httpx.HTTPStatusError as e:
+            if not qp1.should_fall_back(e, model, position, models):
+                raise
+
+
+async def agenerate_questions(subject, level, topics, num_questions, difficulty="Mixed", question_type="Mixed",
+                              model=None, session_id=None, on_queue=None, render=True, executor=None,
+                              slots=None, marks=None):
+    """
+    Async qp1.run_generation: generate, parse, bank and (with ``render``)
+    draw the diagrams of ``num_questions`` questions.  Raises
+    qp1.GenerationError.
+    """
+    qp1 = app()
+    model = model or qp1.GROQ_MODELS[1]
+    payload, expected_tokens = qp1.generation_request(subject, level, topics, num_questions, difficulty,
+                                                      question_type, model, slots=slots, marks=marks)
+    result = cached = await _in_executor(None, qp1.cached_completion, payload, qp1.GROQ_API_KEY, session_id)
+    started = time.perf_counter()
+    try:
+        if cached is None:
+            result = await acomplete_with_fallback(
+                payload, qp1.GROQ_API_KEY, qp1.fallback_models(model), session_id=session_id,
+                on_queue=on_queue, expected_completion_tokens=expected_tokens
+            )
+    except qp1.RateLimitTimeout as e:
+        raise qp1.GenerationError(f"The API is busy right now, please try again in a minute. ({e})")
+    except httpx.HTTPError as e:
+        raise qp1.GenerationError(f"API request error: {e}")
+
+    latency = time.perf_counter() - started if cached is None else None
+
+    # Parsing, near-duplicate checks and the bank write block, so off the loop
+    questions = await _in_executor(None, qp1.questions_from_completion, result, payload, subject, level,
+                                   topics, difficulty, question_type, latency, slots, cached is not None)
+    if cached is None:
+        await _in_executor(None, qp1.store_completion, payload, result, qp1.GROQ_API_KEY, session_id)
+    await areplace_failed_answers(questions, subject, level, topics, difficulty, model,
+                                  session_id=session_id, on_queue=on_queue)
+    if render:
+        await arender_diagrams(questions, executor=executor)
+    return questions
+
+
+async def areplace_failed_answers(questions, subject, level, topics, difficulty, model, session_id=None,
+                                  on_queue=None):
+    """Async version of run_generation's re-request of questions that failed qp1.verify_answers"""
+    qp1 = app()
+    failed = qp1.failed_answers(questions)
+    for _ in range(qp1.ANSWER_RETRIES if failed else 0):
+        payload, expected_tokens, slots = qp1.answer_retry_request(questions, failed, subject, level, topics,
+                                                                   difficulty, model)
+        try:
+            result = await acomplete_with_fallback(
+                payload, qp1.GROQ_API_KEY, qp1.fallback_models(model), session_id=session_id,
+                on_queue=on_queue, expected_completion_tokens=expected_tokens
+            )
+            replacements = await _in_executor(None, qp1.questions_from_completion, result, payload, subject,
+                                              level, topics, difficulty, "Calculation", None, slots)
+        except (qp1.RateLimitTimeout, httpx.HTTPError, qp1.GenerationError):
+            # The flagged questions are still usable, just marked
+            break
+        failed = qp1.merge_replacements(questions, failed, replacements)
+        if not failed:
+            break
+    return questions
+
+
+def _render_png(description, index):
+    # Module level, so process pools can pickle it
+    return app().render_diagram(description, index)
+
+
+async def arender_diagrams(questions, executor=None):
+    """Async qp1.render_question_diagrams: every diagram rendered concurrently"""
+    plan = app().plan_question_diagrams(questions)
+    pngs = await asyncio.gather(*(_in_executor(executor, _render_png, desc, i) for _, i, desc in plan))
+    for (q_index, _, _), png in zip(plan, pngs):
+        questions[q_index]['diagrams'].append(png)
+    return questions
+
+
+async def acreate_pdf(questions, executor=None):
+    """Async qp1.cached_pdf"""
+    return await _in_executor(executor, app().cached_pdf, questions)
@@ -0,0 +1,23 @@
+"""
+Offline benchmark and load-testing tools for the question generator.
+
+Run from the repository root, e.g. ``python -m benchmarks.bench_qp1``.
+"""
+import os
+
+
+def load_app():
+    """
+    Import the Streamlit app module in bare mode (outside ``streamlit run``)
+    with the bare-mode warnings silenced and, unless configured otherwise,
+    the shared-key rate limits lifted and the question bank disabled.
+    """
+    from app_loader import import_app
+
+    # The mock endpoint has no provider limits; benchmarks that want the shared
+    # key's rate limiter in the loop set these explicitly
+    os.environ.setdefault("GROQ_RPM", "1000000")
+    os.environ.setdefault("GROQ_TPM", "1000000000")
+    # Answers served from the local question bank would skew the timings
+    os.environ.setdefault("EXAMPREP_BANK_PATH", "")
+    return import_app()
@@ -0,0 +1,546 @@
+"""
+Offline throughput benchmarks for the diagram generators, create_pdf and the
+end-to-end generation path (against benchmarks/mock_groq.py).
+
+    python -m benchmarks.bench_qp1                      # run everything
+    python -m benchmarks.bench_qp1 -k diagram -n 50      # only diagram benches
+    python -m benchmarks.bench_qp1 --json base.json      # save results
+    python -m benchmarks.bench_qp1 --compare base.json   # fail on regressions
+    python -m benchmarks.bench_qp1 --check-determinism   # same inputs, same PNG bytes
+    python -m benchmarks.bench_qp1 -k cache              # cross-process cache hit rates
+    python -m benchmarks.bench_qp1 -k verify             # answer checks per second
+    python -m benchmarks.bench_qp1 -k ui:rerun           # app rerun time by paper size
+
+``--compare`` exits with status 1 when any benchmark's throughput drops by
+more than ``--tolerance`` (default 20%) against the saved baseline.
+``--check-determinism`` renders every corpus description twice (with the
+global random state and layer caches disturbed in between) and exits with
+status 1 unless both PNGs are byte-identical.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import requests
+
+from benchmarks import load_app
+from benchmarks.mock_groq import MockGroqServer, load_recorded_responses
+
+qp1 = load_app()
+
+# Realistic descriptions, as the model writes them, per generator
+CORPUS = {
+    "text": [
+        "A table showing the results of an experiment measuring reaction time",
+        "Timeline of the main events of the industrial revolution between 1750 and 1850",
+        "Flow chart of the stages in the water treatment process",
+    ],
+    "graph": [
+        "A velocity-time graph showing a straight line from the origin to 24 m/s at 8 s",
+        "Bar chart of species counts in four habitats",
+        "Pie chart showing the composition of dry air",
+        "Scatter plot of arm span against height for 30 students",
+        "Graph of the sine curve y = sin x for 0 to 360 degrees",
+        "Curve showing exponential growth of a bacterial population",
+    ],
+    "circuit": [
+        "A series circuit with a battery, a resistor, a lamp and an open switch",
+        "Circuit containing a cell and two lamps in parallel",
+        "A circuit with a 6 V battery and a variable resistor",
+    ],
+    "geometric": [
+        "A right-angled triangle ABC with the right angle at B",
+        "An equilateral triangle with side length 6 cm",
+        "A circle with centre O and radius r",
+        "A square ABCD with side 5 cm",
+        "An angle of 60 degrees between two lines",
+    ],
+    "biology": [
+        "A plant cell showing the cell wall, membrane, nucleus, chloroplasts and vacuole",
+        "An animal cell showing the nucleus, mitochondria and endoplasmic reticulum",
+        "Heart organ showing the four chambers and the aorta",
+        "Brain organ showing the two hemispheres and the cerebellum",
+        "A flowering plant showing roots, stem, leaves and flower",
+    ],
+    "chemistry": [
+        "Bohr model of a sodium atom showing the electron shells",
+        "Water molecule showing the bonds between hydrogen and oxygen",
+        "Carbon dioxide molecule with double bonds",
+        "Combustion reaction of methane with oxygen",
+        "Precipitation reaction of silver nitrate and sodium chloride",
+        "Acid and base neutralisation reaction of hydrochloric acid with sodium hydroxide",
+    ],
+}
+
+GENERATORS = {
+    "text": qp1.generate_text_diagram,
+    "graph": qp1.generate_graph_diagram,
+    "circuit": qp1.generate_circuit_diagram,
+    "geometric": qp1.generate_geometric_diagram,
+    "biology": qp1.generate_biology_diagram,
+    "chemistry": qp1.generate_chemistry_diagram,
+}
+
+# name -> factory returning (run, teardown); teardown may be None
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark.  The decorated function returns (run, teardown)"""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def _register_generator_benches():
+    for kind, generator in GENERATORS.items():
+        def make(generator=generator, descriptions=CORPUS[kind]):
+            def run():
+                for i, desc in enumerate(descriptions, 1):
+                    generator(desc, i)
+            return run, None
+        benchmark(f"diagram:{kind}")(make)
+
+
+_register_generator_benches()
+
+# Dense diagrams: heavy atoms with many shells and electrons
+DENSE_CORPUS = [
+    "Bohr model of a krypton atom showing all of its electron shells",
+    "Bohr model of a xenon atom",
+    "Bohr model of a gold atom",
+    "Bohr model of a uranium atom showing 92 electrons",
+]
+
+
+@benchmark("diagram:chemistry_dense")
+def _dense_atoms_bench():
+    def run():
+        for i, desc in enumerate(DENSE_CORPUS, 1):
+            qp1.generate_chemistry_diagram(desc, i)
+    return run, None
+
+
+@benchmark("diagram:cold_layers")
+def _cold_layers_bench():
+    """Circuit, biology and chemistry diagrams with the static layers repainted every time"""
+    def run():
+        for kind in ("circuit", "biology", "chemistry"):
+            for i, desc in enumerate(CORPUS[kind], 1):
+                qp1.diagram_layers.clear()
+                GENERATORS[kind](desc, i)
+    return run, None
+
+
+def sample_questions(count, with_diagrams=True):
+    """Build a paper of ``count`` questions cycling through the corpus"""
+    kinds = list(CORPUS)
+    questions = []
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        desc = CORPUS[kind][i % len(CORPUS[kind])]
+        question = {
+            "question": f"Question {i + 1} about {desc.lower()}.\n(a) Describe what is shown.\n(b) Explain it.",
+            "topic": kind.capitalize(),
+            "difficulty": ("Easy", "Medium", "Hard")[i % 3],
+            "mark_scheme": "Point one [1]\nPoint two [1]\nPoint three with working = 3 × 4 = 12 [2]",
+        }
+        if with_diagrams:
+            question["diagrams"] = [GENERATORS[kind](desc, 1).getvalue()]
+        questions.append(question)
+    return questions
+
+
+def _pdf_bench(count):
+    def make():
+        questions = sample_questions(count)
+
+        def run():
+            qp1.create_pdf(questions)
+        return run, None
+    return make
+
+
+for _count in (3, 10, 40):
+    benchmark(f"pdf:{_count}q")(_pdf_bench(_count))
+
+
+def _run_app(app):
+    # AppTest swaps in its own __main__; put ours back so process pools can
+    # still pickle this module's functions (e.g. _render_corpus) afterwards
+    main = sys.modules["__main__"]
+    try:
+        app.run()
+    finally:
+        sys.modules["__main__"] = main
+
+
+def _ui_rerun(count):
+    """One rerun of the app script showing a paper of ``count`` questions (Streamlit's AppTest)"""
+    def make():
+        from streamlit.testing.v1 import AppTest
+
+        app = AppTest.from_file(qp1.__file__, default_timeout=300)
+        _run_app(app)
+        app.session_state.generated_questions = sample_questions(count)
+        _run_app(app)
+
+        def run():
+            _run_app(app)
+        return run, None
+    return make
+
+
+for _count in (10, 50, 200):
+    benchmark(f"ui:rerun_{_count}q")(_ui_rerun(_count))
+
+
+@benchmark("dedupe:signature")
+def _signature_bench():
+    """MinHash signatures for a 10-question batch"""
+    texts = [qp1.question_text(q) for q in sample_questions(10, with_diagrams=False)]
+
+    def run():
+        qp1.MINHASHER.signatures(texts)
+    return run, None
+
+
+@benchmark("dedupe:lookup_300k")
+def _lookup_bench():
+    """100 near-duplicate lookups against an index of 300k signatures"""
+    rng = np.random.default_rng(0)
+    signatures = rng.integers(0, 2 ** 32, (300_000, qp1.MINHASHER.num_perm), dtype=np.uint32)
+    index = qp1.LSHIndex(qp1.MINHASHER.num_perm, threshold=qp1.DUPLICATE_THRESHOLD)
+    index.add_many(range(len(signatures)), signatures)
+
+    # Half the probes are near-copies of indexed questions, half are new
+    probes = signatures[:100].copy()
+    probes[:50, :8] = 0
+    probes[50:] = rng.integers(0, 2 ** 32, probes[50:].shape, dtype=np.uint32)
+
+    def run():
+        for probe in probes:
+            index.query(probe)
+    return run, None
+
+
+@benchmark("verify:answers_1000")
+def _verify_bench():
+    """
+    Check the worked answers of 1000 Calculation mark schemes (the recorded
+    ones, every fifth with its last worked answer changed) in one batch
+    """
+    schemes = [question["mark_scheme"] for response in load_recorded_responses()
+               for question in json.loads(qp1.extract_json_block(response["content"]))]
+    corpus = []
+    for i in range(1000):
+        scheme = schemes[i % len(schemes)]
+        answers = list(re.finditer(r"=\s*(\d)", scheme))
+        if i % 5 == 0 and answers:
+            # Change the leading digit of the last worked answer
+            digit = answers[-1].start(1)
+            scheme = scheme[:digit] + str((int(scheme[digit]) + 1) % 10) + scheme[digit + 1:]
+        corpus.append(scheme)
+
+    def run():
+        start = time.perf_counter()
+        results = qp1.answer_check.verify(corpus)
+        elapsed = time.perf_counter() - start
+        return {"verified_per_s": len(corpus) / elapsed,
+                "failed": sum(not all(check.ok for check in checks) for checks in results)}
+    return run, None
+
+
+@benchmark("plan:assemble_200")
+def _plan_bench():
+    """Plan a balanced 200-question paper with a marks target from 800 skewed bank candidates"""
+    rng = random.Random(0)
+    topics = ["Waves", "Forces", "Energy", "Electricity"]
+    difficulties, formats = qp1.paper_dimensions("Mixed", "Mixed")
+    candidates = [
+        {"topic": rng.choices(topics, [6, 1, 1, 0.3])[0], "difficulty": rng.choices(difficulties, [5, 2, 1])[0],
+         "format": rng.choices(formats, [5, 2, 1, 1])[0], "mark_scheme": f"Working [{rng.randint(1, 8)}]"}
+        for _ in range(800)
+    ]
+
+    def run():
+        chosen, slots, _ = qp1.paper_plan.assemble(200, topics, difficulties, formats, candidates,
+                                                   target_marks=800, rng=random.Random(0))
+        return {"banked": len(chosen), "requested": len(slots)}
+    return run, None
+
+
+def _end_to_end(rate_limit_every=0):
+    def make():
+        server = MockGroqServer(rate_limit_every=rate_limit_every).start()
+        previous_url = qp1.GROQ_API_URL
+        qp1.GROQ_API_URL = server.url
+
+        def run():
+            qp1.generate_questions_with_groq(
+                subject="Physics", level="IGCSE", topics=["Mechanics"], num_questions=3,
+                difficulty="Mixed", question_type="Mixed", model=qp1.GROQ_MODELS[1],
+            )
+
+        def teardown():
+            qp1.GROQ_API_URL = previous_url
+            server.stop()
+        return run, teardown
+    return make
+
+
+benchmark("e2e:generate")(_end_to_end())
+benchmark("e2e:generate_with_429s")(_end_to_end(rate_limit_every=4))
+
+
+@benchmark("async:generate_200")
+def _async_bench():
+    """200 concurrent generations on one event loop (mock API, 0.5s latency)"""
+    import async_api
+
+    server = MockGroqServer(latency=0.5).start()
+    previous_url = qp1.GROQ_API_URL
+    qp1.GROQ_API_URL = server.url
+
+    async def generate_all():
+        try:
+            await asyncio.gather(*(
+                async_api.agenerate_questions("Physics", "IGCSE", ["Mechanics"], 3, session_id=f"s{i}",
+                                              render=False)
+                for i in range(200)
+            ))
+        finally:
+            await async_api.aclose()
+
+    def run():
+        asyncio.run(generate_all())
+
+    def teardown():
+        qp1.GROQ_API_URL = previous_url
+        server.stop()
+    return run, teardown
+
+
+def _slow_tail(hedge):
+    """
+    Every 10th upstream request is 1s slower.  Hedging starts the backup at
+    the p90 of observed API latency (200ms until enough samples exist).
+    """
+    def make():
+        server = MockGroqServer(latency=0.05, slow_every=10, slow_latency=1.0).start()
+        previous = qp1.GROQ_API_URL, qp1.HEDGE_DEFAULT_DELAY
+        qp1.GROQ_API_URL, qp1.HEDGE_DEFAULT_DELAY = server.url, 0.2
+
+        def run():
+            qp1.run_generation(
+                subject="Physics", level="IGCSE", topics=["Mechanics"], num_questions=3,
+                difficulty="Mixed", question_type="Mixed", model=qp1.GROQ_MODELS[1], hedge=hedge,
+            )
+
+        def teardown():
+            qp1.GROQ_API_URL, qp1.HEDGE_DEFAULT_DELAY = previous
+            server.stop()
+        return run, teardown
+    return make
+
+
+benchmark("e2e:slow_tail")(_slow_tail(hedge=False))
+benchmark("e2e:slow_tail_hedged")(_slow_tail(hedge=True))
+
+
+@benchmark("e2e:stream")
+def _stream_bench():
+    """Consume a streamed completion from the mock (transport + SSE parsing)"""
+    server = MockGroqServer().start()
+    session = requests.Session()
+
+    def run():
+        payload = {"model": qp1.GROQ_MODELS[1], "stream": True,
+                   "messages": [{"role": "user", "content": "bench"}]}
+        with session.post(server.url, json=payload, stream=True) as response:
+            response.raise_for_status()
+            content = io.StringIO()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                content.write(json.loads(data)["choices"][0]["delta"].get("content", ""))
+        qp1.extract_json_block(content.getvalue())
+
+    def teardown():
+        session.close()
+        server.stop()
+    return run, teardown
+
+
+def _render_corpus(backend, order):
+    """Render every corpus diagram through the cache (in a worker process)"""
+    os.environ["EXAMPREP_CACHE"] = backend
+    qp1.get_cache.clear()
+    before = qp1.PROFILER.counters()
+    descriptions = [desc for descs in CORPUS.values() for desc in descs]
+    random.Random(order).shuffle(descriptions)
+    for desc in descriptions:
+        qp1.render_diagram(desc, 1)
+    after = qp1.PROFILER.counters()
+    return tuple(after.get(name, 0) - before.get(name, 0)
+                 for name in ("cache.diagrams.hits", "cache.diagrams.misses"))
+
+
+def _cross_process(backend, processes=4):
+    """
+    ``processes`` fresh workers (replicas) render the same 28 diagrams in
+    different orders, against a new cache each iteration.  Reports the hit
+    rate over all of them: a shared cache only draws each diagram about once.
+    """
+    def make():
+        context = multiprocessing.get_context("fork" if hasattr(os, "fork") else "spawn")
+        pool = context.Pool(processes, maxtasksperchild=1)
+        workdir = tempfile.TemporaryDirectory()
+        runs = itertools.count()
+
+        def run():
+            spec = backend
+            if backend == "sqlite":
+                spec = f"sqlite:{os.path.join(workdir.name, f'cache{next(runs)}.sqlite3')}"
+            counts = pool.starmap(_render_corpus, [(spec, order) for order in range(processes)])
+            hits, misses = map(sum, zip(*counts))
+            return {"hit_rate": hits / (hits + misses)}
+
+        def teardown():
+            pool.close()
+            pool.join()
+            workdir.cleanup()
+        return run, teardown
+    return make
+
+
+benchmark("cache:cross_process_memory")(_cross_process("memory"))
+benchmark("cache:cross_process_sqlite")(_cross_process("sqlite"))
+
+
+STANDARD_FIELDS = ("name", "iterations", "mean_ms", "p50_ms", "p95_ms", "ops_per_s")
+
+
+def run_benchmark(name, iterations, warmup):
+    run, teardown = BENCHMARKS[name]()
+    try:
+        for _ in range(warmup):
+            run()
+        samples = []
+        stats = None
+        for _ in range(iterations):
+            start = time.perf_counter()
+            stats = run()
+            samples.append(time.perf_counter() - start)
+    finally:
+        if teardown:
+            teardown()
+
+    samples.sort()
+    mean = statistics.fmean(samples)
+    # Benchmarks may report extra figures (e.g. cache hit rates) from their last run
+    return dict(stats or {}, **{
+        "name": name,
+        "iterations": iterations,
+        "mean_ms": mean * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "ops_per_s": 1 / mean if mean else float("inf"),
+    })
+
+
+def compare(results, baseline_path, tolerance):
+    """Return the names of benchmarks that regressed against the baseline"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["name"]: r for r in json.load(f)}
+
+    regressions = []
+    for result in results:
+        base = baseline.get(result["name"])
+        if not base:
+            continue
+        ratio = result["ops_per_s"] / base["ops_per_s"]
+        result["vs_baseline"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result["name"])
+    return regressions
+
+
+def check_determinism():
+    """Descriptions whose diagram is not byte-identical across renders"""
+    unstable = []
+    for kind, descriptions in CORPUS.items():
+        for desc in descriptions:
+            first = GENERATORS[kind](desc, 1).getvalue()
+            np.random.seed(len(unstable) + 1)
+            qp1.diagram_layers.clear()
+            if GENERATORS[kind](desc, 1).getvalue() != first:
+                unstable.append(f"{kind}: {desc}")
+            elif GENERATORS[kind](desc, 1, seed=qp1.diagram_seed(desc)).getvalue() != first:
+                unstable.append(f"{kind} (explicit seed): {desc}")
+    return unstable
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop (fraction)")
+    parser.add_argument("--check-determinism", action="store_true",
+                        help="only check that diagrams are byte-identical across renders")
+    args = parser.parse_args(argv)
+
+    if args.check_determinism:
+        unstable = check_determinism()
+        for name in unstable:
+            print(f"Non-deterministic diagram: {name}")
+        print(f"{sum(map(len, CORPUS.values())) - len(unstable)} diagrams deterministic, {len(unstable)} not")
+        return 1 if unstable else 0
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = []
+    print(f"{'benchmark':<28}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'ops/s':>10}")
+    for name in names:
+        result = run_benchmark(name, args.iterations, args.warmup)
+        results.append(result)
+        extra = "".join(f"  {key}={value:.2f}" if isinstance(value, float) else f"  {key}={value}"
+                        for key, value in result.items() if key not in STANDARD_FIELDS)
+        print(f"{name:<28}{result['mean_ms']:>10.2f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['ops_per_s']:>10.1f}{extra}")
+
+    status = 0
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for result in results:
+            if "vs_baseline" in result:
+                print(f"{result['name']:<28}{result['vs_baseline']:>9.2f}x baseline")
+        if regressions:
+            print(f"Throughput regressions: {', '.join(regressions)}")
+            status = 1
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Load generator simulating concurrent Streamlit sessions.
+
+Each simulated session runs the same path as a click on "Generate
+Questions" followed by "Download as PDF": generate_questions_coalesced
+(against the local mock endpoint), diagram rendering and create_pdf.
+Streamlit runs every session's script in its own thread, so sessions are
+threads here too.
+
+    python -m benchmarks.loadtest --sessions 1,10,30 --latency 2.0 --jitter 1.0
+
+Reports p50/p95/p99 end-to-end latency, throughput, upstream API calls and
+traced memory per concurrent session for each concurrency level, plus the
+per-stage breakdown collected by the profiler.
+"""
+import argparse
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import load_app
+from benchmarks.mock_groq import MockGroqServer
+
+qp1 = load_app()
+
+from profiling import PROFILER  # noqa: E402  (after load_app so qp1 is importable)
+
+# Request mix cycled across sessions (one class usually asks for the same thing)
+SESSION_CONFIGS = [
+    {"subject": "Physics", "level": "IGCSE", "topics": ["Mechanics"], "difficulty": "Hard",
+     "question_type": "Mixed"},
+    {"subject": "Chemistry", "level": "IGCSE", "topics": ["Atomic Structure", "Chemical Reactions"],
+     "difficulty": "Mixed", "question_type": "Mixed"},
+    {"subject": "Biology", "level": "IGCSE", "topics": ["Cell Biology"], "difficulty": "Easy",
+     "question_type": "Short Answer"},
+]
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    pos = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[pos]
+
+
+def simulate_session(session_id, requests_per_session, num_questions, think_time, model):
+    """Run one session's clicks and return (latencies, failures)"""
+    config = SESSION_CONFIGS[session_id % len(SESSION_CONFIGS)]
+    latencies = []
+    failures = 0
+    for _ in range(requests_per_session):
+        start = time.perf_counter()
+        try:
+            questions = qp1.generate_questions_coalesced(
+                num_questions=num_questions, model=model, **config
+            )
+        except qp1.GenerationError:
+            questions = []
+        if questions:
+            qp1.create_pdf(questions)
+        else:
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+        if think_time:
+            time.sleep(think_time)
+    return latencies, failures
+
+
+def run_level(sessions, args, server):
+    """Drive ``sessions`` concurrent sessions and return a result row"""
+    PROFILER.reset()
+    api_calls_before = server.stats["requests"]
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline_mem, _ = tracemalloc.get_traced_memory()
+
+    # Start all sessions at once, like a class pressing the button together
+    barrier = threading.Barrier(sessions)
+
+    def session(session_id):
+        barrier.wait()
+        return simulate_session(session_id, args.requests_per_session, args.num_questions,
+                                args.think_time, args.model)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        outcomes = list(pool.map(session, range(sessions)))
+    wall = time.perf_counter() - start
+
+    _, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = sorted(lat for lats, _ in outcomes for lat in lats)
+    failures = sum(f for _, f in outcomes)
+    return {
+        "sessions": sessions,
+        "requests": len(latencies),
+        "failures": failures,
+        "api_calls": server.stats["requests"] - api_calls_before,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "mean_s": statistics.fmean(latencies) if latencies else 0.0,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "mem_per_session_mb": (peak_mem - baseline_mem) / sessions / 1e6,
+        "stages": PROFILER.snapshot(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", default="1,5,10,30",
+                        help="comma separated concurrency levels to run")
+    parser.add_argument("--requests-per-session", type=int, default=2)
+    parser.add_argument("--num-questions", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between a session's clicks")
+    parser.add_argument("--latency", type=float, default=1.0, help="mock LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="extra random mock latency in seconds")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="mock returns 429 every Nth request")
+    parser.add_argument("--rpm", type=int, help="shared-key requests per minute limit (default: unlimited)")
+    parser.add_argument("--tpm", type=int, help="shared-key tokens per minute limit (default: unlimited)")
+    parser.add_argument("--model", default=qp1.GROQ_MODELS[1])
+    parser.add_argument("--stages", action="store_true", help="print the per-stage breakdown per level")
+    args = parser.parse_args(argv)
+
+    levels = [int(n) for n in args.sessions.split(",") if n.strip()]
+    if args.rpm or args.tpm:
+        qp1.GROQ_RPM = args.rpm or qp1.GROQ_RPM
+        qp1.GROQ_TPM = args.tpm or qp1.GROQ_TPM
+        qp1.get_rate_limiter.clear()
+    server = MockGroqServer(latency=args.latency, jitter=args.jitter,
+                            rate_limit_every=args.rate_limit_every).start()
+    qp1.GROQ_API_URL = server.url
+    print(f"Mock LLM at {server.url} (latency {args.latency}s + up to {args.jitter}s jitter)")
+    print(f"{'sessions':>8}{'reqs':>6}{'fail':>6}{'api':>6}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}"
+          f"{'req/s':>9}{'MB/sess':>9}")
+    try:
+        for sessions in levels:
+            row = run_level(sessions, args, server)
+            print(f"{row['sessions']:>8}{row['requests']:>6}{row['failures']:>6}{row['api_calls']:>6}"
+                  f"{row['p50_s']:>9.3f}{row['p95_s']:>9.3f}{row['p99_s']:>9.3f}"
+                  f"{row['throughput_rps']:>9.2f}{row['mem_per_session_mb']:>9.2f}")
+            if args.stages:
+                for stage in row["stages"]:
+                    print(f"{'':>8}  {stage['stage']:<20} n={stage['count']:<5} "
+                          f"p50={stage['p50_ms']:.1f}ms p95={stage['p95_ms']:.1f}ms")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
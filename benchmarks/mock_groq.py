@@ -0,0 +1,229 @@
+"""
+Local stand-in for the Groq chat completions endpoint.
+
+Replays recorded completions (``recorded_responses.json``) in a loop, with
+optional latency/jitter, periodic 429 responses and SSE streaming when the
+request asks for ``"stream": true``.  Point the app at it with::
+
+    python -m benchmarks.mock_groq --port 8765 --latency 1.5
+    GROQ_API_URL=http://127.0.0.1:8765/openai/v1/chat/completions streamlit run qp1.py
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECORDED_RESPONSES_PATH = os.path.join(os.path.dirname(__file__), "recorded_responses.json")
+
+COMPLETIONS_PATH = "/openai/v1/chat/completions"
+
+
+class _Server(ThreadingHTTPServer):
+    # Load tests open hundreds of connections at once; the default backlog is 5
+    request_queue_size = 1024
+
+
+def load_recorded_responses(path=RECORDED_RESPONSES_PATH):
+    """Load the list of recorded completions ({"content": ..., "usage": ...})"""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class MockGroqServer:
+    """
+    Threaded HTTP server replaying recorded completions.
+
+    ``rate_limit_every`` makes every Nth request a 429 with a Retry-After
+    header; ``latency`` and ``jitter`` (seconds) delay each response, and
+    ``model_latency`` overrides the base latency per model.  Every
+    ``slow_every``-th request takes ``slow_latency`` extra (a heavy tail), and
+    models in ``decommissioned`` get the provider's 400 error.
+    """
+
+    def __init__(self, responses=None, latency=0.0, jitter=0.0, rate_limit_every=0,
+                 retry_after=1, stream_chunk_chars=40, model_latency=None, slow_every=0,
+                 slow_latency=0.0, decommissioned=(), host="127.0.0.1", port=0):
+        self.responses = responses if responses is not None else load_recorded_responses()
+        self.latency = latency
+        self.jitter = jitter
+        self.model_latency = model_latency or {}
+        self.slow_every = slow_every
+        self.slow_latency = slow_latency
+        self.decommissioned = set(decommissioned)
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.stream_chunk_chars = stream_chunk_chars
+        self._cycle = itertools.cycle(self.responses)
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.stats = {"requests": 0, "rate_limited": 0, "streamed": 0}
+        self.models = {}  # requests per model
+
+        handler = type("Handler", (_Handler,), {"mock": self})
+        self.httpd = _Server((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{COMPLETIONS_PATH}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _next(self, model):
+        """Return (request number, recorded response) for the next request"""
+        with self._lock:
+            self.stats["requests"] += 1
+            self.models[model] = self.models.get(model, 0) + 1
+            return next(self._counter), next(self._cycle)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    mock = None  # set per server by MockGroqServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            return self._send_json(400, {"error": {"message": "invalid JSON body"}})
+
+        if self.path != COMPLETIONS_PATH:
+            return self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+        mock = self.mock
+        model = payload.get("model", "mock-model")
+        number, recorded = mock._next(model)
+
+        # Simulated provider rate limit
+        if mock.rate_limit_every and number % mock.rate_limit_every == 0:
+            mock._count("rate_limited")
+            return self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached for requests", "type": "requests",
+                           "code": "rate_limit_exceeded"}},
+                headers={"Retry-After": str(mock.retry_after)},
+            )
+
+        if model in mock.decommissioned:
+            return self._send_json(400, {"error": {
+                "message": f"The model `{model}` has been decommissioned and is no longer supported.",
+                "type": "invalid_request_error",
+                "code": "model_decommissioned",
+            }})
+
+        delay = mock.model_latency.get(model, mock.latency)
+        if mock.jitter:
+            delay += random.uniform(0, mock.jitter)
+        if mock.slow_every and number % mock.slow_every == 0:
+            delay += mock.slow_latency
+        if delay:
+            time.sleep(delay)
+
+        if payload.get("stream"):
+            mock._count("streamed")
+            return self._send_stream(model, recorded)
+
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": recorded["content"]},
+                "finish_reason": "stop",
+            }],
+            "usage": recorded.get("usage", {}),
+        }
+        self._send_json(200, completion)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model, recorded):
+        """Send the content as OpenAI-style server-sent event chunks"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        content = recorded["content"]
+        step = self.mock.stream_chunk_chars
+        for start in range(0, len(content), step):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": content[start:start + step]},
+                             "finish_reason": None}],
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self._write_chunk("")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded Groq completions locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency (seconds)")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="make every Nth request a 429")
+    args = parser.parse_args()
+
+    server = MockGroqServer(latency=args.latency, jitter=args.jitter,
+                            rate_limit_every=args.rate_limit_every,
+                            host=args.host, port=args.port)
+    print(f"Mock Groq endpoint listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Cache backends for the LLM response, diagram and PDF caches.
+
+Both backends store bytes under string keys, with an optional time to live,
+and are safe to share between threads:
+
+``MemoryCache``
+    An LRU bounded by total size, private to the process.
+``SQLiteCache``
+    A table in a SQLite file in WAL mode.  Every process opening the same
+    file (Streamlit replicas, api_server workers, prewarm) shares its hits.
+
+``open_cache(namespace)`` picks one from EXAMPREP_CACHE:
+
+    sqlite          the question bank file (the default; off with the bank)
+    sqlite:<path>   a separate SQLite file
+    memory          per process
+    none            no caching
+
+Namespaces ("llm", "diagrams", "pdf") share one table without colliding.
+"""
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+from question_bank import bank_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    expires_at REAL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+"""
+
+# Limits per namespace, in bytes (the oldest entries go first)
+MEMORY_MAX_BYTES = 64 * 1024 * 1024
+SQLITE_MAX_BYTES = int(os.getenv("EXAMPREP_CACHE_MAX_MB", "512")) * 1024 * 1024
+# Expired and surplus SQLite entries are pruned every this many writes
+PRUNE_EVERY = 200
+
+
+class MemoryCache:
+    """In-process LRU of bytes values, bounded by their total size"""
+
+    def __init__(self, max_bytes=MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> (value, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Cached value for ``key`` or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        value = bytes(value)
+        if len(value) > self.max_bytes:
+            return
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires_at)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+    def _remove(self, key):
+        # Caller holds the lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+
+class SQLiteCache:
+    """One namespace of a cache table in a SQLite file shared between processes"""
+
+    def __init__(self, path, namespace, max_bytes=SQLITE_MAX_BYTES):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        with conn:
+            conn.executescript(SCHEMA)
+            _import_bank_diagrams(conn)
+
+    def _conn(self):
+        """One connection per thread (sqlite3 connections are not thread-safe)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """Cached value for ``key`` or None"""
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (self.namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, created_at) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (self.namespace, key, bytes(value), now + ttl if ttl else None, now))
+        # Unsynchronised on purpose: an occasional missed or extra prune is harmless
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def prune(self):
+        """Drop expired entries, then the oldest ones beyond ``max_bytes``"""
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time()))
+            total = 0
+            rows = conn.execute("SELECT key, length(value) FROM cache WHERE namespace = ? "
+                                "ORDER BY created_at DESC", (self.namespace,))
+            surplus = []
+            for key, size in rows:
+                total += size
+                if total > self.max_bytes:
+                    surplus.append((self.namespace, key))
+            conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", surplus)
+
+    def stats(self):
+        entries, size = self._conn().execute(
+            "SELECT count(*), coalesce(sum(length(value)), 0) FROM cache WHERE namespace = ?", (self.namespace,)
+        ).fetchone()
+        return {"entries": entries, "bytes": size}
+
+
+def _import_bank_diagrams(conn):
+    """Move diagrams cached by older versions in the bank's own table"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'diagrams'").fetchone():
+        try:
+            conn.execute("INSERT OR IGNORE INTO cache (namespace, key, value, expires_at, created_at) "
+                         "SELECT 'diagrams', key, png, NULL, created_at FROM diagrams")
+            conn.execute("DROP TABLE diagrams")
+        except sqlite3.OperationalError:
+            # Another process moved them first
+            pass
+
+
+def open_cache(namespace, backend=None):
+    """
+    The cache for ``namespace`` configured by ``backend`` (default:
+    EXAMPREP_CACHE, see the module docstring), or None when caching is off
+    """
+    if backend is None:
+        backend = os.getenv("EXAMPREP_CACHE", "sqlite")
+    if backend in ("", "none"):
+        return None
+    if backend == "memory":
+        return MemoryCache()
+    if backend == "sqlite":
+        path = bank_path()
+        return SQLiteCache(path, namespace) if path else None
+    if backend.startswith("sqlite:"):
+        return SQLiteCache(backend[len("sqlite:"):], namespace)
+    raise ValueError(f"Unknown EXAMPREP_CACHE backend {backend!r}")
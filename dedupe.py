@@ -0,0 +1,211 @@
+"""
+Near-duplicate detection for generated questions.
+
+Questions are reduced to character shingles, hashed into a MinHash signature
+(``num_perm`` uint32 minimums, all computed in one NumPy pass) and indexed
+with banded LSH: two questions whose estimated Jaccard similarity is high
+share at least one band with high probability.  Bands of the bulk-loaded
+bank live in sorted NumPy arrays (binary search per band); questions added
+since the last merge sit in a small dict, so lookups stay well under a
+millisecond at hundreds of thousands of questions.
+"""
+import re
+import threading
+
+import numpy as np
+
+_SHIFT32 = np.uint64(32)
+
+
+def _mix(x):
+    """splitmix64 finalizer, spreads the shingle hashes over 64 bits"""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def question_text(question):
+    """The text a question is compared on: question plus mark scheme"""
+    mark_scheme = question.get("mark_scheme") or ""
+    return f"{question.get('question', '')}\n{mark_scheme}"
+
+
+class MinHasher:
+    """
+    MinHash signatures over character shingles.
+
+    Text is lowercased with punctuation and runs of whitespace collapsed, so
+    reformatting alone does not make a question "new".  Permutations are
+    multiply-shift hashes ``(a * x + b) >> 32`` with fixed seeds, so
+    signatures are stable across processes and can be stored.
+    """
+
+    def __init__(self, num_perm=64, shingle_size=5, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self._powers = np.uint64(1099511628211) ** np.arange(shingle_size - 1, -1, -1, dtype=np.uint64)
+
+    def shingles(self, text):
+        """Unique 64-bit hashes of the text's character shingles"""
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+        data = np.frombuffer(normalized.encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+        if len(data) < self.shingle_size:
+            data = np.pad(data, (0, self.shingle_size - len(data)))
+        windows = np.lib.stride_tricks.sliding_window_view(data, self.shingle_size)
+        return np.unique(_mix(windows @ self._powers))
+
+    def signature(self, text):
+        """MinHash signature (``num_perm`` uint32) of one text"""
+        hashes = self.shingles(text)
+        permuted = (hashes[None, :] * self._a[:, None] + self._b[:, None]) >> _SHIFT32
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts):
+        """Signatures of several texts as a (len(texts), num_perm) array"""
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+        return np.stack([self.signature(text) for text in texts])
+
+
+def similarity(signature, signatures):
+    """Estimated Jaccard similarity of one signature against each row of many"""
+    return (np.asarray(signatures) == signature).mean(axis=-1)
+
+
+def unique_mask(signatures, threshold):
+    """
+    Boolean mask keeping the first of every group of near-duplicates among
+    ``signatures`` (one vectorized pairwise comparison).
+    """
+    signatures = np.asarray(signatures)
+    if len(signatures) < 2:
+        return np.ones(len(signatures), dtype=bool)
+    pairwise = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=-1)
+    # Only compare against earlier questions, which are kept in preference
+    duplicate_of_earlier = np.tril(pairwise >= threshold, k=-1)
+    keep = np.ones(len(signatures), dtype=bool)
+    for i in np.flatnonzero(duplicate_of_earlier.any(axis=1)):
+        if (duplicate_of_earlier[i] & keep).any():
+            keep[i] = False
+    return keep
+
+
+class LSHIndex:
+    """
+    Banded LSH over MinHash signatures with exact-estimate verification.
+
+    ``query`` returns ``[(key, similarity)]`` for indexed signatures at or
+    above ``threshold``.  Thread-safe; ``add_unless_duplicate`` checks and
+    inserts atomically.
+    """
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.8, merge_every=2048):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.merge_every = merge_every
+        self._band_mult = np.random.default_rng(7).integers(1, 2 ** 63, self.rows, dtype=np.uint64) | np.uint64(1)
+        self._lock = threading.Lock()
+        self._keys = []
+        self._sigs = np.empty((1024, num_perm), dtype=np.uint32)
+        self._band_hashes = np.empty((1024, bands), dtype=np.uint64)
+        # Merged part: per band, sorted band hashes and the rows they belong to
+        self._sorted = np.empty((bands, 0), dtype=np.uint64)
+        self._order = np.empty((bands, 0), dtype=np.int64)
+        self._merged = 0
+        # Rows added since the last merge: {(band, band hash): [rows]}
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _hash_bands(self, signatures):
+        """(n, bands) uint64 hash of each band of each signature"""
+        grouped = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        return _mix((grouped * self._band_mult).sum(axis=-1))
+
+    def _grow(self, extra):
+        needed = len(self._keys) + extra
+        if needed > len(self._sigs):
+            capacity = max(needed, 2 * len(self._sigs))
+            self._sigs = np.resize(self._sigs, (capacity, self.num_perm))
+            self._band_hashes = np.resize(self._band_hashes, (capacity, self.bands))
+
+    def _merge(self):
+        """Fold the pending rows into the sorted band arrays (caller holds the lock)"""
+        count = len(self._keys)
+        hashes = self._band_hashes[:count].T
+        self._order = np.argsort(hashes, axis=1, kind="stable")
+        self._sorted = np.take_along_axis(hashes, self._order, axis=1)
+        self._merged = count
+        self._pending = {}
+
+    def _append(self, keys, signatures, band_hashes):
+        start = len(self._keys)
+        self._grow(len(keys))
+        self._sigs[start:start + len(keys)] = signatures
+        self._band_hashes[start:start + len(keys)] = band_hashes
+        self._keys.extend(keys)
+        # Re-sorting costs O(n log n), so merge less often as the index grows
+        if len(self._keys) - self._merged >= max(self.merge_every, self._merged // 4):
+            self._merge()
+            return
+        for row in range(start, len(self._keys)):
+            for band, value in enumerate(self._band_hashes[row]):
+                self._pending.setdefault((band, int(value)), []).append(row)
+
+    def _candidates(self, band_hashes):
+        rows = set()
+        for band, value in enumerate(band_hashes):
+            sorted_band = self._sorted[band]
+            lo = np.searchsorted(sorted_band, value, side="left")
+            hi = np.searchsorted(sorted_band, value, side="right")
+            if hi > lo:
+                rows.update(self._order[band, lo:hi].tolist())
+            rows.update(self._pending.get((band, int(value)), ()))
+        return rows
+
+    def _query(self, signature, band_hashes):
+        rows = self._candidates(band_hashes)
+        if not rows:
+            return []
+        rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+        scores = similarity(signature, self._sigs[rows])
+        hits = scores >= self.threshold
+        matches = [(self._keys[row], float(score)) for row, score in zip(rows[hits], scores[hits])]
+        return sorted(matches, key=lambda match: -match[1])
+
+    def query(self, signature):
+        """Indexed near-duplicates of ``signature``, most similar first"""
+        signature = np.asarray(signature, dtype=np.uint32)
+        band_hashes = self._hash_bands(signature[None, :])[0]
+        with self._lock:
+            return self._query(signature, band_hashes)
+
+    def add(self, key, signature):
+        self.add_many([key], np.asarray(signature, dtype=np.uint32)[None, :])
+
+    def add_many(self, keys, signatures):
+        """Bulk insert (no duplicate check), e.g. when loading the bank"""
+        signatures = np.asarray(signatures, dtype=np.uint32).reshape(-1, self.num_perm)
+        band_hashes = self._hash_bands(signatures)
+        with self._lock:
+            self._append(list(keys), signatures, band_hashes)
+
+    def add_unless_duplicate(self, key, signature):
+        """Insert ``signature`` unless it has near-duplicates; returns those (empty if added)"""
+        signature = np.asarray(signature, dtype=np.uint32)
+        band_hashes = self._hash_bands(signature[None, :])
+        with self._lock:
+            matches = self._query(signature, band_hashes[0])
+            if not matches:
+                self._append([key], signature[None, :], band_hashes)
+            return matches
@@ -0,0 +1,90 @@
+"""
+Pre-rendered static layers for the PIL diagram generators.
+
+Most of a diagram never changes between calls: the border, the circuit
+wiring, cell outlines, reaction arrows.  Generators register painters for
+those parts with ``@layer(kind, variant)``; ``canvas`` paints the layer once
+per (kind, variant, size), caches it and hands out copies, so each diagram
+only draws its variable parts (title, labels, random elements) on top.
+``overlay`` pastes optional components, painted once on a transparent layer
+and cropped to their content.
+
+The caches live in this module rather than in qp1, which Streamlit
+re-executes on every rerun.
+"""
+import functools
+import threading
+
+from PIL import Image, ImageDraw, ImageFont
+
+PAINTERS = {}
+
+_lock = threading.Lock()
+stats = {"painted": 0, "reused": 0}
+
+
+def layer(kind, variant=None):
+    """
+    Register ``painter(draw, width, height, *params)`` for a static layer.
+    ``canvas`` variants may be tuples ``(variant, *params)``, e.g. the shell
+    radii of an atom, which are passed on to the painter.
+    """
+    def decorator(painter):
+        PAINTERS[(kind, variant)] = painter
+        return painter
+    return decorator
+
+
+@functools.lru_cache(maxsize=None)
+def fonts():
+    """(font, title_font, small_font) shared by the PIL generators"""
+    try:
+        return (ImageFont.truetype("arial.ttf", 18), ImageFont.truetype("arial.ttf", 24),
+                ImageFont.truetype("arial.ttf", 14))
+    except IOError:
+        default = ImageFont.load_default()
+        return default, default, default
+
+
+@functools.lru_cache(maxsize=256)
+def _template(kind, variant, width, height):
+    img = Image.new('RGB', (width, height), color='white')
+    draw = ImageDraw.Draw(img)
+
+    # Every PIL diagram has the same border
+    draw.rectangle([(10, 10), (width - 10, height - 10)], outline='black', width=2)
+    name, params = (variant[0], variant[1:]) if isinstance(variant, tuple) else (variant, ())
+    painter = PAINTERS.get((kind, name))
+    if painter is not None:
+        painter(draw, width, height, *params)
+    with _lock:
+        stats["painted"] += 1
+    return img
+
+
+def canvas(kind, variant, width, height):
+    """A copy of the static layer and a draw handle on it"""
+    img = _template(kind, variant, width, height).copy()
+    with _lock:
+        stats["reused"] += 1
+    return img, ImageDraw.Draw(img)
+
+
+@functools.lru_cache(maxsize=256)
+def _sprite(kind, name, width, height):
+    rgba = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    PAINTERS[(kind, name)](ImageDraw.Draw(rgba), width, height)
+    box = rgba.getbbox()
+    return rgba.crop(box), box[:2]
+
+
+def overlay(img, kind, name):
+    """Paste the pre-rendered component ``name`` onto ``img``"""
+    sprite, position = _sprite(kind, name, img.width, img.height)
+    img.paste(sprite, position, sprite)
+
+
+def clear():
+    """Drop every cached layer (e.g. after changing a painter)"""
+    _template.cache_clear()
+    _sprite.cache_clear()
@@ -0,0 +1,122 @@
+"""
+Keyword registry that picks a diagram generator for a description.
+
+Generators register the keywords that select them (``keywords``) and the
+ones they look for inside the description to choose a variant
+(``features``).  Every keyword of every generator is compiled into one
+regex, so a description is scanned once, in a single pass, and generators
+test membership in the resulting set instead of re-scanning the text.
+Matching keeps the plain substring semantics of ``keyword in text``:
+"angle" is found in "triangle", "sin" in "cosine".  Generators also name
+the structured spec types (see diagram_spec) they draw.
+
+The registry lives in this module rather than in qp1, which Streamlit
+re-executes on every rerun; registering the same keywords again keeps the
+compiled matcher.
+"""
+import collections
+import functools
+import re
+import threading
+
+Kind = collections.namedtuple("Kind", "name generator keywords features priority spec_types")
+
+
+class DiagramRegistry:
+    """
+    ``match(description)`` scores every generator by its keyword hits and
+    returns the highest-priority kind with any hit (more hits break ties),
+    or the fallback kind when nothing matches.
+    """
+
+    def __init__(self):
+        self._kinds = {}
+        self._fallback = None
+        self._lock = threading.Lock()
+        self._pattern = None
+        self._implied = {}
+        self._owners = {}
+
+    def register(self, name, keywords=(), features=(), priority=0, fallback=False, spec_types=()):
+        """
+        Decorator registering ``generator(description, index, width, height,
+        seed, spec=None)``
+        """
+        def decorator(generator):
+            kind = Kind(name, generator, tuple(k.lower() for k in keywords),
+                        tuple(f.lower() for f in features), priority, tuple(spec_types))
+            with self._lock:
+                previous = self._kinds.get(name)
+                self._kinds[name] = kind
+                if fallback:
+                    self._fallback = name
+                if previous is None or previous[2:] != kind[2:]:
+                    self._pattern = None
+                    self.scan.cache_clear()
+            return generator
+        return decorator
+
+    def generator(self, name):
+        return self._kinds[name].generator
+
+    def for_spec(self, spec_type):
+        """Name of the generator drawing ``spec_type`` specs, or None"""
+        for kind in self._kinds.values():
+            if spec_type in kind.spec_types:
+                return kind.name
+        return None
+
+    def names(self):
+        return list(self._kinds)
+
+    def _compile(self):
+        """One overlapping-match regex over the whole vocabulary (caller holds the lock)"""
+        vocabulary = set()
+        owners = collections.defaultdict(set)
+        for kind in self._kinds.values():
+            vocabulary.update(kind.keywords, kind.features)
+            for keyword in kind.keywords:
+                owners[keyword].add(kind.name)
+        # Longest first, so each position reports its longest keyword; the
+        # shorter keywords inside it are recovered from ``implied``
+        ordered = sorted(vocabulary, key=lambda k: (-len(k), k))
+        self._implied = {k: frozenset(v for v in vocabulary if v in k) for k in vocabulary}
+        self._owners = dict(owners)
+        if not ordered:
+            return re.compile(r"(?!)")
+        return re.compile("(?=(" + "|".join(map(re.escape, ordered)) + "))")
+
+    def _matcher(self):
+        with self._lock:
+            if self._pattern is None:
+                self._pattern = self._compile()
+            return self._pattern, self._implied, self._owners
+
+    @functools.lru_cache(maxsize=1024)
+    def scan(self, description):
+        """
+        (found keywords, {kind: score}) for a description.  ``found`` holds
+        every registered keyword that occurs in the lowercased text.
+        """
+        pattern, implied, owners = self._matcher()
+        found = set()
+        scores = collections.Counter()
+        for match in pattern.finditer(description.lower()):
+            for keyword in implied[match.group(1)]:
+                found.add(keyword)
+                for owner in owners.get(keyword, ()):
+                    scores[owner] += 1
+        return frozenset(found), dict(scores)
+
+    def found(self, description):
+        """Registered keywords present in the description"""
+        return self.scan(description)[0]
+
+    def match(self, description):
+        """Name of the generator to use for the description"""
+        _, scores = self.scan(description)
+        best = max(scores, key=lambda name: (self._kinds[name].priority, scores[name]), default=None)
+        return best if best is not None else self._fallback
+
+
+DIAGRAMS = DiagramRegistry()
@@ -0,0 +1,154 @@
+"""
+Structured diagram specs written by the model.
+
+Besides free-text descriptions, ``diagram_descriptions`` entries may be
+small JSON objects the generators draw directly (real bar values, circuit
+components, the element of an atom) instead of guessing from the text::
+
+    {"type": "bar", "labels": ["A", "B"], "values": [3, 5], "x_label": "...", "y_label": "..."}
+    {"type": "line" | "scatter", "x": [...], "y": [...], "x_label": "...", "y_label": "..."}
+    {"type": "pie", "labels": [...], "values": [...]}
+    {"type": "circuit", "components": ["battery", "resistor", "lamp", "switch"]}
+    {"type": "triangle", "kind": "right" | "equilateral" | "isosceles" | "scalene"}
+    {"type": "angle", "degrees": 35}
+    {"type": "circle" | "square" | "rectangle"}
+    {"type": "atom", "element": "Na"}
+
+Every spec may also carry ``title`` and ``description``.  ``validate``
+returns a cleaned copy or None; invalid specs fall back to their
+description, which goes down the text path like any other description.
+"""
+import math
+
+# Compact schema for the prompt
+PROMPT_SCHEMA = (
+    '{"type":"bar|pie","labels":[...],"values":[...]} | '
+    '{"type":"line|scatter","x":[...],"y":[...],"x_label":"...","y_label":"..."} | '
+    '{"type":"circuit","components":["battery|resistor|lamp|switch"]} | '
+    '{"type":"triangle","kind":"right|equilateral|isosceles|scalene"} | {"type":"angle","degrees":35} | '
+    '{"type":"circle|square|rectangle"} | {"type":"atom","element":"Na"}'
+)
+
+# Elements the atom diagram can draw (the keys of qp1.ELECTRON_CONFIGS)
+ELEMENT_SYMBOLS = {
+    "H": "Hydrogen", "He": "Helium", "Li": "Lithium", "Be": "Beryllium", "B": "Boron", "C": "Carbon",
+    "N": "Nitrogen", "O": "Oxygen", "F": "Fluorine", "Ne": "Neon", "Na": "Sodium", "Mg": "Magnesium",
+    "Al": "Aluminium", "Si": "Silicon", "P": "Phosphorus", "S": "Sulfur", "Cl": "Chlorine", "Ar": "Argon",
+    "K": "Potassium", "Ca": "Calcium", "Br": "Bromine", "Kr": "Krypton", "I": "Iodine", "Xe": "Xenon",
+    "Cs": "Caesium", "Au": "Gold", "Rn": "Radon", "U": "Uranium",
+}
+_ELEMENT_NAMES = {name.lower(): symbol for symbol, name in ELEMENT_SYMBOLS.items()}
+
+CIRCUIT_COMPONENTS = ("battery", "cell", "resistor", "lamp", "bulb", "switch")
+TRIANGLE_KINDS = ("right", "equilateral", "isosceles", "scalene")
+SHAPES = ("circle", "square", "rectangle")
+
+MAX_POINTS = 200
+MAX_TEXT = 80
+
+
+def _text(value, limit=MAX_TEXT):
+    if value is None:
+        return None
+    if not isinstance(value, (str, int, float)):
+        return None
+    return str(value).strip()[:limit] or None
+
+
+def _numbers(values, min_count=1):
+    """List of finite floats, or None if anything is not a number"""
+    if not isinstance(values, list) or not min_count <= len(values) <= MAX_POINTS:
+        return None
+    numbers = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return None
+        numbers.append(float(value))
+    return numbers
+
+
+def _labels(values):
+    if not isinstance(values, list) or not 1 <= len(values) <= MAX_POINTS:
+        return None
+    labels = [_text(value, 40) for value in values]
+    return None if None in labels else labels
+
+
+def validate(spec):
+    """Cleaned copy of a diagram spec, or None if it cannot be drawn"""
+    if not isinstance(spec, dict):
+        return None
+    kind = str(spec.get("type", "")).strip().lower()
+    cleaned = {"type": kind}
+    for key in ("title", "description", "x_label", "y_label"):
+        value = _text(spec.get(key), 300 if key == "description" else MAX_TEXT)
+        if value:
+            cleaned[key] = value
+
+    if kind in ("bar", "pie"):
+        labels, values = _labels(spec.get("labels")), _numbers(spec.get("values"))
+        if labels is None or values is None or len(labels) != len(values):
+            return None
+        if kind == "pie" and (min(values) < 0 or sum(values) <= 0):
+            return None
+        cleaned.update(labels=labels, values=values)
+    elif kind in ("line", "scatter"):
+        x, y = _numbers(spec.get("x"), 2 if kind == "line" else 1), _numbers(spec.get("y"))
+        if x is None or y is None or len(x) != len(y):
+            return None
+        cleaned.update(x=x, y=y)
+    elif kind == "circuit":
+        components = spec.get("components")
+        if not isinstance(components, list):
+            return None
+        components = [str(c).strip().lower() for c in components]
+        if not components or any(c not in CIRCUIT_COMPONENTS for c in components):
+            return None
+        cleaned["components"] = components
+    elif kind == "triangle":
+        triangle = str(spec.get("kind") or "scalene").strip().lower()
+        if triangle not in TRIANGLE_KINDS:
+            return None
+        cleaned["kind"] = triangle
+    elif kind == "angle":
+        degrees = _numbers([spec.get("degrees")])
+        if degrees is None or not 0 < degrees[0] < 360:
+            return None
+        cleaned["degrees"] = round(degrees[0], 1) if degrees[0] % 1 else int(degrees[0])
+    elif kind == "atom":
+        # A symbol, or the name the model sometimes writes instead
+        symbol = str(spec.get("element") or "").strip()
+        symbol = _ELEMENT_NAMES.get(symbol.lower(), symbol[:1].upper() + symbol[1:].lower())
+        if symbol not in ELEMENT_SYMBOLS:
+            return None
+        cleaned["element"] = symbol
+    elif kind not in SHAPES:
+        return None
+    return cleaned
+
+
+def clean_descriptions(descriptions):
+    """
+    Validate the specs in a diagram_descriptions list.  Returns (entries,
+    invalid count): valid specs are cleaned, invalid ones are replaced by
+    their description (or dropped if they have none), strings are kept.
+    """
+    entries, invalid = [], 0
+    for entry in descriptions:
+        if not isinstance(entry, dict):
+            entries.append(str(entry))
+            continue
+        cleaned = validate(entry)
+        if cleaned is not None:
+            entries.append(cleaned)
+            continue
+        invalid += 1
+        fallback = _text(entry.get("description"), 300)
+        if fallback:
+            entries.append(fallback)
+    return entries, invalid
+
+
+def spec_text(spec):
+    """Text a spec is known by: its description or title, else its type"""
+    return spec.get("description") or spec.get("title") or f"{spec['type']} diagram"
@@ -0,0 +1,158 @@
+"""
+Bulk export of the question bank for offline analytics.
+
+    python export.py questions.parquet
+    python export.py questions.jsonl.gz --level IGCSE --subject Physics --since 2026-01-01
+
+Every banked question is written with its level, subject, topic,
+difficulty, format, model, the token usage and API latency of the
+generation it came from (usage is for the whole generation of
+``generation_questions`` questions) and ``diagram_keys``, the diagram cache
+keys of its diagrams at the default size.  Rows stream from SQLite in
+batches straight into Parquet row groups or JSON lines, so exports of
+millions of questions run in constant memory.
+
+``load`` and ``iter_batches`` read either format back as pyarrow tables /
+record batches (Parquet memory-mapped, JSON lines with Arrow's parser),
+never as Python dicts::
+
+    table = load("questions.parquet", columns=["subject", "difficulty", "completion_tokens"])
+    table.group_by("subject").aggregate([("completion_tokens", "mean")])
+
+Parquet and the loader need pyarrow.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+from datetime import datetime
+
+from app_loader import import_app
+from question_bank import EXPORT_COLUMNS
+
+BATCH_SIZE = 10000
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.json  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise RuntimeError("Parquet export and loading need pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def schema():
+    """Arrow schema of an export"""
+    pa = _pyarrow()
+    types = {
+        "id": pa.int64(), "created_at": pa.float64(), "generation_id": pa.int64(),
+        "prompt_tokens": pa.int64(), "completion_tokens": pa.int64(), "latency_ms": pa.float64(),
+        "generation_questions": pa.int64(),
+    }
+    fields = [pa.field(name, types.get(name, pa.string())) for name in EXPORT_COLUMNS]
+    return pa.schema(fields + [pa.field("diagram_keys", pa.list_(pa.string()))])
+
+
+def export_format(path):
+    """"parquet" or "jsonl", from the file name"""
+    if path.endswith(".parquet"):
+        return "parquet"
+    if path.endswith((".jsonl", ".jsonl.gz", ".ndjson", ".ndjson.gz")):
+        return "jsonl"
+    raise ValueError(f"Cannot tell the export format of {path} (use .parquet, .jsonl or .jsonl.gz)")
+
+
+def _with_diagram_keys(qp1, rows):
+    """Columns of a batch of EXPORT_COLUMNS tuples, plus diagram_keys"""
+    columns = dict(zip(EXPORT_COLUMNS, map(list, zip(*rows))))
+    columns["diagram_keys"] = [
+        qp1.diagram_references(question, json.loads(descriptions))
+        for question, descriptions in zip(columns["question"], columns["diagram_descriptions"])
+    ]
+    return columns
+
+
+def export(bank, path, level=None, subject=None, since=None, batch_size=BATCH_SIZE):
+    """Write the bank's questions to ``path`` (Parquet or JSON lines); returns the row count"""
+    qp1 = import_app()
+    fmt = export_format(path)
+    batches = bank.export_batches(batch_size, level=level, subject=subject, since=since)
+    rows = 0
+
+    if fmt == "parquet":
+        pa = _pyarrow()
+        arrow_schema = schema()
+        with pa.parquet.ParquetWriter(path, arrow_schema, compression="zstd") as writer:
+            for batch in batches:
+                columns = _with_diagram_keys(qp1, batch)
+                writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=arrow_schema))
+                rows += len(batch)
+        return rows
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for batch in batches:
+            columns = _with_diagram_keys(qp1, batch)
+            names = list(columns)
+            lines = (json.dumps(dict(zip(names, values)), ensure_ascii=False)
+                     for values in zip(*columns.values()))
+            f.write("\n".join(lines) + "\n")
+            rows += len(batch)
+    return rows
+
+
+def iter_batches(path, columns=None, batch_size=65536):
+    """Stream an export as pyarrow RecordBatches"""
+    pa = _pyarrow()
+    if export_format(path) == "parquet":
+        yield from pa.parquet.ParquetFile(path, memory_map=True).iter_batches(batch_size, columns=columns)
+        return
+    reader = pa.json.open_json(
+        pa.input_stream(path, compression="detect"),
+        read_options=pa.json.ReadOptions(block_size=8 << 20),
+        parse_options=pa.json.ParseOptions(explicit_schema=schema()),
+    )
+    for batch in reader:
+        yield batch.select(columns) if columns else batch
+
+
+def load(path, columns=None):
+    """Read a whole export (or just ``columns``) as a pyarrow Table"""
+    pa = _pyarrow()
+    if export_format(path) == "parquet":
+        return pa.parquet.read_table(path, columns=columns, memory_map=True)
+    table = pa.json.read_json(
+        pa.input_stream(path, compression="detect"),
+        parse_options=pa.json.ParseOptions(explicit_schema=schema()),
+    )
+    return table.select(columns) if columns else table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="output file: .parquet, .jsonl or .jsonl.gz")
+    parser.add_argument("--level")
+    parser.add_argument("--subject")
+    parser.add_argument("--since", help="only questions banked on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    qp1 = import_app()
+    bank = qp1.get_question_bank()
+    if bank is None:
+        print("The question bank is disabled (EXAMPREP_BANK_PATH is empty)")
+        return 1
+
+    since = datetime.strptime(args.since, "%Y-%m-%d").timestamp() if args.since else None
+    start = time.perf_counter()
+    rows = export(bank, args.path, level=args.level, subject=args.subject, since=since,
+                  batch_size=args.batch_size)
+    print(f"Exported {rows} questions to {args.path} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Executor-backed background jobs.
+
+The Streamlit script thread submits work (question generation) and keeps
+only the job id in session state; the job reports progress that the UI
+polls, and can be cancelled cooperatively: the work function calls
+``job.check_cancelled()`` between steps.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it notices it has been cancelled"""
+
+
+class Job:
+    """State of one background job, safe to read from any thread"""
+
+    def __init__(self, description=""):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.status = QUEUED
+        self.message = "Queued"
+        self.fraction = 0.0
+        self.details = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    def cancel(self):
+        """Ask the job to stop at its next cancellation check"""
+        self._cancel.set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def update(self, message=None, fraction=None, **details):
+        """Report progress (message, overall fraction 0-1, free-form details)"""
+        with self._lock:
+            if message is not None:
+                self.message = message
+            if fraction is not None:
+                self.fraction = max(0.0, min(1.0, fraction))
+            self.details.update(details)
+
+    def snapshot(self):
+        """Consistent copy of the progress fields"""
+        with self._lock:
+            return {
+                "status": self.status,
+                "message": self.message,
+                "fraction": self.fraction,
+                "details": dict(self.details),
+            }
+
+    def _finish(self, status, result=None, error=None):
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            if status == DONE:
+                self.fraction = 1.0
+
+
+class JobQueue:
+    """Runs jobs on a thread pool and keeps finished ones for ``keep_seconds``"""
+
+    def __init__(self, max_workers=4, keep_seconds=3600):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.keep_seconds = keep_seconds
+
+    def submit(self, fn, *args, description="", **kwargs):
+        """Queue ``fn(job, *args, **kwargs)`` and return its Job"""
+        job = Job(description)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def active(self):
+        """Jobs that are queued or running"""
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.done]
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancelled:
+            job._finish(CANCELLED)
+            return
+        job.status = RUNNING
+        job.update(message="Starting")
+        try:
+            result = fn(job, *args, **kwargs)
+        except JobCancelled:
+            job._finish(CANCELLED)
+        except Exception as e:
+            job._finish(FAILED, error=e)
+        else:
+            job._finish(CANCELLED if job.cancelled else DONE, result=result)
+
+    def _prune(self):
+        """Forget finished jobs nobody has collected (caller holds the lock)"""
+        cutoff = time.time() - self.keep_seconds
+        stale = [job_id for job_id, job in self._jobs.items() if job.done and job.finished < cutoff]
+        for job_id in stale:
+            del self._jobs[job_id]
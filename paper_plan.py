@@ -0,0 +1,165 @@
+"""
+Paper assembly as a small constraint problem.
+
+A request for ``count`` questions fixes how many the paper should have of
+each selected topic, difficulty and format: every value of each is used as
+evenly as the count allows (``quotas``).  ``assemble`` fills those quotas
+from banked candidates greedily, always taking the question whose topic,
+difficulty and format are scarcest in the candidate pool relative to what
+is still needed, and among equals the one whose marks keep the paper on its
+total marks target.  Because the quotas are per dimension rather than per
+(topic, difficulty, format) cell, the bank can fill a quota with any cell
+that fits.  What is left becomes ``Slot``s, the only questions sent to the
+API, which ``assign`` matches back to the questions that come back.
+
+Marks come from the mark scheme's annotations ([2], (3 marks), M1/A1),
+defaulting by difficulty; the time of a paper is taken as proportional to
+its marks.
+"""
+import collections
+import random
+import re
+
+import numpy as np
+
+Slot = collections.namedtuple("Slot", "topic difficulty format")
+
+DIMENSIONS = Slot._fields
+# Marks assumed for a question whose mark scheme does not show them
+DEFAULT_MARKS = {"Easy": 2, "Medium": 4, "Hard": 6}
+# Exam minutes per mark
+MINUTES_PER_MARK = 1.2
+
+_MARK_ANNOTATIONS = re.compile(r"\[\s*(\d+)\s*(?:marks?)?\s*\]|\(\s*(\d+)\s*marks?\s*\)", re.IGNORECASE)
+_MARK_CODES = re.compile(r"\b[MABC]\d\b")
+
+
+def question_marks(question):
+    """Marks a question is worth"""
+    marks = question.get("marks")
+    if isinstance(marks, (int, float)) and not isinstance(marks, bool) and marks > 0:
+        return int(marks)
+    scheme = question.get("mark_scheme")
+    if isinstance(scheme, str):
+        annotated = [int(a or b) for a, b in _MARK_ANNOTATIONS.findall(scheme)]
+        if annotated:
+            return sum(annotated)
+        codes = len(_MARK_CODES.findall(scheme))
+        if codes:
+            return codes
+    return DEFAULT_MARKS.get(question.get("difficulty"), DEFAULT_MARKS["Medium"])
+
+
+def paper_minutes(marks):
+    """Rough exam time of a paper worth ``marks``"""
+    return round(marks * MINUTES_PER_MARK)
+
+
+def _label(question, dimension):
+    value = question.get(dimension)
+    return value.strip().lower() if isinstance(value, str) else None
+
+
+def quotas(count, topics, difficulties, formats, rng=random):
+    """
+    {dimension: Counter(value -> questions)} spreading ``count`` questions
+    as evenly as possible over each dimension's values (the remainder goes
+    to random values)
+    """
+    result = {}
+    for dimension, values in zip(DIMENSIONS, (topics, difficulties, formats)):
+        values = list(values)
+        counts = collections.Counter({value: count // len(values) for value in values})
+        counts.update(rng.sample(values, count % len(values)))
+        result[dimension] = counts
+    return result
+
+
+def assemble(count, topics, difficulties, formats, candidates, target_marks=None, rng=random):
+    """
+    Choose up to ``count`` of ``candidates`` (question dicts) within the
+    quotas, aiming for ``target_marks`` in total if given.  Returns
+    (chosen questions, open slots, marks per open slot or None).
+    """
+    remaining = quotas(count, topics, difficulties, formats, rng)
+    values = [list(remaining[d]) for d in DIMENSIONS]
+    # Labels are matched case-insensitively; a missing or "Mixed" label (-1)
+    # fits any value, other candidates outside the quotas are never usable
+    positions = [dict({value.lower(): i for i, value in enumerate(dimension)}, mixed=-1) for dimension in values]
+    pool, rows = [], []
+    for question in candidates:
+        row = [positions[i].get(_label(question, d) or "mixed") for i, d in enumerate(DIMENSIONS)]
+        if None not in row:
+            pool.append(question)
+            rows.append(row)
+
+    # One vectorised pass over the pool per question chosen
+    labels = np.array(rows, dtype=np.intp).reshape(-1, len(DIMENSIONS))
+    marks = np.array([question_marks(question) for question in pool], dtype=float)
+    needed = [np.array([remaining[d][value] for value in dimension], dtype=float)
+              for d, dimension in zip(DIMENSIONS, values)]
+    alive = np.ones(len(pool), dtype=bool)
+    chosen = []
+    marks_left = target_marks
+    while alive.any() and len(chosen) < count:
+        # Demand over supply of each label, summed: the most constrained question first
+        # (labelled questions before unlabelled ones)
+        scarcity = np.zeros(len(pool))
+        for i, need in enumerate(needed):
+            column = labels[:, i]
+            known = column >= 0
+            supply = np.bincount(column[alive & known], minlength=len(need))
+            scarcity[known] += need[column[known]] / np.maximum(supply[column[known]], 1)
+        scarcity[~alive] = -np.inf
+        best = np.flatnonzero(scarcity == scarcity.max())
+        if target_marks:
+            ideal = marks_left / (count - len(chosen))
+            best = best[np.argmin(np.abs(marks[best] - ideal))]
+            marks_left -= marks[best]
+        else:
+            best = best[0]
+
+        chosen.append(pool[best])
+        alive[best] = False
+        for i, need in enumerate(needed):
+            # An unlabelled question counts towards the value needed most
+            label = labels[best, i] if labels[best, i] >= 0 else np.argmax(need)
+            need[label] -= 1
+            alive &= (labels[:, i] < 0) | (need[labels[:, i]] > 0)
+
+    remaining = {d: collections.Counter({value: int(n) for value, n in zip(dimension, need)})
+                 for d, dimension, need in zip(DIMENSIONS, values, needed)}
+
+    # Pair up what the bank could not supply, one slot per missing question
+    open_values = []
+    for d in DIMENSIONS:
+        missing = list(remaining[d].elements())
+        rng.shuffle(missing)
+        open_values.append(missing)
+    slots = [Slot(*labels) for labels in zip(*open_values)]
+    marks_per_slot = None
+    if target_marks and slots:
+        marks_per_slot = max(1, round(marks_left / len(slots)))
+    return chosen, slots, marks_per_slot
+
+
+def assign(slots, questions):
+    """
+    Match generated ``questions`` to ``slots``: the best-agreeing question
+    first for each slot (topic, then difficulty, then format).  Returns
+    (matched questions in slot order, how many differ from their slot).
+    """
+    free = list(questions)
+    matched, off_plan = [], 0
+    for slot in slots:
+        if not free:
+            break
+
+        def agreement(question):
+            return tuple(_label(question, d) == getattr(slot, d).lower() for d in DIMENSIONS)
+
+        best = max(free, key=agreement)
+        free.remove(best)
+        matched.append(best)
+        off_plan += not all(agreement(best))
+    return matched, off_plan
@@ -0,0 +1,172 @@
+"""
+Pre-warm the question bank before peak (exam) season.
+
+Walks every (level, subject, topic, difficulty, format) cell of SUBJECTS,
+TOPICS and QUESTION_FORMATS, generates questions for cells below the target
+inventory and renders their diagrams into the diagram cache, emptiest cells
+first.  Requests go through the app's shared-key rate limiter, by default at
+half of GROQ_RPM/GROQ_TPM so a running app keeps the rest.
+
+    python prewarm.py --report                      # cells below target, no API calls
+    python prewarm.py --target 10 --window 01:00-06:00
+
+Schedule it off-peak, e.g. from cron::
+
+    0 1 * * * cd /srv/examprep && python prewarm.py --window 01:00-06:00
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from app_loader import import_app
+
+DIFFICULTIES = ["Easy", "Medium", "Hard"]
+
+# Stop after this many generations in a row have failed (API down, key revoked...)
+MAX_CONSECUTIVE_FAILURES = 5
+
+
+def cells(qp1, levels=None, subjects=None):
+    """Every (level, subject, topic, difficulty, format) the app can ask for"""
+    for level, level_subjects in qp1.SUBJECTS.items():
+        if levels and level not in levels:
+            continue
+        for subject in level_subjects:
+            if subjects and subject not in subjects:
+                continue
+            for topic in qp1.TOPICS.get(f"{level} {subject}", ["General Curriculum"]):
+                for difficulty in DIFFICULTIES:
+                    for question_format in qp1.QUESTION_FORMATS:
+                        yield level, subject, topic, difficulty, question_format
+
+
+def inventory(qp1, bank, target, levels=None, subjects=None):
+    """Cells below ``target`` as dicts, emptiest first"""
+    counts = bank.cell_counts()
+    rows = []
+    for cell in cells(qp1, levels, subjects):
+        count = counts.get(cell, 0)
+        if count < target:
+            level, subject, topic, difficulty, question_format = cell
+            rows.append({"level": level, "subject": subject, "topic": topic, "difficulty": difficulty,
+                         "format": question_format, "count": count, "missing": target - count})
+    rows.sort(key=lambda row: row["count"])
+    return rows
+
+
+def parse_window(window):
+    """'01:00-06:00' -> (time(1, 0), time(6, 0))"""
+    start, end = (datetime.strptime(part.strip(), "%H:%M").time() for part in window.split("-"))
+    return start, end
+
+
+def in_window(window, now):
+    start, end = window
+    if start <= end:
+        return start <= now.time() < end
+    # Window over midnight, e.g. 22:00-05:00
+    return now.time() >= start or now.time() < end
+
+
+def seconds_until(moment, now):
+    target = datetime.combine(now.date(), moment)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+def prewarm(qp1, bank, target, batch_size, model, window=None, levels=None, subjects=None, max_requests=None):
+    """Fill cells below target; returns (requests made, questions stored)"""
+    rows = inventory(qp1, bank, target, levels, subjects)
+    print(f"{len(rows)} cells below {target} questions ({sum(r['missing'] for r in rows)} questions missing)")
+
+    requests_made = stored = failures = 0
+    for row in rows:
+        if max_requests is not None and requests_made >= max_requests:
+            break
+        if window and not in_window(window, datetime.now()):
+            print("Off-peak window is over, stopping")
+            break
+
+        before = bank.count(row["level"], row["subject"], [row["topic"]], row["difficulty"], row["format"])
+        missing = target - before
+        if missing <= 0:
+            continue
+
+        label = f"{row['level']} {row['subject']} / {row['topic']} / {row['difficulty']} / {row['format']}"
+        requests_made += 1
+        try:
+            # Questions and diagrams land in the bank and diagram cache as a side effect
+            qp1.run_generation(row["subject"], row["level"], [row["topic"]], min(missing, batch_size),
+                               row["difficulty"], row["format"], model, session_id="prewarm")
+        except qp1.GenerationError as e:
+            failures += 1
+            print(f"  {label}: failed ({e})")
+            if failures >= MAX_CONSECUTIVE_FAILURES:
+                print(f"{failures} failures in a row, giving up")
+                break
+            continue
+        failures = 0
+
+        after = bank.count(row["level"], row["subject"], [row["topic"]], row["difficulty"], row["format"])
+        stored += after - before
+        print(f"  {label}: {before} -> {after}")
+    return requests_made, stored
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", type=int, default=10, help="questions wanted per cell")
+    parser.add_argument("--batch-size", type=int, default=5, help="questions per API request")
+    parser.add_argument("--level", action="append", help="only this level (repeatable)")
+    parser.add_argument("--subject", action="append", help="only this subject (repeatable)")
+    parser.add_argument("--window", help="only generate between HH:MM-HH:MM, waiting for the start")
+    parser.add_argument("--max-requests", type=int, help="stop after this many API requests")
+    parser.add_argument("--rpm", type=int, help="requests per minute for this job (default: half of GROQ_RPM)")
+    parser.add_argument("--tpm", type=int, help="tokens per minute for this job (default: half of GROQ_TPM)")
+    parser.add_argument("--model", help="model to generate with (default: the app's default)")
+    parser.add_argument("--report", action="store_true", help="only print the cells below target")
+    parser.add_argument("--csv", help="write the inventory report to this CSV file")
+    args = parser.parse_args(argv)
+
+    qp1 = import_app()
+    bank = qp1.get_question_bank()
+    if bank is None:
+        print("The question bank is disabled (EXAMPREP_BANK_PATH is empty)")
+        return 1
+
+    if args.report or args.csv:
+        rows = inventory(qp1, bank, args.target, args.level, args.subject)
+        report = pd.DataFrame(rows, columns=["level", "subject", "topic", "difficulty", "format",
+                                             "count", "missing"])
+        if args.csv:
+            report.to_csv(args.csv, index=False)
+        print(report.to_string(index=False) if rows else f"Every cell has at least {args.target} questions")
+        print(f"{len(rows)} cells below target, {int(report['missing'].sum())} questions missing")
+        return 0
+
+    # Leave part of the shared key's capacity to the app
+    qp1.GROQ_RPM = args.rpm or max(1, qp1.GROQ_RPM // 2)
+    qp1.GROQ_TPM = args.tpm or max(1, qp1.GROQ_TPM // 2)
+    qp1.get_rate_limiter.clear()
+
+    window = parse_window(args.window) if args.window else None
+    if window and not in_window(window, datetime.now()):
+        wait = seconds_until(window[0], datetime.now())
+        print(f"Waiting {wait / 3600:.1f}h for the off-peak window {args.window}")
+        time.sleep(wait)
+
+    start = time.perf_counter()
+    requests_made, stored = prewarm(qp1, bank, args.target, args.batch_size,
+                                    args.model or qp1.GROQ_MODELS[1], window=window,
+                                    levels=args.level, subjects=args.subject, max_requests=args.max_requests)
+    print(f"{requests_made} requests, {stored} questions stored in {time.perf_counter() - start:.0f}s "
+          f"(GROQ_RPM={qp1.GROQ_RPM}, GROQ_TPM={qp1.GROQ_TPM})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+Lightweight span instrumentation for the question generation pipeline.
+
+Every stage (API call, JSON extraction, diagram rendering, PDF building) and
+every diagram generator is timed with ``span`` / ``profiled``.  Timings are
+aggregated into per-stage histograms that the Streamlit debug expander reads
+through ``PROFILER.snapshot()``.
+
+Set ``EXAMPREP_PROFILE_DIR`` to also keep cProfile dumps of the slowest
+requests (``EXAMPREP_PROFILE_TOP_N`` of them, default 5).
+"""
+import cProfile
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in milliseconds (the last bucket is open ended)
+HISTOGRAM_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Number of recent samples kept per stage for percentile estimates
+RECENT_SAMPLES = 1000
+
+
+class StageStats:
+    """Running statistics and a fixed-bucket histogram for one stage"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def add(self, elapsed):
+        elapsed_ms = elapsed * 1000
+        self.count += 1
+        self.total += elapsed
+        self.min = elapsed if self.min is None else min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.recent.append(elapsed)
+
+        # Find the first bucket whose upper bound holds this sample
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, pct):
+        """Percentile (0-100) over the recent samples, in seconds"""
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        pos = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[pos]
+
+    def histogram(self):
+        """Return the histogram as a list of (label, count) pairs"""
+        labels = [f"<={b}ms" for b in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}ms"]
+        return list(zip(labels, self.buckets))
+
+
+class Profiler:
+    """Process-wide collector shared by all Streamlit sessions"""
+
+    def __init__(self, profile_dir=None, top_n=5):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._counters = {}
+        self._local = threading.local()
+        self.profile_dir = profile_dir
+        self.top_n = top_n
+        # Min-heap of (elapsed, seq, path) for the slowest profiled requests
+        self._slowest = []
+        self._seq = itertools.count()
+
+    def record(self, name, elapsed):
+        """Add one timing sample (in seconds) to the named stage"""
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = StageStats()
+            stats.add(elapsed)
+
+    def count(self, name, amount=1):
+        """Increment a named counter (hits, retries, cache misses...)"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block and record it under ``name``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def profiled(self, name):
+        """Decorator version of ``span``"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def request(self, name="request", label=None):
+        """
+        Time a whole request.  When a profile directory is configured, the
+        request also runs under cProfile and the dump is kept if it is among
+        the slowest ``top_n`` seen so far.  Nested requests in the same thread
+        are only timed, never profiled twice.
+        """
+        nested = getattr(self._local, "active", False)
+        profiler = None
+        if self.profile_dir and not nested:
+            profiler = cProfile.Profile()
+
+        self._local.active = True
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            elapsed = time.perf_counter() - start
+            self._local.active = nested
+            self.record(name, elapsed)
+            if profiler is not None:
+                self._keep_profile(profiler, name, label, elapsed)
+
+    def _keep_profile(self, profiler, name, label, elapsed):
+        """Write the dump if it ranks among the slowest requests"""
+        with self._lock:
+            if len(self._slowest) >= self.top_n and elapsed <= self._slowest[0][0]:
+                return
+            seq = next(self._seq)
+            os.makedirs(self.profile_dir, exist_ok=True)
+            slug = "".join(c if c.isalnum() else "_" for c in (label or name))[:60]
+            path = os.path.join(self.profile_dir, f"{name}_{seq:06d}_{int(elapsed * 1000)}ms_{slug}.prof")
+            profiler.dump_stats(path)
+            heapq.heappush(self._slowest, (elapsed, seq, path))
+
+            # Drop the fastest dump once we hold more than top_n
+            if len(self._slowest) > self.top_n:
+                _, _, stale = heapq.heappop(self._slowest)
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def slowest_profiles(self):
+        """Paths of the kept cProfile dumps, slowest first"""
+        with self._lock:
+            return [path for _, _, path in sorted(self._slowest, reverse=True)]
+
+    def snapshot(self):
+        """Summary rows (one per stage) suitable for a DataFrame"""
+        with self._lock:
+            rows = []
+            for name in sorted(self._stats):
+                stats = self._stats[name]
+                rows.append({
+                    "stage": name,
+                    "count": stats.count,
+                    "mean_ms": round(stats.total / stats.count * 1000, 2),
+                    "p50_ms": round(stats.percentile(50) * 1000, 2),
+                    "p95_ms": round(stats.percentile(95) * 1000, 2),
+                    "max_ms": round(stats.max * 1000, 2),
+                    "total_s": round(stats.total, 3),
+                })
+            return rows
+
+    def histograms(self):
+        """Histogram per stage as {stage: [(bucket label, count), ...]}"""
+        with self._lock:
+            return {name: stats.histogram() for name, stats in self._stats.items()}
+
+    def stage(self, name):
+        """Return the StageStats for ``name`` (or None if never recorded)"""
+        with self._lock:
+            return self._stats.get(name)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._counters.clear()
+
+
+PROFILER = Profiler(
+    profile_dir=os.getenv("EXAMPREP_PROFILE_DIR"),
+    top_n=int(os.getenv("EXAMPREP_PROFILE_TOP_N", "5")),
+)
+
+# Module-level shortcuts
+span = PROFILER.span
+profiled = PROFILER.profiled
@@ -0,0 +1,120 @@
+"""
+Chat messages for question generation.
+
+Everything that does not depend on the request (instructions, output
+format, the diagram spec schema) is a constant system message built once at
+import, so it is byte-identical across calls and providers can reuse its
+cached prefix.  Each request only adds a short user message naming the
+level, subject, topics, count, difficulty and format.
+
+The optional few-shot mode swaps the spelled-out output structure for one
+short worked example (about the same size), for models that drift from
+the JSON format.
+"""
+import json
+
+from diagram_spec import PROMPT_SCHEMA
+
+INSTRUCTIONS = f"""You are an exam question generator for IGCSE and A-Level subjects. Generate high-quality past paper style questions for the level, subject, topics, difficulty and format given in the request.
+
+The questions should:
+1. Match real exam questions of that level and subject in style, format, and complexity
+2. Include a detailed mark scheme showing how points are awarded
+3. Be clearly labeled with their difficulty level (Easy, Medium, or Hard)
+4. Include diagrams where appropriate - describe any needed diagrams in detail by enclosing the description in [DIAGRAM: description] tags
+
+Where a diagram is a chart, circuit, shape or atom, give it in diagram_descriptions as a JSON object instead of text, with the real data the question uses:
+{PROMPT_SCHEMA}
+Add "title" and "description" to every object."""
+
+OUTPUT_FORMAT = """Format your response as a JSON array of questions with the following structure:
+```json
+[
+  {
+    "question": "The full text of the question...",
+    "topic": "The specific topic",
+    "difficulty": "Easy|Medium|Hard",
+    "format": "Multiple Choice|Short Answer|Calculation|Extended Response|Practical",
+    "mark_scheme": "The full mark scheme...",
+    "diagram_descriptions": ["Description 1", {"type": "bar", "labels": ["A", "B"], "values": [3, 5], "title": "...", "description": "..."}] // Only if diagrams are needed
+  }
+]
+```"""
+
+# The few-shot example shows the structure, so the compact prompt only names it
+COMPACT_OUTPUT_FORMAT = ("Format your response as a ```json array of question objects with the keys of the "
+                         "example (diagram_descriptions only if diagrams are needed).")
+
+CLOSING = ("The generated questions should be challenging but fair, and should test understanding rather than "
+           "just recall. Make the questions engaging and relevant to real-world applications where possible.")
+
+SYSTEM_PROMPT = "\n\n".join([INSTRUCTIONS, OUTPUT_FORMAT, CLOSING])
+COMPACT_SYSTEM_PROMPT = "\n\n".join([INSTRUCTIONS, COMPACT_OUTPUT_FORMAT, CLOSING])
+
+# One short worked exchange for the few-shot mode
+FEW_SHOT = (
+    {"role": "user", "content": "Generate 1 IGCSE Physics question.\nTopics: Electricity\n"
+                                "Difficulty: Easy\nFormat: Calculation"},
+    {"role": "assistant", "content": "```json\n" + json.dumps([{
+        "question": "A 12 V battery is connected to a 4 Ω resistor. Calculate the current in the resistor.",
+        "topic": "Electricity",
+        "difficulty": "Easy",
+        "format": "Calculation",
+        "mark_scheme": "I = V / R [1]\nI = 12 / 4 = 3 A [1]",
+        "diagram_descriptions": [{"type": "circuit", "components": ["battery", "resistor"],
+                                  "title": "Battery and resistor", "description": "A battery in series with a resistor"}],
+    }], ensure_ascii=False) + "\n```"},
+)
+
+
+class PromptTemplate:
+    """A constant message prefix plus one variable user message per request"""
+
+    def __init__(self, system, examples=()):
+        self.prefix = ({"role": "system", "content": system},) + tuple(examples)
+        self.prefix_chars = sum(len(message["content"]) for message in self.prefix)
+
+    def messages(self, request):
+        # Copies, so callers cannot change the shared prefix
+        return [dict(message) for message in self.prefix] + [{"role": "user", "content": request}]
+
+
+TEMPLATES = {
+    False: PromptTemplate(SYSTEM_PROMPT),
+    True: PromptTemplate(COMPACT_SYSTEM_PROMPT, FEW_SHOT),
+}
+
+
+def request_text(level, subject, topics, num_questions, difficulty, question_type, formats, slots=None,
+                 marks=None):
+    """
+    The per-request part of the prompt.  ``slots`` (paper_plan.Slot) pin
+    the topic, difficulty and format of every question; ``marks`` asks for
+    about that many marks per question.
+    """
+    marks_str = f"\nMarks: about {marks} per question" if marks else ""
+    if slots:
+        lines = [f"{i}. Topic: {slot.topic}; Difficulty: {slot.difficulty}; Format: {slot.format}"
+                 for i, slot in enumerate(slots, 1)]
+        return (f"Generate {len(slots)} {level} {subject} questions, one for each line, in this order:\n"
+                + "\n".join(lines) + marks_str)
+    if difficulty != "Mixed":
+        difficulty_str = difficulty
+    else:
+        difficulty_str = "Mixed, with approximately equal numbers of Easy, Medium, and Hard questions"
+    if question_type != "Mixed":
+        format_str = f"{question_type} - {formats[question_type]}"
+    else:
+        format_str = "Mixed, including multiple choice, short answer, calculation, and extended response"
+    return (f"Generate {num_questions} {level} {subject} questions.\n"
+            f"Topics: {', '.join(topics)}\n"
+            f"Difficulty: {difficulty_str}\n"
+            f"Format: {format_str}"
+            + marks_str)
+
+
+def build_messages(level, subject, topics, num_questions, difficulty, question_type, formats, few_shot=False,
+                   slots=None, marks=None):
+    """Chat messages for one generation request"""
+    return TEMPLATES[bool(few_shot)].messages(
+        request_text(level, subject, topics, num_questions, difficulty, question_type, formats, slots, marks))
@@ -7,20 +7,39 @@ import random
 import re
 from datetime import datetime
 import tempfile
+import queue
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from reportlab.lib.utils import ImageReader
 import io
 import matplotlib.pyplot as plt
 import numpy as np
 import base64
-from PIL import Image as PILImage, ImageDraw, ImageFont
+from PIL import Image as PILImage
 import math
 from dotenv import load_dotenv
 import os
+from profiling import PROFILER, span, profiled
+from singleflight import SingleFlight
+import answer_check
+import diagram_layers
+import paper_plan
+from diagram_registry import DIAGRAMS
+from diagram_spec import ELEMENT_SYMBOLS, clean_descriptions, spec_text
+from prompts import build_messages
+from ratelimit import GroqRateLimiter, RateLimitTimeout
+from jobs import JobQueue, JobCancelled, DONE, CANCELLED
+from question_bank import DIFFICULTIES, open_question_bank
+from cache_backend import open_cache
+from dedupe import MinHasher, LSHIndex, question_text, unique_mask
 
 # Set up page configuration
 st.set_page_config(
@@ -32,6 +51,11 @@ st.set_page_config(
 
 load_dotenv()  # Loads .env into environment variables
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# Chat completions endpoint (overridable, e.g. to point at benchmarks/mock_groq.py)
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+# Provider limits of the shared key, enforced process-wide across all sessions
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = int(os.getenv("GROQ_TPM", "6000"))
  # Replace this with your actual Groq API key
 
 # Initialize session state variables if they don't exist
@@ -41,6 +65,12 @@ if 'selected_subject' not in st.session_state:
     st.session_state.selected_subject = None
 if 'selected_topics' not in st.session_state:
     st.session_state.selected_topics = []
+if 'generation_job_id' not in st.session_state:
+    st.session_state.generation_job_id = None
+if 'generation_notice' not in st.session_state:
+    st.session_state.generation_notice = None
+if 'question_page' not in st.session_state:
+    st.session_state.question_page = 1
 
 # CSS styling
 st.markdown("""
@@ -202,46 +232,78 @@ def process_diagram_text(text):
     return clean_text, diagrams
 
 
+
+# Many identical primitives (electrons, organelles, particles) are placed
+# with NumPy array ops and drawn from the precomputed boxes in one pass
+def draw_ellipses(draw, centers, rx, ry, fill=None, outline=None, width=1):
+    """Same as draw.ellipse for each (x, y) center with half-axes rx, ry"""
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    boxes = np.concatenate([centers - (rx, ry), centers + (rx, ry)], axis=1).tolist()
+    ellipse = draw.ellipse
+    for box in boxes:
+        ellipse(box, fill=fill, outline=outline, width=width)
+
+
+def draw_squares(draw, centers, half, fill):
+    """Same as draw.rectangle([(x-half, y-half), (x+half, y+half)], fill=fill) for each center"""
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    rectangle = draw.rectangle
+    for box in np.concatenate([centers - half, centers + half], axis=1).tolist():
+        rectangle(box, fill=fill)
+
+
+def ring_points(cx, cy, radius, count, start_degrees=0.0):
+    """(count, 2) integer points evenly spaced on a circle, as int(r * cos) offsets"""
+    angles = np.radians(start_degrees + np.arange(count) * 360.0 / count)
+    radius = np.broadcast_to(radius, angles.shape)
+    return np.stack([cx + (radius * np.cos(angles)).astype(np.int64),
+                     cy + (radius * np.sin(angles)).astype(np.int64)], axis=1)
+
+
+def diagram_seed(description, question_id=None):
+    """Stable 64-bit seed for a diagram's random elements"""
+    key = description.strip() if question_id is None else f"{question_id}|{description.strip()}"
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "little")
+
+
+def diagram_rng(description, seed=None):
+    """Local generator for one diagram; never touches the global random state"""
+    return np.random.default_rng(diagram_seed(description) if seed is None else seed)
+
+
 # Function to generate diagrams based on description
-def generate_diagram(description, index, width=600, height=400):
+def generate_diagram(description, index, width=600, height=400, seed=None, spec=None):
     """
     Generate a more visual diagram based on the description.
     Analyzes the text to determine what kind of diagram to create.
+    
+    Random elements come from ``seed`` (default: derived from the
+    description), so the same inputs always give the same PNG bytes.
+    
+    ``description`` may also be a validated diagram spec (see diagram_spec),
+    which goes straight to the generator drawing its type.
     """
-    # Convert description to lowercase for easier matching
-    desc_lower = description.lower()
-    
-    # Default is a simple text diagram
-    if "graph" in desc_lower or "plot" in desc_lower or "curve" in desc_lower:
-        return generate_graph_diagram(description, index, width, height)
-    elif "circuit" in desc_lower:
-        return generate_circuit_diagram(description, index, width, height)
-    elif "triangle" in desc_lower or "square" in desc_lower or "circle" in desc_lower or "angle" in desc_lower:
-        return generate_geometric_diagram(description, index, width, height)
-    elif "cell" in desc_lower or "organ" in desc_lower or "plant" in desc_lower or "animal" in desc_lower:
-        return generate_biology_diagram(description, index, width, height)
-    elif "molecule" in desc_lower or "atom" in desc_lower or "compound" in desc_lower or "reaction" in desc_lower:
-        return generate_chemistry_diagram(description, index, width, height)
-    else:
-        return generate_text_diagram(description, index, width, height)
+    if isinstance(description, dict):
+        spec, description = description, spec_text(description)
+    if seed is None:
+        seed = diagram_seed(description if spec is None else json.dumps(spec, sort_keys=True))
+    
+    # A spec names its generator; otherwise one keyword scan picks it (see
+    # the DIAGRAMS.register calls) and anything unmatched becomes text
+    kind = DIAGRAMS.for_spec(spec["type"]) if spec is not None else None
+    if kind is None:
+        kind = DIAGRAMS.match(description)
+    PROFILER.count(f"diagram.{kind}")
+    return DIAGRAMS.generator(kind)(description, index, width, height, seed, spec)
 
 
-def generate_text_diagram(description, index, width=600, height=400):
+@DIAGRAMS.register("text", fallback=True)
+@profiled("diagram:text")
+def generate_text_diagram(description, index, width=600, height=400, seed=None, spec=None):
     """Create a basic text diagram"""
-    # Create a blank image with a white background
-    img = PILImage.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(img)
-    
-    # Try to load a font, fallback to default if not available
-    try:
-        font = ImageFont.truetype("arial.ttf", 18)
-        title_font = ImageFont.truetype("arial.ttf", 24)
-    except IOError:
-        font = ImageFont.load_default()
-        title_font = ImageFont.load_default()
-    
-    # Draw a border
-    draw.rectangle([(10, 10), (width-10, height-10)], outline='black', width=2)
+    # Start from the pre-rendered blank bordered image
+    img, draw = diagram_layers.canvas("text", None, width, height)
+    font, title_font, _ = diagram_layers.fonts()
     
     # Add a title
     draw.text((width//2-80, 20), f"Diagram {index}", fill='black', font=title_font)
@@ -277,35 +339,63 @@ def generate_text_diagram(description, index, width=600, height=400):
     return buf
 
 
-def generate_graph_diagram(description, index, width=600, height=400):
+@DIAGRAMS.register("graph", keywords=("graph", "plot", "curve"), priority=50,
+                   features=("bar", "histogram", "pie", "scatter", "sine", "sin", "cosine", "cos",
+                             "exponential", "exp", "logarithm", "log", "parabola", "quadratic"),
+                   spec_types=("bar", "pie", "line", "scatter"))
+@profiled("diagram:graph")
+def generate_graph_diagram(description, index, width=600, height=400, seed=None, spec=None):
     """Create a graph or plot based on the description"""
     fig, ax = plt.subplots(figsize=(width/100, height/100), dpi=100)
+    rng = diagram_rng(description, seed)
     
     # Determine the type of graph from the description
-    desc_lower = description.lower()
+    found = DIAGRAMS.found(description)
     
-    if "bar" in desc_lower or "histogram" in desc_lower:
+    if spec is not None and spec["type"] in ("line", "scatter"):
+        # Plot the model's own data
+        if spec["type"] == "line":
+            ax.plot(spec["x"], spec["y"], marker='o' if len(spec["x"]) <= 20 else None)
+            ax.grid(True)
+        else:
+            ax.scatter(spec["x"], spec["y"])
+        ax.set_xlabel(spec.get("x_label", 'X-axis'))
+        ax.set_ylabel(spec.get("y_label", 'Y-axis'))
+        ax.set_title(f'Diagram {index}: {spec.get("title", spec["type"].capitalize() + " Graph")}')
+        
+    elif spec is not None and spec["type"] == "pie":
+        ax.pie(spec["values"], labels=spec["labels"], autopct='%1.1f%%', startangle=90)
+        ax.axis('equal')
+        ax.set_title(f'Diagram {index}: {spec.get("title", "Pie Chart")}')
+        
+    elif spec is not None:
+        ax.bar(spec["labels"], spec["values"])
+        ax.set_xlabel(spec.get("x_label", 'Categories'))
+        ax.set_ylabel(spec.get("y_label", 'Values'))
+        ax.set_title(f'Diagram {index}: {spec.get("title", "Bar Chart")}')
+        
+    elif "bar" in found or "histogram" in found:
         # Generate a bar chart
         categories = ['A', 'B', 'C', 'D', 'E']
-        values = np.random.randint(10, 100, size=5)
+        values = rng.integers(10, 100, size=5)
         ax.bar(categories, values)
         ax.set_xlabel('Categories')
         ax.set_ylabel('Values')
         ax.set_title(f'Diagram {index}: Bar Chart')
         
-    elif "pie" in desc_lower:
+    elif "pie" in found:
         # Generate a pie chart
         labels = ['Category A', 'Category B', 'Category C', 'Category D']
-        sizes = np.random.rand(4)
+        sizes = rng.random(4)
         sizes = sizes / sizes.sum()  # Normalize to sum to 1
         ax.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90)
         ax.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle
         ax.set_title(f'Diagram {index}: Pie Chart')
         
-    elif "scatter" in desc_lower:
+    elif "scatter" in found:
         # Generate a scatter plot
-        x = np.random.rand(30)
-        y = np.random.rand(30)
+        x = rng.random(30)
+        y = rng.random(30)
         ax.scatter(x, y)
         ax.set_xlabel('X-axis')
         ax.set_ylabel('Y-axis')
@@ -315,19 +405,19 @@ def generate_graph_diagram(description, index, width=600, height=400):
         # Default to a line graph
         x = np.linspace(0, 10, 100)
         
-        if "sine" in desc_lower or "sin" in desc_lower:
+        if "sine" in found or "sin" in found:
             y = np.sin(x)
             title = "Sine Wave"
-        elif "cosine" in desc_lower or "cos" in desc_lower:
+        elif "cosine" in found or "cos" in found:
             y = np.cos(x)
             title = "Cosine Wave"
-        elif "exponential" in desc_lower or "exp" in desc_lower:
+        elif "exponential" in found or "exp" in found:
             y = np.exp(x/5) / np.exp(2)  # Scaled exponential
             title = "Exponential Function"
-        elif "logarithm" in desc_lower or "log" in desc_lower:
+        elif "logarithm" in found or "log" in found:
             y = np.log(x + 1)
             title = "Logarithmic Function"
-        elif "parabola" in desc_lower or "quadratic" in desc_lower:
+        elif "parabola" in found or "quadratic" in found:
             y = x**2 / 10
             title = "Quadratic Function"
         else:
@@ -352,119 +442,121 @@ def generate_graph_diagram(description, index, width=600, height=400):
     return buf
 
 
-def generate_circuit_diagram(description, index, width=600, height=400):
-    """Create a simple circuit diagram based on the description"""
-    # Create a blank image with a white background
-    img = PILImage.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(img)
+@diagram_layers.layer("circuit")
+def paint_circuit_loop(draw, width, height):
+    """Border and the basic circuit loop"""
+    left_x, right_x, top_y, bottom_y = 100, width - 100, 100, height - 100
+    draw.line([(left_x, top_y), (right_x, top_y)], fill='black', width=3)
+    draw.line([(right_x, top_y), (right_x, bottom_y)], fill='black', width=3)
+    draw.line([(right_x, bottom_y), (left_x, bottom_y)], fill='black', width=3)
+    draw.line([(left_x, bottom_y), (left_x, top_y)], fill='black', width=3)
+
+
+@diagram_layers.layer("circuit", "battery")
+def paint_battery(draw, width, height):
+    # Battery on the left side
+    battery_x = 100
+    battery_top = 100 + 50
     
-    # Try to load a font, fallback to default if not available
-    try:
-        font = ImageFont.truetype("arial.ttf", 18)
-        title_font = ImageFont.truetype("arial.ttf", 24)
-    except IOError:
-        font = ImageFont.load_default()
-        title_font = ImageFont.load_default()
+    # Positive terminal
+    draw.line([(battery_x-15, battery_top), (battery_x+15, battery_top)], fill='black', width=3)
+    draw.line([(battery_x, battery_top-10), (battery_x, battery_top+10)], fill='black', width=3)
+    
+    # Negative terminal
+    draw.line([(battery_x-15, battery_top+40), (battery_x+15, battery_top+40)], fill='black', width=3)
+
+
+@diagram_layers.layer("circuit", "resistor")
+def paint_resistor(draw, width, height):
+    # Resistor on the top
+    resistor_y = 100
+    resistor_left = 100 + 100
+    resistor_right = resistor_left + 100
+    
+    # Zigzag resistor symbol
+    points = []
+    x = resistor_left
+    zigzag_height = 15
+    while x < resistor_right:
+        y_offset = zigzag_height if (x - resistor_left) % 20 < 10 else -zigzag_height
+        points.append((x, resistor_y + y_offset))
+        x += 10
+    
+    # Connect points with lines
+    last_point = (resistor_left, resistor_y)
+    for point in points:
+        draw.line([last_point, point], fill='black', width=3)
+        last_point = point
+    draw.line([last_point, (resistor_right, resistor_y)], fill='black', width=3)
+
+
+@diagram_layers.layer("circuit", "lamp")
+def paint_lamp(draw, width, height):
+    # Bulb on the right side
+    bulb_x = width - 100
+    bulb_y = height - 100 - 80
+    
+    # Circle for bulb
+    draw.ellipse([(bulb_x-25, bulb_y-25), (bulb_x+25, bulb_y+25)], outline='black', width=3)
+    
+    # Filament
+    draw.line([(bulb_x-15, bulb_y), (bulb_x+15, bulb_y)], fill='black', width=2)
+    
+    # X cross inside to represent filament
+    draw.line([(bulb_x-15, bulb_y-15), (bulb_x+15, bulb_y+15)], fill='black', width=2)
+    draw.line([(bulb_x-15, bulb_y+15), (bulb_x+15, bulb_y-15)], fill='black', width=2)
+
+
+@diagram_layers.layer("circuit", "switch")
+def paint_switch(draw, width, height):
+    # Switch on the bottom
+    switch_y = height - 100
+    switch_left = 100 + 150
+    switch_right = switch_left + 80
+    
+    # Switch symbol
+    draw.line([(switch_left, switch_y), (switch_left+20, switch_y)], fill='black', width=3)
+    draw.line([(switch_right-20, switch_y), (switch_right, switch_y)], fill='black', width=3)
     
-    # Draw a border
-    draw.rectangle([(10, 10), (width-10, height-10)], outline='black', width=2)
+    # Switch lever (open position)
+    draw.line([(switch_left+20, switch_y), (switch_right-30, switch_y-30)], fill='black', width=3)
+
+
+@DIAGRAMS.register("circuit", keywords=("circuit",), priority=40,
+                   features=("battery", "cell", "resistor", "bulb", "lamp", "switch"),
+                   spec_types=("circuit",))
+@profiled("diagram:circuit")
+def generate_circuit_diagram(description, index, width=600, height=400, seed=None, spec=None):
+    """Create a simple circuit diagram based on the description"""
+    # Start from the pre-rendered border and circuit loop
+    img, draw = diagram_layers.canvas("circuit", None, width, height)
+    font, title_font, _ = diagram_layers.fonts()
     
     # Add a title
     draw.text((width//2-120, 20), f"Circuit Diagram {index}", fill='black', font=title_font)
     
-    # Draw a simple circuit based on description
-    desc_lower = description.lower()
-    
-    # Base coordinates for the circuit
+    # Add the components named in the description (pre-rendered) and their labels
+    found = set(spec["components"]) if spec is not None else DIAGRAMS.found(description)
     left_x = 100
     right_x = width - 100
     top_y = 100
     bottom_y = height - 100
     
-    # Draw the basic circuit loop
-    draw.line([(left_x, top_y), (right_x, top_y)], fill='black', width=3)
-    draw.line([(right_x, top_y), (right_x, bottom_y)], fill='black', width=3)
-    draw.line([(right_x, bottom_y), (left_x, bottom_y)], fill='black', width=3)
-    draw.line([(left_x, bottom_y), (left_x, top_y)], fill='black', width=3)
+    if "battery" in found or "cell" in found:
+        diagram_layers.overlay(img, "circuit", "battery")
+        draw.text((left_x-30, top_y+50+20), "Battery", fill='black', font=font)
     
-    # Add battery symbol
-    if "battery" in desc_lower or "cell" in desc_lower:
-        # Draw battery on the left side
-        battery_x = left_x
-        battery_top = top_y + 50
-        battery_bottom = battery_top + 80
-        
-        # Positive terminal
-        draw.line([(battery_x-15, battery_top), (battery_x+15, battery_top)], fill='black', width=3)
-        draw.line([(battery_x, battery_top-10), (battery_x, battery_top+10)], fill='black', width=3)
-        
-        # Negative terminal
-        draw.line([(battery_x-15, battery_top+40), (battery_x+15, battery_top+40)], fill='black', width=3)
-        
-        # Label
-        draw.text((battery_x-30, battery_top+20), "Battery", fill='black', font=font)
-    
-    # Add resistor symbol
-    if "resistor" in desc_lower:
-        # Draw resistor on the top
-        resistor_y = top_y
-        resistor_left = left_x + 100
-        resistor_right = resistor_left + 100
-        
-        # Zigzag resistor symbol
-        points = []
-        x = resistor_left
-        zigzag_height = 15
-        while x < resistor_right:
-            y_offset = zigzag_height if (x - resistor_left) % 20 < 10 else -zigzag_height
-            points.append((x, resistor_y + y_offset))
-            x += 10
-        
-        # Connect points with lines
-        last_point = (resistor_left, resistor_y)
-        for point in points:
-            draw.line([last_point, point], fill='black', width=3)
-            last_point = point
-        draw.line([last_point, (resistor_right, resistor_y)], fill='black', width=3)
-        
-        # Label
-        draw.text((resistor_left+30, resistor_y-40), "Resistor", fill='black', font=font)
+    if "resistor" in found:
+        diagram_layers.overlay(img, "circuit", "resistor")
+        draw.text((left_x+100+30, top_y-40), "Resistor", fill='black', font=font)
     
-    # Add bulb/lamp symbol
-    if "bulb" in desc_lower or "lamp" in desc_lower:
-        # Draw bulb on the right side
-        bulb_x = right_x
-        bulb_y = bottom_y - 80
-        
-        # Circle for bulb
-        draw.ellipse([(bulb_x-25, bulb_y-25), (bulb_x+25, bulb_y+25)], outline='black', width=3)
-        
-        # Filament
-        draw.line([(bulb_x-15, bulb_y), (bulb_x+15, bulb_y)], fill='black', width=2)
-        
-        # X cross inside to represent filament
-        draw.line([(bulb_x-15, bulb_y-15), (bulb_x+15, bulb_y+15)], fill='black', width=2)
-        draw.line([(bulb_x-15, bulb_y+15), (bulb_x+15, bulb_y-15)], fill='black', width=2)
-        
-        # Label
-        draw.text((bulb_x+30, bulb_y), "Lamp", fill='black', font=font)
+    if "bulb" in found or "lamp" in found:
+        diagram_layers.overlay(img, "circuit", "lamp")
+        draw.text((right_x+30, bottom_y-80), "Lamp", fill='black', font=font)
     
-    # Add switch symbol
-    if "switch" in desc_lower:
-        # Draw switch on the bottom
-        switch_y = bottom_y
-        switch_left = left_x + 150
-        switch_right = switch_left + 80
-        
-        # Switch symbol
-        draw.line([(switch_left, switch_y), (switch_left+20, switch_y)], fill='black', width=3)
-        draw.line([(switch_right-20, switch_y), (switch_right, switch_y)], fill='black', width=3)
-        
-        # Switch lever (open position)
-        draw.line([(switch_left+20, switch_y), (switch_right-30, switch_y-30)], fill='black', width=3)
-        
-        # Label
-        draw.text((switch_left+20, switch_y+10), "Switch", fill='black', font=font)
+    if "switch" in found:
+        diagram_layers.overlay(img, "circuit", "switch")
+        draw.text((left_x+150+20, bottom_y+10), "Switch", fill='black', font=font)
     
     # Save to BytesIO
     buf = io.BytesIO()
@@ -473,32 +565,39 @@ def generate_circuit_diagram(description, index, width=600, height=400):
     return buf
 
 
-def generate_geometric_diagram(description, index, width=600, height=400):
+@DIAGRAMS.register("geometric", keywords=("triangle", "square", "circle", "angle"), priority=30,
+                   features=("equilateral", "isosceles", "right", "rectangle", "30", "45", "60", "90", "120"),
+                   spec_types=("triangle", "angle", "circle", "square", "rectangle"))
+@profiled("diagram:geometric")
+def generate_geometric_diagram(description, index, width=600, height=400, seed=None, spec=None):
     """Create a geometric diagram based on the description"""
     # Create a figure
     fig, ax = plt.subplots(figsize=(width/100, height/100), dpi=100)
     
-    # Determine the type of geometric shape from the description
-    desc_lower = description.lower()
+    # Determine the type of geometric shape from the spec or the description
+    if spec is not None:
+        found = {spec["type"], spec.get("kind")}
+    else:
+        found = DIAGRAMS.found(description)
     
     # Set plot limits
     ax.set_xlim(0, 10)
     ax.set_ylim(0, 10)
     
     # Triangle
-    if "triangle" in desc_lower:
+    if "triangle" in found:
         # Check for specific triangle types
-        if "equilateral" in desc_lower:
+        if "equilateral" in found:
             # Equilateral triangle
             x = [5, 3, 7]
             y = [8, 4, 4]
             triangle_type = "Equilateral Triangle"
-        elif "isosceles" in desc_lower:
+        elif "isosceles" in found:
             # Isosceles triangle
             x = [5, 3, 7]
             y = [8, 4, 4]
             triangle_type = "Isosceles Triangle"
-        elif "right" in desc_lower:
+        elif "right" in found:
             # Right-angled triangle
             x = [2, 2, 7]
             y = [2, 7, 2]
@@ -526,8 +625,8 @@ def generate_geometric_diagram(description, index, width=600, height=400):
         ax.set_title(f'Diagram {index}: {triangle_type}')
     
     # Square or Rectangle
-    elif "square" in desc_lower or "rectangle" in desc_lower:
-        if "square" in desc_lower:
+    elif "square" in found or "rectangle" in found:
+        if "square" in found:
             # Square
             x = [2, 2, 7, 7, 2]
             y = [2, 7, 7, 2, 2]
@@ -552,7 +651,7 @@ def generate_geometric_diagram(description, index, width=600, height=400):
         ax.set_title(f'Diagram {index}: {shape_type}')
     
     # Circle
-    elif "circle" in desc_lower:
+    elif "circle" in found:
         # Draw a circle
         circle = plt.Circle((5, 5), 3, fill=False, linewidth=2)
         ax.add_artist(circle)
@@ -569,20 +668,22 @@ def generate_geometric_diagram(description, index, width=600, height=400):
         ax.set_title(f'Diagram {index}: Circle')
     
     # Angle
-    elif "angle" in desc_lower:
+    elif "angle" in found:
         # Draw angle lines
         ax.plot([5, 9], [5, 5], 'k-', linewidth=2)  # Horizontal line
         
-        # Determine angle from description
-        if "30" in desc_lower:
+        # Determine angle from the spec or the description
+        if spec is not None:
+            angle_deg = spec["degrees"]
+        elif "30" in found:
             angle_deg = 30
-        elif "45" in desc_lower:
+        elif "45" in found:
             angle_deg = 45
-        elif "60" in desc_lower:
+        elif "60" in found:
             angle_deg = 60
-        elif "90" in desc_lower:
+        elif "90" in found:
             angle_deg = 90
-        elif "120" in desc_lower:
+        elif "120" in found:
             angle_deg = 120
         else:
             angle_deg = 45  # Default angle
@@ -629,286 +730,280 @@ def generate_geometric_diagram(description, index, width=600, height=400):
     return buf
 
 
-def generate_biology_diagram(description, index, width=600, height=400):
-    """Create a biology-related diagram based on the description"""
-    # Create a blank image with a white background
-    img = PILImage.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(img)
+@diagram_layers.layer("biology", "plant_cell")
+def paint_plant_cell(draw, width, height):
+    """Cell wall, membrane, nucleus and vacuole of a plant cell"""
+    _, _, small_font = diagram_layers.fonts()
+    cell_x, cell_y = width//2, height//2
+    cell_width, cell_height = 300, 200
     
-    # Try to load a font, fallback to default if not available
-    try:
-        font = ImageFont.truetype("arial.ttf", 18)
-        title_font = ImageFont.truetype("arial.ttf", 24)
-        small_font = ImageFont.truetype("arial.ttf", 14)
-    except IOError:
-        font = ImageFont.load_default()
-        title_font = ImageFont.load_default()
-        small_font = ImageFont.load_default()
+    # Cell wall (outer rectangle)
+    draw.rectangle([
+        (cell_x - cell_width//2 - 10, cell_y - cell_height//2 - 10),
+        (cell_x + cell_width//2 + 10, cell_y + cell_height//2 + 10)
+    ], outline='green', width=3)
+    
+    # Cell membrane (inner rectangle)
+    draw.rectangle([
+        (cell_x - cell_width//2, cell_y - cell_height//2),
+        (cell_x + cell_width//2, cell_y + cell_height//2)
+    ], outline='black', width=2)
+    
+    # Nucleus
+    nucleus_x, nucleus_y = cell_x - 50, cell_y
+    draw.ellipse([
+        (nucleus_x - 30, nucleus_y - 25),
+        (nucleus_x + 30, nucleus_y + 25)
+    ], outline='black', width=2)
+    draw.text((nucleus_x - 25, nucleus_y - 10), "Nucleus", fill='black', font=small_font)
+    
+    # Central vacuole
+    vac_x, vac_y = cell_x + 50, cell_y
+    draw.ellipse([
+        (vac_x - 50, vac_y - 40),
+        (vac_x + 50, vac_y + 40)
+    ], outline='blue', width=2)
+    draw.text((vac_x - 30, vac_y), "Vacuole", fill='blue', font=small_font)
+    
+    # Cell wall label
+    draw.text((cell_x - cell_width//2 - 60, cell_y), "Cell wall", fill='green', font=small_font)
+
+
+@diagram_layers.layer("biology", "animal_cell")
+def paint_animal_cell(draw, width, height):
+    """Membrane, nucleus, mitochondrion and ER of an animal cell"""
+    _, _, small_font = diagram_layers.fonts()
+    cell_x, cell_y = width//2, height//2
+    cell_radius = 150
+    
+    # Cell membrane (circle)
+    draw.ellipse([
+        (cell_x - cell_radius, cell_y - cell_radius),
+        (cell_x + cell_radius, cell_y + cell_radius)
+    ], outline='black', width=2)
+    
+    # Nucleus
+    nucleus_x, nucleus_y = cell_x - 30, cell_y
+    draw.ellipse([
+        (nucleus_x - 30, nucleus_y - 25),
+        (nucleus_x + 30, nucleus_y + 25)
+    ], outline='black', width=2)
+    draw.text((nucleus_x - 25, nucleus_y - 10), "Nucleus", fill='black', font=small_font)
+    
+    # Mitochondria (bean-shaped)
+    mito_x, mito_y = cell_x + 50, cell_y - 40
+    # Draw a bean-shaped mitochondrion
+    draw.arc([
+        (mito_x - 25, mito_y - 15),
+        (mito_x + 25, mito_y + 15)
+    ], 0, 180, fill='red', width=2)
+    draw.arc([
+        (mito_x - 25, mito_y - 5),
+        (mito_x + 25, mito_y + 25)
+    ], 180, 360, fill='red', width=2)
+    draw.text((mito_x - 15, mito_y + 25), "Mitochondrion", fill='red', font=small_font)
+    
+    # Endoplasmic Reticulum
+    er_x, er_y = cell_x - 70, cell_y + 50
+    for i in range(4):
+        draw.line([
+            (er_x - 40, er_y - 10 + i*8),
+            (er_x + 40, er_y - 10 + i*8)
+        ], fill='purple', width=2)
+    draw.text((er_x - 40, er_y + 30), "Endoplasmic Reticulum", fill='purple', font=small_font)
+
+
+@diagram_layers.layer("biology", "heart")
+def paint_heart(draw, width, height):
+    _, _, small_font = diagram_layers.fonts()
+    heart_x, heart_y = width//2, height//2
+    
+    # Heart shape
+    # Left lobe
+    draw.arc([
+        (heart_x - 100, heart_y - 100),
+        (heart_x, heart_y)
+    ], 180, 0, fill='red', width=3)
+    
+    # Right lobe
+    draw.arc([
+        (heart_x, heart_y - 100),
+        (heart_x + 100, heart_y)
+    ], 180, 0, fill='red', width=3)
+    
+    # Bottom point
+    draw.polygon([
+        (heart_x - 100, heart_y - 50),
+        (heart_x + 100, heart_y - 50),
+        (heart_x, heart_y + 100)
+    ], outline='red', width=3)
+    
+    # Label chambers
+    draw.text((heart_x - 70, heart_y - 80), "Left Atrium", fill='black', font=small_font)
+    draw.text((heart_x + 20, heart_y - 80), "Right Atrium", fill='black', font=small_font)
+    draw.text((heart_x - 70, heart_y + 20), "Left Ventricle", fill='black', font=small_font)
+    draw.text((heart_x + 20, heart_y + 20), "Right Ventricle", fill='black', font=small_font)
+    
+    # Main blood vessels
+    draw.line([(heart_x, heart_y - 120), (heart_x, heart_y - 180)], fill='blue', width=4)
+    draw.text((heart_x + 10, heart_y - 150), "Aorta", fill='blue', font=small_font)
+
+
+@diagram_layers.layer("biology", "brain")
+def paint_brain(draw, width, height):
+    _, _, small_font = diagram_layers.fonts()
+    brain_x, brain_y = width//2, height//2
+    
+    # Brain shape (simplified)
+    draw.ellipse([
+        (brain_x - 120, brain_y - 80),
+        (brain_x + 120, brain_y + 100)
+    ], outline='gray', width=3)
+    
+    # Cerebrum division
+    draw.line([
+        (brain_x, brain_y - 80),
+        (brain_x, brain_y + 50)
+    ], fill='black', width=2)
+    
+    # Cerebellum
+    draw.ellipse([
+        (brain_x - 60, brain_y + 60),
+        (brain_x + 60, brain_y + 120)
+    ], outline='gray', width=2)
+    
+    # Labels
+    draw.text((brain_x - 100, brain_y - 50), "Left Hemisphere", fill='black', font=small_font)
+    draw.text((brain_x + 10, brain_y - 50), "Right Hemisphere", fill='black', font=small_font)
+    draw.text((brain_x - 30, brain_y + 80), "Cerebellum", fill='black', font=small_font)
+    draw.text((brain_x - 70, brain_y + 20), "Frontal Lobe", fill='black', font=small_font)
+
+
+@diagram_layers.layer("biology", "organ")
+def paint_organ(draw, width, height):
+    font, _, _ = diagram_layers.fonts()
+    # Label in the center of the (randomly shaped) organ
+    draw.text((width//2 - 40, height//2), "Organ Structure", fill='black', font=font)
+
+
+@diagram_layers.layer("biology", "plant")
+def paint_plant(draw, width, height):
+    """Stem, leaves and flower of a plant (the roots vary per diagram)"""
+    _, _, small_font = diagram_layers.fonts()
+    plant_x, plant_y = width//2, height - 100
+    
+    # Stem
+    draw.line([
+        (plant_x, plant_y),
+        (plant_x, plant_y - 200)
+    ], fill='green', width=5)
+    
+    # Leaves
+    for i in range(3):
+        y_pos = plant_y - 80 - i * 60
+        # Left leaf
+        draw.ellipse([
+            (plant_x - 80, y_pos - 20),
+            (plant_x, y_pos + 20)
+        ], outline='green', width=2)
+        # Right leaf
+        draw.ellipse([
+            (plant_x, y_pos - 20),
+            (plant_x + 80, y_pos + 20)
+        ], outline='green', width=2)
+    
+    # Flower
+    flower_y = plant_y - 220
+    # Petals
+    for angle in range(0, 360, 45):
+        rad = math.radians(angle)
+        petal_x1 = plant_x + int(20 * math.cos(rad))
+        petal_y1 = flower_y + int(20 * math.sin(rad))
+        petal_x2 = plant_x + int(40 * math.cos(rad))
+        petal_y2 = flower_y + int(40 * math.sin(rad))
+        draw.ellipse([
+            (petal_x1 - 10, petal_y1 - 10),
+            (petal_x2 + 10, petal_y2 + 10)
+        ], fill='yellow', outline='orange', width=1)
     
-    # Draw a border
-    draw.rectangle([(10, 10), (width-10, height-10)], outline='black', width=2)
+    # Center of flower
+    draw.ellipse([
+        (plant_x - 15, flower_y - 15),
+        (plant_x + 15, flower_y + 15)
+    ], fill='orange', outline='orange', width=1)
+    
+    # Labels
+    draw.text((plant_x + 10, plant_y - 150), "Stem", fill='black', font=small_font)
+    draw.text((plant_x + 10, plant_y + 20), "Roots", fill='black', font=small_font)
+    draw.text((plant_x + 50, plant_y - 100), "Leaf", fill='black', font=small_font)
+    draw.text((plant_x + 10, flower_y - 40), "Flower", fill='black', font=small_font)
+
+
+@DIAGRAMS.register("biology", keywords=("cell", "organ", "plant", "animal"), priority=20,
+                   features=("heart", "brain"))
+@profiled("diagram:biology")
+def generate_biology_diagram(description, index, width=600, height=400, seed=None, spec=None):
+    """Create a biology-related diagram based on the description"""
+    font, title_font, small_font = diagram_layers.fonts()
+    rng = diagram_rng(description, seed)
     
     # Determine the type of biology diagram
-    desc_lower = description.lower()
+    found = DIAGRAMS.found(description)
     
-    # Add a title
-    if "cell" in desc_lower:
-        title = f"Cell Diagram {index}"
-        draw.text((width//2-100, 20), title, fill='black', font=title_font)
-        
-        # Determine if it's animal or plant cell
-        if "plant" in desc_lower:
-            # Draw plant cell (rectangular with cell wall)
+    # Start from the pre-rendered static parts and add the title and the
+    # parts that vary per diagram
+    if "cell" in found:
+        if "plant" in found:
+            img, draw = diagram_layers.canvas("biology", "plant_cell", width, height)
+            draw.text((width//2-100, 20), f"Cell Diagram {index}", fill='black', font=title_font)
             cell_x, cell_y = width//2, height//2
-            cell_width, cell_height = 300, 200
-            
-            # Cell wall (outer rectangle)
-            draw.rectangle([
-                (cell_x - cell_width//2 - 10, cell_y - cell_height//2 - 10),
-                (cell_x + cell_width//2 + 10, cell_y + cell_height//2 + 10)
-            ], outline='green', width=3)
-            
-            # Cell membrane (inner rectangle)
-            draw.rectangle([
-                (cell_x - cell_width//2, cell_y - cell_height//2),
-                (cell_x + cell_width//2, cell_y + cell_height//2)
-            ], outline='black', width=2)
-            
-            # Nucleus
-            nucleus_x, nucleus_y = cell_x - 50, cell_y
-            draw.ellipse([
-                (nucleus_x - 30, nucleus_y - 25),
-                (nucleus_x + 30, nucleus_y + 25)
-            ], outline='black', width=2)
-            draw.text((nucleus_x - 25, nucleus_y - 10), "Nucleus", fill='black', font=small_font)
-            
-            # Chloroplast (green ovals)
-            for i in range(5):
-                cp_x = cell_x + random.randint(-100, 100)
-                cp_y = cell_y + random.randint(-70, 70)
-                if i == 0:  # Label only one chloroplast
-                    draw.ellipse([
-                        (cp_x - 20, cp_y - 10),
-                        (cp_x + 20, cp_y + 10)
-                    ], fill='lightgreen', outline='green', width=1)
-                    draw.text((cp_x - 15, cp_y + 15), "Chloroplast", fill='green', font=small_font)
-                else:
-                    draw.ellipse([
-                        (cp_x - 20, cp_y - 10),
-                        (cp_x + 20, cp_y + 10)
-                    ], fill='lightgreen', outline='green', width=1)
-            
-            # Central vacuole
-            vac_x, vac_y = cell_x + 50, cell_y
-            draw.ellipse([
-                (vac_x - 50, vac_y - 40),
-                (vac_x + 50, vac_y + 40)
-            ], outline='blue', width=2)
-            draw.text((vac_x - 30, vac_y), "Vacuole", fill='blue', font=small_font)
-            
-            # Cell wall label
-            draw.text((cell_x - cell_width//2 - 60, cell_y), "Cell wall", fill='green', font=small_font)
             
+            # Chloroplast (green ovals), label only the first one
+            chloroplasts = np.stack([cell_x + rng.integers(-100, 101, 5),
+                                     cell_y + rng.integers(-70, 71, 5)], axis=1)
+            draw_ellipses(draw, chloroplasts, 20, 10, fill='lightgreen', outline='green')
+            cp_x, cp_y = chloroplasts[0]
+            draw.text((cp_x - 15, cp_y + 15), "Chloroplast", fill='green', font=small_font)
         else:
-            # Draw animal cell (circular)
-            cell_x, cell_y = width//2, height//2
-            cell_radius = 150
-            
-            # Cell membrane (circle)
-            draw.ellipse([
-                (cell_x - cell_radius, cell_y - cell_radius),
-                (cell_x + cell_radius, cell_y + cell_radius)
-            ], outline='black', width=2)
-            
-            # Nucleus
-            nucleus_x, nucleus_y = cell_x - 30, cell_y
-            draw.ellipse([
-                (nucleus_x - 30, nucleus_y - 25),
-                (nucleus_x + 30, nucleus_y + 25)
-            ], outline='black', width=2)
-            draw.text((nucleus_x - 25, nucleus_y - 10), "Nucleus", fill='black', font=small_font)
-            
-            # Mitochondria (bean-shaped)
-            mito_x, mito_y = cell_x + 50, cell_y - 40
-            # Draw a bean-shaped mitochondrion
-            draw.arc([
-                (mito_x - 25, mito_y - 15),
-                (mito_x + 25, mito_y + 15)
-            ], 0, 180, fill='red', width=2)
-            draw.arc([
-                (mito_x - 25, mito_y - 5),
-                (mito_x + 25, mito_y + 25)
-            ], 180, 360, fill='red', width=2)
-            draw.text((mito_x - 15, mito_y + 25), "Mitochondrion", fill='red', font=small_font)
-            
-            # Endoplasmic Reticulum
-            er_x, er_y = cell_x - 70, cell_y + 50
-            for i in range(4):
-                draw.line([
-                    (er_x - 40, er_y - 10 + i*8),
-                    (er_x + 40, er_y - 10 + i*8)
-                ], fill='purple', width=2)
-            draw.text((er_x - 40, er_y + 30), "Endoplasmic Reticulum", fill='purple', font=small_font)
-            
-    elif "organ" in desc_lower:
-        if "heart" in desc_lower:
-            title = f"Heart Diagram {index}"
-            draw.text((width//2-100, 20), title, fill='black', font=title_font)
-            
-            # Draw heart outline (simplified)
-            heart_x, heart_y = width//2, height//2
-            
-            # Heart shape
-            # Left lobe
-            draw.arc([
-                (heart_x - 100, heart_y - 100),
-                (heart_x, heart_y)
-            ], 180, 0, fill='red', width=3)
-            
-            # Right lobe
-            draw.arc([
-                (heart_x, heart_y - 100),
-                (heart_x + 100, heart_y)
-            ], 180, 0, fill='red', width=3)
-            
-            # Bottom point
-            draw.polygon([
-                (heart_x - 100, heart_y - 50),
-                (heart_x + 100, heart_y - 50),
-                (heart_x, heart_y + 100)
-            ], outline='red', width=3)
-            
-            # Label chambers
-            draw.text((heart_x - 70, heart_y - 80), "Left Atrium", fill='black', font=small_font)
-            draw.text((heart_x + 20, heart_y - 80), "Right Atrium", fill='black', font=small_font)
-            draw.text((heart_x - 70, heart_y + 20), "Left Ventricle", fill='black', font=small_font)
-            draw.text((heart_x + 20, heart_y + 20), "Right Ventricle", fill='black', font=small_font)
+            img, draw = diagram_layers.canvas("biology", "animal_cell", width, height)
+            draw.text((width//2-100, 20), f"Cell Diagram {index}", fill='black', font=title_font)
             
-            # Main blood vessels
-            draw.line([(heart_x, heart_y - 120), (heart_x, heart_y - 180)], fill='blue', width=4)
-            draw.text((heart_x + 10, heart_y - 150), "Aorta", fill='blue', font=small_font)
+    elif "organ" in found:
+        if "heart" in found:
+            img, draw = diagram_layers.canvas("biology", "heart", width, height)
+            draw.text((width//2-100, 20), f"Heart Diagram {index}", fill='black', font=title_font)
             
-        elif "brain" in desc_lower:
-            title = f"Brain Diagram {index}"
-            draw.text((width//2-100, 20), title, fill='black', font=title_font)
-            
-            # Draw brain outline
-            brain_x, brain_y = width//2, height//2
-            
-            # Brain shape (simplified)
-            draw.ellipse([
-                (brain_x - 120, brain_y - 80),
-                (brain_x + 120, brain_y + 100)
-            ], outline='gray', width=3)
-            
-            # Cerebrum division
-            draw.line([
-                (brain_x, brain_y - 80),
-                (brain_x, brain_y + 50)
-            ], fill='black', width=2)
-            
-            # Cerebellum
-            draw.ellipse([
-                (brain_x - 60, brain_y + 60),
-                (brain_x + 60, brain_y + 120)
-            ], outline='gray', width=2)
-            
-            # Labels
-            draw.text((brain_x - 100, brain_y - 50), "Left Hemisphere", fill='black', font=small_font)
-            draw.text((brain_x + 10, brain_y - 50), "Right Hemisphere", fill='black', font=small_font)
-            draw.text((brain_x - 30, brain_y + 80), "Cerebellum", fill='black', font=small_font)
-            draw.text((brain_x - 70, brain_y + 20), "Frontal Lobe", fill='black', font=small_font)
+        elif "brain" in found:
+            img, draw = diagram_layers.canvas("biology", "brain", width, height)
+            draw.text((width//2-100, 20), f"Brain Diagram {index}", fill='black', font=title_font)
             
         else:
             # Generic organ
-            title = f"Organ Diagram {index}"
-            draw.text((width//2-100, 20), title, fill='black', font=title_font)
-            
-            # Draw generic blob shape
-            organ_x, organ_y = width//2, height//2
+            img, draw = diagram_layers.canvas("biology", "organ", width, height)
+            draw.text((width//2-100, 20), f"Organ Diagram {index}", fill='black', font=title_font)
             
-            # Blob shape
-            points = []
-            for angle in range(0, 360, 20):
-                rad = math.radians(angle)
-                radius = 100 + random.randint(-20, 20)
-                x = organ_x + int(radius * math.cos(rad))
-                y = organ_y + int(radius * math.sin(rad))
-                points.append((x, y))
+            # Blob shape: 18 points at jittered radii, joined as one closed polyline
+            radii = 100 + rng.integers(-20, 21, 18)
+            points = ring_points(width//2, height//2, radii, 18)
+            draw.line([tuple(p) for p in points] + [tuple(points[0])], fill='brown', width=3)
             
-            # Connect the points
-            for i in range(len(points) - 1):
-                draw.line([points[i], points[i+1]], fill='brown', width=3)
-            draw.line([points[-1], points[0]], fill='brown', width=3)
-            
-            # Add a label in the center
-            draw.text((organ_x - 40, organ_y), "Organ Structure", fill='black', font=font)
-            
-    elif "plant" in desc_lower:
-        title = f"Plant Diagram {index}"
-        draw.text((width//2-100, 20), title, fill='black', font=title_font)
-        
-        # Draw a simple plant
+    elif "plant" in found:
+        img, draw = diagram_layers.canvas("biology", "plant", width, height)
+        draw.text((width//2-100, 20), f"Plant Diagram {index}", fill='black', font=title_font)
         plant_x, plant_y = width//2, height - 100
         
-        # Stem
-        draw.line([
-            (plant_x, plant_y),
-            (plant_x, plant_y - 200)
-        ], fill='green', width=5)
-        
-        # Roots
-        for i in range(5):
-            angle = 30 + i * 30
-            length = 30 + random.randint(0, 30)
-            end_x = plant_x + int(length * math.cos(math.radians(angle)))
-            end_y = plant_y + int(length * math.sin(math.radians(angle)))
+        # Roots, fanning out from the base of the stem
+        angles = np.radians(30 + np.arange(5) * 30)
+        lengths = 30 + rng.integers(0, 31, 5)
+        ends_x = plant_x + (lengths * np.cos(angles)).astype(int)
+        ends_y = plant_y + (lengths * np.sin(angles)).astype(int)
+        for end_x, end_y in zip(ends_x.tolist(), ends_y.tolist()):
             draw.line([(plant_x, plant_y), (end_x, end_y)], fill='brown', width=2)
-        
-        # Leaves
-        for i in range(3):
-            y_pos = plant_y - 80 - i * 60
-            # Left leaf
-            draw.ellipse([
-                (plant_x - 80, y_pos - 20),
-                (plant_x, y_pos + 20)
-            ], outline='green', width=2)
-            # Right leaf
-            draw.ellipse([
-                (plant_x, y_pos - 20),
-                (plant_x + 80, y_pos + 20)
-            ], outline='green', width=2)
-        
-        # Flower
-        flower_y = plant_y - 220
-        # Petals
-        for angle in range(0, 360, 45):
-            rad = math.radians(angle)
-            petal_x1 = plant_x + int(20 * math.cos(rad))
-            petal_y1 = flower_y + int(20 * math.sin(rad))
-            petal_x2 = plant_x + int(40 * math.cos(rad))
-            petal_y2 = flower_y + int(40 * math.sin(rad))
-            draw.ellipse([
-                (petal_x1 - 10, petal_y1 - 10),
-                (petal_x2 + 10, petal_y2 + 10)
-            ], fill='yellow', outline='orange', width=1)
-        
-        # Center of flower
-        draw.ellipse([
-            (plant_x - 15, flower_y - 15),
-            (plant_x + 15, flower_y + 15)
-        ], fill='orange', outline='orange', width=1)
-        
-        # Labels
-        draw.text((plant_x + 10, plant_y - 150), "Stem", fill='black', font=small_font)
-        draw.text((plant_x + 10, plant_y + 20), "Roots", fill='black', font=small_font)
-        draw.text((plant_x + 50, plant_y - 100), "Leaf", fill='black', font=small_font)
-        draw.text((plant_x + 10, flower_y - 40), "Flower", fill='black', font=small_font)
     
     else:
         # Generic biology diagram
-        title = f"Biology Diagram {index}"
-        draw.text((width//2-100, 20), title, fill='black', font=title_font)
+        img, draw = diagram_layers.canvas("biology", None, width, height)
+        draw.text((width//2-100, 20), f"Biology Diagram {index}", fill='black', font=title_font)
         draw.text((width//2-150, height//2), description, fill='black', font=font)
     
     # Save to BytesIO
@@ -918,121 +1013,335 @@ def generate_biology_diagram(description, index, width=600, height=400):
     return buf
 
 
-def generate_chemistry_diagram(description, index, width=600, height=400):
-    """Create a chemistry-related diagram based on the description"""
-    # Create a blank image with a white background
-    img = PILImage.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(img)
+# Electrons per shell (simplified Bohr model) of the elements atom diagrams
+# recognise in descriptions
+ELECTRON_CONFIGS = {
+    "Hydrogen": [1],
+    "Helium": [2],
+    "Lithium": [2, 1],
+    "Beryllium": [2, 2],
+    "Boron": [2, 3],
+    "Carbon": [2, 4],
+    "Nitrogen": [2, 5],
+    "Oxygen": [2, 6],
+    "Fluorine": [2, 7],
+    "Neon": [2, 8],
+    "Sodium": [2, 8, 1],
+    "Magnesium": [2, 8, 2],
+    "Aluminium": [2, 8, 3],
+    "Silicon": [2, 8, 4],
+    "Phosphorus": [2, 8, 5],
+    "Sulfur": [2, 8, 6],
+    "Chlorine": [2, 8, 7],
+    "Argon": [2, 8, 8],
+    "Potassium": [2, 8, 8, 1],
+    "Calcium": [2, 8, 8, 2],
+    "Bromine": [2, 8, 18, 7],
+    "Krypton": [2, 8, 18, 8],
+    "Iodine": [2, 8, 18, 18, 7],
+    "Xenon": [2, 8, 18, 18, 8],
+    "Caesium": [2, 8, 18, 18, 8, 1],
+    "Gold": [2, 8, 18, 32, 18, 1],
+    "Radon": [2, 8, 18, 32, 18, 8],
+    "Uranium": [2, 8, 18, 32, 21, 9, 2],
+}
+
+
+@diagram_layers.layer("chemistry", "atom")
+def paint_atom(draw, width, height, shell_radii):
+    """Nucleus and electron shell orbits of a Bohr model"""
+    atom_x, atom_y = width//2, height//2
     
-    # Try to load a font, fallback to default if not available
-    try:
-        font = ImageFont.truetype("arial.ttf", 18)
-        title_font = ImageFont.truetype("arial.ttf", 24)
-        small_font = ImageFont.truetype("arial.ttf", 14)
-    except IOError:
-        font = ImageFont.load_default()
-        title_font = ImageFont.load_default()
-        small_font = ImageFont.load_default()
+    # Nucleus
+    nucleus_radius = 25
+    draw.ellipse([
+        (atom_x - nucleus_radius, atom_y - nucleus_radius),
+        (atom_x + nucleus_radius, atom_y + nucleus_radius)
+    ], fill='red', outline='black', width=2)
+    
+    for shell_radius in shell_radii:
+        # Draw the shell orbit
+        draw.ellipse([
+            (atom_x - shell_radius, atom_y - shell_radius),
+            (atom_x + shell_radius, atom_y + shell_radius)
+        ], outline='blue', width=2)
+
+
+@diagram_layers.layer("chemistry", "molecule")
+def paint_molecule(draw, width, height, shape):
+    """Ball-and-stick drawing of a water, carbon dioxide or generic molecule"""
+    font, _, _ = diagram_layers.fonts()
+    mol_x, mol_y = width//2, height//2
     
-    # Draw a border
-    draw.rectangle([(10, 10), (width-10, height-10)], outline='black', width=2)
+    if shape == "water":
+        # Draw water molecule (H2O)
+        # Oxygen atom
+        draw.ellipse([
+            (mol_x - 25, mol_y - 25),
+            (mol_x + 25, mol_y + 25)
+        ], fill='red', outline='black', width=2)
+        draw.text((mol_x - 10, mol_y - 10), "O", fill='white', font=font)
+
+        # Hydrogen atoms
+        h1_x, h1_y = mol_x - 60, mol_y - 20
+        draw.ellipse([
+            (h1_x - 15, h1_y - 15),
+            (h1_x + 15, h1_y + 15)
+        ], fill='lightblue', outline='black', width=2)
+        draw.text((h1_x - 5, h1_y - 5), "H", fill='black', font=font)
+
+        h2_x, h2_y = mol_x - 60, mol_y + 20
+        draw.ellipse([
+            (h2_x - 15, h2_y - 15),
+            (h2_x + 15, h2_y + 15)
+        ], fill='lightblue', outline='black', width=2)
+        draw.text((h2_x - 5, h2_y - 5), "H", fill='black', font=font)
+
+        # Bonds
+        draw.line([(mol_x - 25, mol_y - 10), (h1_x + 15, h1_y)], fill='black', width=2)
+        draw.line([(mol_x - 25, mol_y + 10), (h2_x + 15, h2_y)], fill='black', width=2)
+        
+    elif shape == "carbon_dioxide":
+        # Draw CO2
+        # Carbon atom
+        draw.ellipse([
+            (mol_x - 20, mol_y - 20),
+            (mol_x + 20, mol_y + 20)
+        ], fill='gray', outline='black', width=2)
+        draw.text((mol_x - 5, mol_y - 5), "C", fill='white', font=font)
+
+        # Oxygen atoms
+        o1_x, o1_y = mol_x - 70, mol_y
+        draw.ellipse([
+            (o1_x - 20, o1_y - 20),
+            (o1_x + 20, o1_y + 20)
+        ], fill='red', outline='black', width=2)
+        draw.text((o1_x - 5, o1_y - 5), "O", fill='white', font=font)
+
+        o2_x, o2_y = mol_x + 70, mol_y
+        draw.ellipse([
+            (o2_x - 20, o2_y - 20),
+            (o2_x + 20, o2_y + 20)
+        ], fill='red', outline='black', width=2)
+        draw.text((o2_x - 5, o2_y - 5), "O", fill='white', font=font)
+
+        # Double bonds
+        draw.line([(mol_x - 20, mol_y - 5), (o1_x + 20, o1_y - 5)], fill='black', width=2)
+        draw.line([(mol_x - 20, mol_y + 5), (o1_x + 20, o1_y + 5)], fill='black', width=2)
+
+        draw.line([(mol_x + 20, mol_y - 5), (o2_x - 20, o2_y - 5)], fill='black', width=2)
+        draw.line([(mol_x + 20, mol_y + 5), (o2_x - 20, o2_y + 5)], fill='black', width=2)
+        
+    else:
+        # Generic molecule representation
+        # Central atom
+        draw.ellipse([
+            (mol_x - 30, mol_y - 30),
+            (mol_x + 30, mol_y + 30)
+        ], fill='gray', outline='black', width=2)
+
+        # Surrounding atoms in a tetrahedral arrangement
+        surrounding_positions = [
+            (mol_x, mol_y - 80),  # top
+            (mol_x - 70, mol_y + 40),  # bottom left
+            (mol_x + 70, mol_y + 40),  # bottom right
+            (mol_x, mol_y + 80)   # closer to viewer
+        ]
+
+        for i, pos in enumerate(surrounding_positions):
+            s_x, s_y = pos
+            # Different colors for different atoms
+            if i % 3 == 0:
+                color = 'red'  # oxygen
+                label = "O"
+            elif i % 3 == 1:
+                color = 'blue'  # nitrogen
+                label = "N"
+            else:
+                color = 'lightblue'  # hydrogen
+                label = "H"
+
+            draw.ellipse([
+                (s_x - 20, s_y - 20),
+                (s_x + 20, s_y + 20)
+            ], fill=color, outline='black', width=2)
+            draw.text((s_x - 5, s_y - 5), label, fill='white', font=font)
+
+            # Bond
+            draw.line([(mol_x, mol_y), (s_x, s_y)], fill='black', width=2)
+
+
+@diagram_layers.layer("chemistry", "reaction")
+def paint_reaction(draw, width, height, reaction_type):
+    """Equation, arrow and conditions of a reaction diagram"""
+    font, title_font, _ = diagram_layers.fonts()
+    
+    if reaction_type == "combustion":
+        # Methane combustion: CH4 + 2O2 → CO2 + 2H2O
+        # Reactants
+        draw.text((100, 150), "CH₄", fill='black', font=title_font)
+        draw.text((200, 150), "+", fill='black', font=title_font)
+        draw.text((250, 150), "2O₂", fill='black', font=title_font)
+
+        # Arrow
+        draw.line([(350, 150), (450, 150)], fill='black', width=3)
+        draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
+
+        # Products
+        draw.text((470, 150), "CO₂", fill='black', font=title_font)
+        draw.text((550, 150), "+", fill='black', font=title_font)
+        draw.text((600, 150), "2H₂O", fill='black', font=title_font)
+
+        # Add heat
+        draw.text((380, 120), "heat", fill='red', font=font)
+
+        # Add flames
+        for i in range(5):
+            x = 380 + i * 10
+            draw.line([(x, 180), (x, 200)], fill='red', width=2)
+            draw.line([(x, 180), (x-5, 170)], fill='orange', width=2)
+            draw.line([(x, 180), (x+5, 170)], fill='orange', width=2)
+            
+    elif reaction_type == "acid_base":
+        # HCl + NaOH → NaCl + H2O
+        # Reactants
+        draw.text((100, 150), "HCl", fill='red', font=title_font)
+        draw.text((180, 150), "+", fill='black', font=title_font)
+        draw.text((220, 150), "NaOH", fill='blue', font=title_font)
+
+        # Arrow
+        draw.line([(350, 150), (450, 150)], fill='black', width=3)
+        draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
+
+        # Products
+        draw.text((470, 150), "NaCl", fill='black', font=title_font)
+        draw.text((550, 150), "+", fill='black', font=title_font)
+        draw.text((600, 150), "H₂O", fill='black', font=title_font)
+        
+    elif reaction_type == "precipitation":
+        # AgNO3 + NaCl → AgCl↓ + NaNO3
+        # Reactants
+        draw.text((100, 150), "AgNO₃", fill='black', font=title_font)
+        draw.text((200, 150), "+", fill='black', font=title_font)
+        draw.text((250, 150), "NaCl", fill='black', font=title_font)
+
+        # Arrow
+        draw.line([(350, 150), (450, 150)], fill='black', width=3)
+        draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
+
+        # Products
+        draw.text((470, 150), "AgCl↓", fill='brown', font=title_font)
+        draw.text((550, 150), "+", fill='black', font=title_font)
+        draw.text((600, 150), "NaNO₃", fill='black', font=title_font)
+
+        # Draw precipitate
+        particles = np.arange(8)
+        draw_squares(draw, np.stack([500 + particles * 5, 220 + (particles % 3) * 10], axis=1), 3, 'brown')
+        
+    else:
+        # Generic reaction: A + B → C + D
+        # Reactants
+        draw.text((150, 150), "A", fill='blue', font=title_font)
+        draw.text((200, 150), "+", fill='black', font=title_font)
+        draw.text((250, 150), "B", fill='red', font=title_font)
+
+        # Arrow
+        draw.line([(350, 150), (450, 150)], fill='black', width=3)
+        draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
+
+        # Products
+        draw.text((500, 150), "C", fill='green', font=title_font)
+        draw.text((550, 150), "+", fill='black', font=title_font)
+        draw.text((600, 150), "D", fill='purple', font=title_font)
+        
+    # Add reaction conditions
+    draw.text((width//2 - 100, height - 50), 
+             "Reaction conditions: Standard temp & pressure", 
+             fill='black', font=font)
+
+
+# Molecules the molecule diagram recognises, with their formulas
+MOLECULES = {
+    "water": "H₂O",
+    "carbon dioxide": "CO₂",
+    "methane": "CH₄",
+    "glucose": "C₆H₁₂O₆",
+    "ammonia": "NH₃",
+    "oxygen": "O₂"
+}
+
+
+@DIAGRAMS.register("chemistry", keywords=("molecule", "atom", "compound", "reaction"), priority=10,
+                   features=("combustion", "acid", "base", "precipitation",
+                             *MOLECULES, *(e.lower() for e in ELECTRON_CONFIGS)),
+                   spec_types=("atom",))
+@profiled("diagram:chemistry")
+def generate_chemistry_diagram(description, index, width=600, height=400, seed=None, spec=None):
+    """Create a chemistry-related diagram based on the description"""
+    font, title_font, small_font = diagram_layers.fonts()
     
     # Determine the type of chemistry diagram
-    desc_lower = description.lower()
+    found = {"atom"} if spec is not None else DIAGRAMS.found(description)
     
-    # Add a title
-    if "atom" in desc_lower:
-        element = None
+    # Start from the pre-rendered static parts and add the title and the
+    # parts that vary per diagram
+    if "atom" in found:
+        element = ELEMENT_SYMBOLS[spec["element"]] if spec is not None else None
         # Try to identify the element
-        elements = [
-            "hydrogen", "helium", "lithium", "beryllium", "boron", "carbon",
-            "nitrogen", "oxygen", "fluorine", "neon", "sodium", "magnesium"
-        ]
-        for e in elements:
-            if e in desc_lower:
-                element = e.capitalize()
-                break
+        if element is None:
+            for e in ELECTRON_CONFIGS:
+                if e.lower() in found:
+                    element = e
+                    break
         
         if not element:
             element = "Carbon"  # Default element
         
-        title = f"{element} Atom Diagram {index}"
-        draw.text((width//2-120, 20), title, fill='black', font=title_font)
-        
         # Draw Bohr model
         atom_x, atom_y = width//2, height//2
         
-        # Element configurations (simplified)
-        electron_configs = {
-            "Hydrogen": [1],
-            "Helium": [2],
-            "Lithium": [2, 1],
-            "Beryllium": [2, 2],
-            "Boron": [2, 3],
-            "Carbon": [2, 4],
-            "Nitrogen": [2, 5],
-            "Oxygen": [2, 6],
-            "Fluorine": [2, 7],
-            "Neon": [2, 8],
-            "Sodium": [2, 8, 1],
-            "Magnesium": [2, 8, 2]
-        }
-        
-        config = electron_configs.get(element, [2, 4])  # Default to carbon if not found
-        
-        # Nucleus
+        config = ELECTRON_CONFIGS.get(element, [2, 4])  # Default to carbon if not found
         nucleus_radius = 25
-        draw.ellipse([
-            (atom_x - nucleus_radius, atom_y - nucleus_radius),
-            (atom_x + nucleus_radius, atom_y + nucleus_radius)
-        ], fill='red', outline='black', width=2)
         
+        # Electron shells; heavy atoms with more than three shells are packed
+        # between the nucleus and the edge of the image
+        shell_radii = [70, 120, 170]
+        if len(config) > len(shell_radii):
+            outer = min(width, height) // 2 - 60  # clear of the title and the label
+            shell_radii = np.linspace(nucleus_radius + 20, outer, len(config)).astype(int).tolist()
+        shell_radii = shell_radii[:len(config)]
+        
+        img, draw = diagram_layers.canvas("chemistry", ("atom", tuple(shell_radii)), width, height)
+        title = f"{element} Atom Diagram {index}"
+        draw.text((width//2-120, 20), title, fill='black', font=title_font)
         draw.text((atom_x - 20, atom_y - 10), element, fill='white', font=font)
         
-        # Electron shells
-        shell_radii = [70, 120, 170]
+        # Place every electron of every shell in one array op, then draw them in one batch
+        shells = np.repeat(np.arange(len(config)), config)
+        slots = np.concatenate([np.arange(n) for n in config])
+        counts = np.asarray(config)[shells]
+        radii = np.asarray(shell_radii)[shells]
+        angles = slots * (2 * np.pi / counts)
+        electrons = np.stack([atom_x + (radii * np.cos(angles)).astype(np.int64),
+                              atom_y + (radii * np.sin(angles)).astype(np.int64)], axis=1)
         
-        for i, shell_radius in enumerate(shell_radii[:len(config)]):
-            # Draw the shell orbit
-            draw.ellipse([
-                (atom_x - shell_radius, atom_y - shell_radius),
-                (atom_x + shell_radius, atom_y + shell_radius)
-            ], outline='blue', width=2)
-            
-            # Add electrons
-            electrons_in_shell = config[i]
-            for e in range(electrons_in_shell):
-                angle = (e * 360 / electrons_in_shell) * (math.pi / 180)
-                e_x = atom_x + int(shell_radius * math.cos(angle))
-                e_y = atom_y + int(shell_radius * math.sin(angle))
-                
-                # Draw electron
-                draw.ellipse([
-                    (e_x - 5, e_y - 5),
-                    (e_x + 5, e_y + 5)
-                ], fill='blue', outline='black', width=1)
+        # Smaller electrons when the shells are crowded
+        spacing = min(2 * np.pi * r / n for r, n in zip(shell_radii, config))
+        electron_radius = int(max(2, min(5, spacing // 3)))
+        draw_ellipses(draw, electrons, electron_radius, electron_radius, fill='blue', outline='black')
         
         # Label
         draw.text((width//2 - 110, height - 50), 
                  f"Electron configuration: {' - '.join(str(n) for n in config)}", 
                  fill='black', font=font)
         
-    elif "molecule" in desc_lower or "compound" in desc_lower:
+    elif "molecule" in found or "compound" in found:
         # Try to identify the molecule
-        molecules = {
-            "water": "H₂O",
-            "carbon dioxide": "CO₂",
-            "methane": "CH₄",
-            "glucose": "C₆H₁₂O₆",
-            "ammonia": "NH₃",
-            "oxygen": "O₂"
-        }
-        
         molecule_name = None
         formula = None
         
-        for name, chem_formula in molecules.items():
-            if name in desc_lower:
+        for name, chem_formula in MOLECULES.items():
+            if name in found:
                 molecule_name = name.capitalize()
                 formula = chem_formula
                 break
@@ -1041,213 +1350,38 @@ def generate_chemistry_diagram(description, index, width=600, height=400):
             molecule_name = "Water"
             formula = "H₂O"
         
+        # Draw specific molecules
+        if "water" in found:
+            shape = "water"
+        elif "carbon dioxide" in found:
+            shape = "carbon_dioxide"
+        else:
+            shape = "generic"
+        img, draw = diagram_layers.canvas("chemistry", ("molecule", shape), width, height)
+        
         title = f"{molecule_name} ({formula}) Molecule Diagram {index}"
         draw.text((width//2-150, 20), title, fill='black', font=title_font)
         
-        # Draw specific molecules
-        mol_x, mol_y = width//2, height//2
-        
-        if "water" in desc_lower or (not molecule_name and formula == "H₂O"):
-            # Draw water molecule (H2O)
-            # Oxygen atom
-            draw.ellipse([
-                (mol_x - 25, mol_y - 25),
-                (mol_x + 25, mol_y + 25)
-            ], fill='red', outline='black', width=2)
-            draw.text((mol_x - 10, mol_y - 10), "O", fill='white', font=font)
-            
-            # Hydrogen atoms
-            h1_x, h1_y = mol_x - 60, mol_y - 20
-            draw.ellipse([
-                (h1_x - 15, h1_y - 15),
-                (h1_x + 15, h1_y + 15)
-            ], fill='lightblue', outline='black', width=2)
-            draw.text((h1_x - 5, h1_y - 5), "H", fill='black', font=font)
-            
-            h2_x, h2_y = mol_x - 60, mol_y + 20
-            draw.ellipse([
-                (h2_x - 15, h2_y - 15),
-                (h2_x + 15, h2_y + 15)
-            ], fill='lightblue', outline='black', width=2)
-            draw.text((h2_x - 5, h2_y - 5), "H", fill='black', font=font)
-            
-            # Bonds
-            draw.line([(mol_x - 25, mol_y - 10), (h1_x + 15, h1_y)], fill='black', width=2)
-            draw.line([(mol_x - 25, mol_y + 10), (h2_x + 15, h2_y)], fill='black', width=2)
-            
-        elif "carbon dioxide" in desc_lower:
-            # Draw CO2
-            # Carbon atom
-            draw.ellipse([
-                (mol_x - 20, mol_y - 20),
-                (mol_x + 20, mol_y + 20)
-            ], fill='gray', outline='black', width=2)
-            draw.text((mol_x - 5, mol_y - 5), "C", fill='white', font=font)
-            
-            # Oxygen atoms
-            o1_x, o1_y = mol_x - 70, mol_y
-            draw.ellipse([
-                (o1_x - 20, o1_y - 20),
-                (o1_x + 20, o1_y + 20)
-            ], fill='red', outline='black', width=2)
-            draw.text((o1_x - 5, o1_y - 5), "O", fill='white', font=font)
-            
-            o2_x, o2_y = mol_x + 70, mol_y
-            draw.ellipse([
-                (o2_x - 20, o2_y - 20),
-                (o2_x + 20, o2_y + 20)
-            ], fill='red', outline='black', width=2)
-            draw.text((o2_x - 5, o2_y - 5), "O", fill='white', font=font)
-            
-            # Double bonds
-            draw.line([(mol_x - 20, mol_y - 5), (o1_x + 20, o1_y - 5)], fill='black', width=2)
-            draw.line([(mol_x - 20, mol_y + 5), (o1_x + 20, o1_y + 5)], fill='black', width=2)
-            
-            draw.line([(mol_x + 20, mol_y - 5), (o2_x - 20, o2_y - 5)], fill='black', width=2)
-            draw.line([(mol_x + 20, mol_y + 5), (o2_x - 20, o2_y + 5)], fill='black', width=2)
-            
-        else:
-            # Generic molecule representation
-            # Central atom
-            draw.ellipse([
-                (mol_x - 30, mol_y - 30),
-                (mol_x + 30, mol_y + 30)
-            ], fill='gray', outline='black', width=2)
-            
-            # Surrounding atoms in a tetrahedral arrangement
-            surrounding_positions = [
-                (mol_x, mol_y - 80),  # top
-                (mol_x - 70, mol_y + 40),  # bottom left
-                (mol_x + 70, mol_y + 40),  # bottom right
-                (mol_x, mol_y + 80)   # closer to viewer
-            ]
-            
-            for i, pos in enumerate(surrounding_positions):
-                s_x, s_y = pos
-                # Different colors for different atoms
-                if i % 3 == 0:
-                    color = 'red'  # oxygen
-                    label = "O"
-                elif i % 3 == 1:
-                    color = 'blue'  # nitrogen
-                    label = "N"
-                else:
-                    color = 'lightblue'  # hydrogen
-                    label = "H"
-                    
-                draw.ellipse([
-                    (s_x - 20, s_y - 20),
-                    (s_x + 20, s_y + 20)
-                ], fill=color, outline='black', width=2)
-                draw.text((s_x - 5, s_y - 5), label, fill='white', font=font)
-                
-                # Bond
-                draw.line([(mol_x, mol_y), (s_x, s_y)], fill='black', width=2)
-            
         # Add chemical formula at the bottom
         draw.text((width//2 - 50, height - 50), formula, fill='black', font=title_font)
         
-    elif "reaction" in desc_lower:
-        title = f"Chemical Reaction Diagram {index}"
-        draw.text((width//2-150, 20), title, fill='black', font=title_font)
-        
+    elif "reaction" in found:
         # Determine reaction type
         reaction_type = "generic"
-        if "combustion" in desc_lower:
+        if "combustion" in found:
             reaction_type = "combustion"
-        elif "acid" in desc_lower and "base" in desc_lower:
+        elif "acid" in found and "base" in found:
             reaction_type = "acid_base"
-        elif "precipitation" in desc_lower:
+        elif "precipitation" in found:
             reaction_type = "precipitation"
-            
-        # Draw the reaction
-        if reaction_type == "combustion":
-            # Methane combustion: CH4 + 2O2 → CO2 + 2H2O
-            # Reactants
-            draw.text((100, 150), "CH₄", fill='black', font=title_font)
-            draw.text((200, 150), "+", fill='black', font=title_font)
-            draw.text((250, 150), "2O₂", fill='black', font=title_font)
-            
-            # Arrow
-            draw.line([(350, 150), (450, 150)], fill='black', width=3)
-            draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
-            
-            # Products
-            draw.text((470, 150), "CO₂", fill='black', font=title_font)
-            draw.text((550, 150), "+", fill='black', font=title_font)
-            draw.text((600, 150), "2H₂O", fill='black', font=title_font)
-            
-            # Add heat
-            draw.text((380, 120), "heat", fill='red', font=font)
-            
-            # Add flames
-            for i in range(5):
-                x = 380 + i * 10
-                draw.line([(x, 180), (x, 200)], fill='red', width=2)
-                draw.line([(x, 180), (x-5, 170)], fill='orange', width=2)
-                draw.line([(x, 180), (x+5, 170)], fill='orange', width=2)
-                
-        elif reaction_type == "acid_base":
-            # HCl + NaOH → NaCl + H2O
-            # Reactants
-            draw.text((100, 150), "HCl", fill='red', font=title_font)
-            draw.text((180, 150), "+", fill='black', font=title_font)
-            draw.text((220, 150), "NaOH", fill='blue', font=title_font)
-            
-            # Arrow
-            draw.line([(350, 150), (450, 150)], fill='black', width=3)
-            draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
-            
-            # Products
-            draw.text((470, 150), "NaCl", fill='black', font=title_font)
-            draw.text((550, 150), "+", fill='black', font=title_font)
-            draw.text((600, 150), "H₂O", fill='black', font=title_font)
-            
-        elif reaction_type == "precipitation":
-            # AgNO3 + NaCl → AgCl↓ + NaNO3
-            # Reactants
-            draw.text((100, 150), "AgNO₃", fill='black', font=title_font)
-            draw.text((200, 150), "+", fill='black', font=title_font)
-            draw.text((250, 150), "NaCl", fill='black', font=title_font)
-            
-            # Arrow
-            draw.line([(350, 150), (450, 150)], fill='black', width=3)
-            draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
-            
-            # Products
-            draw.text((470, 150), "AgCl↓", fill='brown', font=title_font)
-            draw.text((550, 150), "+", fill='black', font=title_font)
-            draw.text((600, 150), "NaNO₃", fill='black', font=title_font)
-            
-            # Draw precipitate
-            for i in range(8):
-                x = 500 + i * 5
-                y = 220 + (i % 3) * 10
-                draw.rectangle([(x-3, y-3), (x+3, y+3)], fill='brown')
-                
-        else:
-            # Generic reaction: A + B → C + D
-            # Reactants
-            draw.text((150, 150), "A", fill='blue', font=title_font)
-            draw.text((200, 150), "+", fill='black', font=title_font)
-            draw.text((250, 150), "B", fill='red', font=title_font)
-            
-            # Arrow
-            draw.line([(350, 150), (450, 150)], fill='black', width=3)
-            draw.polygon([(440, 140), (450, 150), (440, 160)], fill='black')
-            
-            # Products
-            draw.text((500, 150), "C", fill='green', font=title_font)
-            draw.text((550, 150), "+", fill='black', font=title_font)
-            draw.text((600, 150), "D", fill='purple', font=title_font)
-            
-        # Add reaction conditions
-        draw.text((width//2 - 100, height - 50), 
-                 "Reaction conditions: Standard temp & pressure", 
-                 fill='black', font=font)
+        img, draw = diagram_layers.canvas("chemistry", ("reaction", reaction_type), width, height)
+        
+        title = f"Chemical Reaction Diagram {index}"
+        draw.text((width//2-150, 20), title, fill='black', font=title_font)
         
     else:
         # Generic chemistry diagram
+        img, draw = diagram_layers.canvas("chemistry", None, width, height)
         title = f"Chemistry Diagram {index}"
         draw.text((width//2-100, 20), title, fill='black', font=title_font)
         draw.text((width//2-150, height//2), description, fill='black', font=font)
@@ -1259,7 +1393,25 @@ def generate_chemistry_diagram(description, index, width=600, height=400):
     return buf
 
 
+def diagram_png(diagram):
+    """PNG bytes of a rendered diagram (bytes, or a BytesIO from older callers)"""
+    return diagram if isinstance(diagram, bytes) else diagram.getvalue()
+
+
+class DiagramImage(Image):
+    """
+    A platypus Image drawing a shared ImageReader, so a diagram used several
+    times in a document is decoded once
+    """
+    
+    def __init__(self, reader, width=None, height=None):
+        # Image only builds its own reader when it has none yet
+        self._img = reader
+        super().__init__(reader.fp, width, height)
+
+
 # Function to create PDF of generated questions
+@profiled("pdf")
 def create_pdf(questions):
     """
     Create a PDF document containing the generated questions
@@ -1268,7 +1420,7 @@ def create_pdf(questions):
     buffer = io.BytesIO()
     
     # Create the PDF document
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    doc = SimpleDocTemplate(buffer, pagesize=letter, invariant=True)
     
     # Define styles
     styles = getSampleStyleSheet()
@@ -1310,6 +1462,8 @@ def create_pdf(questions):
     
     # List to hold content elements
     content = []
+    # One decoded image per unique diagram
+    readers = {}
     
     # Add title
     title_text = "Generated Exam Questions"
@@ -1354,10 +1508,10 @@ def create_pdf(questions):
         if 'diagrams' in q and q['diagrams']:
             content.append(Spacer(1, 10))
             for j, diagram_data in enumerate(q['diagrams'], 1):
-                img_io = diagram_data
-                # Convert BytesIO to ReportLab Image
-                img = Image(img_io, width=300, height=200)
-                content.append(img)
+                png = diagram_png(diagram_data)
+                if png not in readers:
+                    readers[png] = ImageReader(io.BytesIO(png))
+                content.append(DiagramImage(readers[png], width=300, height=200))
                 content.append(Paragraph(f"Diagram {j}", normal_style))
                 content.append(Spacer(1, 10))
         
@@ -1378,146 +1532,1359 @@ def create_pdf(questions):
     return buffer
 
 
-# Function to call Groq API to generate questions
-def generate_questions_with_groq(subject, level, topics, num_questions, difficulty, question_type, model):
+def extract_json_block(generated_text):
     """
-    Generate questions using the Groq LLM API
+    Find the JSON part of a model response: a ```json fenced block, else
+    anything that looks like a JSON array, else the raw text.
+    """
+    json_match = re.search(r'```json\s*([\s\S]*?)\s*```', generated_text)
+    if json_match:
+        return json_match.group(1)
+    
+    # If not found in code blocks, try to extract anything that looks like JSON array
+    json_match = re.search(r'\[\s*{[\s\S]*}\s*\]', generated_text)
+    if json_match:
+        return json_match.group(0)
+    return generated_text
+
+
+def parse_model_output(result):
+    """Decode the question list from a chat completion (raises ValueError)"""
+    return json.loads(extract_json_block(result['choices'][0]['message']['content']))
+
+
+def check_diagram_specs(questions_data):
     """
-    # Set up headers with API key
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
+    Validate structured diagram specs in place; a spec that fails falls back
+    to its text description (see diagram_spec.clean_descriptions).
+    """
+    for question in questions_data:
+        descriptions = question.get('diagram_descriptions') if isinstance(question, dict) else None
+        if not descriptions:
+            continue
+        if not isinstance(descriptions, list):
+            descriptions = [descriptions]
+        question['diagram_descriptions'], invalid = clean_descriptions(descriptions)
+        specs = sum(isinstance(entry, dict) for entry in question['diagram_descriptions'])
+        PROFILER.count("diagram_spec.valid", specs)
+        PROFILER.count("diagram_spec.invalid", invalid)
+    return questions_data
+
+
+def is_calculation(question, question_type):
+    """Whether a question's mark scheme should show checkable arithmetic"""
+    if question_type == "Calculation":
+        return True
+    return str(question.get('format', '')).lower().startswith("calc")
+
+
+def verify_answers(questions_data, question_type):
+    """
+    Check the arithmetic in the mark schemes of Calculation questions (see
+    answer_check).  Questions with a wrong step get ``answer_check``, a list
+    of notes like "12 / 4 = 4 (works out to 3)"; returns their indices.
+    """
+    checked = [i for i, question in enumerate(questions_data)
+               if isinstance(question, dict) and is_calculation(question, question_type)]
+    if not checked:
+        return []
+    with span("verify"):
+        results = answer_check.verify([str(questions_data[i].get('mark_scheme') or '') for i in checked])
+    
+    failed = []
+    for i, checks in zip(checked, results):
+        notes = [f"{c.expression} = {c.stated} (works out to {c.value:.4g})" for c in checks if not c.ok]
+        if notes:
+            questions_data[i]['answer_check'] = notes
+            failed.append(i)
+        else:
+            questions_data[i].pop('answer_check', None)
+    PROFILER.count("verify.checked", len(checked))
+    PROFILER.count("verify.failed", len(failed))
+    return failed
+
+
+def failed_answers(questions_data):
+    """Indices of the questions verify_answers flagged"""
+    return [i for i, question in enumerate(questions_data)
+            if isinstance(question, dict) and question.get('answer_check')]
+
+
+def replacement_slots(questions_data, failed):
+    """paper_plan slots asking for Calculation questions like the ``failed`` ones"""
+    return [paper_plan.Slot(str(questions_data[i].get('topic', 'General')),
+                            str(questions_data[i].get('difficulty', 'Medium')), "Calculation")
+            for i in failed]
+
+
+def merge_replacements(questions_data, failed, replacements):
+    """
+    Put verified ``replacements`` in place of the ``failed`` questions (in
+    order); returns the indices still failing.
+    """
+    good = iter([q for q in replacements if isinstance(q, dict) and not q.get('answer_check')])
+    still_failed = []
+    for i in failed:
+        replacement = next(good, None)
+        if replacement is None:
+            still_failed.append(i)
+        else:
+            questions_data[i] = replacement
+    PROFILER.count("verify.replaced", len(failed) - len(still_failed))
+    return still_failed
+
+
+def plan_question_diagrams(questions_data):
+    """
+    Prepare questions for rendering and list the diagrams to draw as
+    (question index, diagram number, description), in order.
+    
+    Descriptions come from both the diagram_descriptions list and any
+    [DIAGRAM: ...] tags in the question text, which are removed from it.
+    Diagrams from diagram_descriptions replace any existing ones; tags found
+    in the question text are numbered after them.
+    """
+    plan = []
+    for q_index, question in enumerate(questions_data):
+        descriptions = list(question.get('diagram_descriptions') or [])
+        question_text, text_descriptions = process_diagram_text(question['question'])
+        if not descriptions and not text_descriptions:
+            continue
+        
+        if descriptions:
+            question['diagrams'] = []
+        else:
+            question.setdefault('diagrams', [])
+        
+        start_idx = len(question['diagrams']) + 1
+        for i, desc in enumerate(descriptions + text_descriptions, start_idx):
+            plan.append((q_index, i, desc))
+        
+        # Update question text with cleaned version
+        if text_descriptions:
+            question['question'] = question_text
+    return plan
+
+
+def render_question_diagrams(questions_data, on_diagram=None, should_cancel=None):
+    """
+    Convert diagram descriptions into rendered diagrams, in place (see
+    plan_question_diagrams).
+    
+    ``on_diagram(done, total, per_question)`` is called after every diagram,
+    where per_question holds [done, total] for each question, and
+    ``should_cancel()`` is checked before each one.
+    """
+    # Collect every description first so progress can report totals
+    plan = plan_question_diagrams(questions_data)
+    per_question = [[0, 0] for _ in questions_data]
+    for q_index, _, _ in plan:
+        per_question[q_index][1] += 1
+    
+    for done, (q_index, i, desc) in enumerate(plan, 1):
+        if should_cancel is not None and should_cancel():
+            raise JobCancelled("Generation cancelled while rendering diagrams")
+        questions_data[q_index]['diagrams'].append(render_diagram(desc, i))
+        
+        per_question[q_index][0] += 1
+        if on_diagram is not None:
+            on_diagram(done, len(plan), per_question)
+    return questions_data
+
+
+# Hedged requests: when the primary model has not answered after the
+# HEDGE_PERCENTILE of recent API latencies, a backup request goes to the next
+# model and whichever returns valid JSON first wins
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 10.0  # seconds, until enough latencies have been observed
+
+
+@st.cache_resource
+def get_decommissioned_models():
+    """Models the provider has reported as decommissioned (skipped from then on)"""
+    return set()
+
+
+def is_decommissioned_error(error):
+    """True for the provider's 4xx 'model decommissioned / not found' errors"""
+    response = getattr(error, "response", None)
+    if response is None or not 400 <= response.status_code < 500 or response.status_code == 429:
+        return False
+    try:
+        body = response.json().get("error", {})
+    except ValueError:
+        body = {}
+    message = str(body.get("message", "")).lower()
+    return (body.get("code") in ("model_decommissioned", "model_not_found")
+            or "decommissioned" in message or "does not exist" in message)
+
+
+def fallback_models(model):
+    """``model`` followed by the other GROQ_MODELS, minus decommissioned ones"""
+    dead = get_decommissioned_models()
+    ordered = [model] + [m for m in GROQ_MODELS if m != model]
+    return [m for m in ordered if m not in dead] or [model]
+
+
+def should_fall_back(error, model, position, models):
+    """
+    True if the request to ``model`` (``models[position]``) failed because it
+    is decommissioned and another model is left to try; the model is then
+    remembered as dead.
+    """
+    if not is_decommissioned_error(error) or position == len(models) - 1:
+        return False
+    get_decommissioned_models().add(model)
+    PROFILER.count("api.model_fallback")
+    return True
+
+
+def complete_with_fallback(payload, api_key, models, **kwargs):
+    """
+    post_chat_completion on the first of ``models`` that the provider still
+    serves; decommissioned models are remembered and skipped.
+    """
+    for position, model in enumerate(models):
+        try:
+            return post_chat_completion(dict(payload, model=model), api_key, **kwargs)
+        except requests.exceptions.HTTPError as e:
+            if not should_fall_back(e, model, position, models):
+                raise
+
+
+def hedge_delay():
+    """Seconds to wait for the primary model before launching the backup"""
+    stats = PROFILER.stage("api")
+    if stats is None or stats.count < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return stats.percentile(HEDGE_PERCENTILE)
+
+
+def hedged_completion(payload, api_key, validate, session_id=None, on_queue=None,
+                      expected_completion_tokens=None, delay=None):
+    """
+    Race the primary model against a backup model.  The backup starts after
+    ``delay`` seconds (default: hedge_delay()) or as soon as the primary fails
+    or returns output that ``validate(result)`` rejects.  The first valid
+    result wins and the other request is abandoned: if it is still waiting
+    for rate limit capacity it gives up, but once sent it runs to completion
+    in the background and its result is ignored (requests cannot interrupt
+    a response being read from another thread).
+    
+    A primary that loses is timed to the end so that its real latency is
+    recorded: compare the p95/p99
+    of the ``api.hedged`` and ``api.unhedged`` stages for the tail latency
+    improvement, and the ``hedge.*`` counters for the extra requests spent.
+    """
+    models = fallback_models(payload["model"])
+    attempts = {"primary": models, "backup": models[1:]}
+    outcomes = queue.Queue()
+    abandoned = threading.Event()
+    
+    def queue_progress(position, eta):
+        if abandoned.is_set():
+            raise JobCancelled("Hedged request no longer needed")
+        if on_queue is not None:
+            on_queue(position, eta)
+    
+    def attempt(name):
+        http = requests.Session()
+        try:
+            result = complete_with_fallback(
+                payload, api_key, attempts[name], http=http, session_id=session_id,
+                on_queue=queue_progress, expected_completion_tokens=expected_completion_tokens
+            )
+        except Exception as e:
+            outcomes.put((name, None, e))
+            return
+        finally:
+            http.close()
+        
+        if name == "primary":
+            PROFILER.record("api.unhedged", time.perf_counter() - start)
+        try:
+            validate(result)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            outcomes.put((name, result, e))
+            return
+        outcomes.put((name, result, None))
+    
+    def launch(name):
+        threading.Thread(target=attempt, args=(name,), daemon=True).start()
+        launched.append(name)
+    
+    start = time.perf_counter()
+    launched = []
+    launch("primary")
+    PROFILER.count("hedge.requests")
+    
+    try:
+        outcome = outcomes.get(timeout=delay if delay is not None else hedge_delay())
+    except queue.Empty:
+        outcome = None
+    
+    finished = []
+    try:
+        while True:
+            if outcome is None:
+                # Primary is slow (or failed): start the backup if there is one
+                if len(launched) == 1 and attempts["backup"]:
+                    launch("backup")
+                    PROFILER.count("hedge.backups_launched")
+                outcome = outcomes.get()
+            
+            name, result, error = outcome
+            finished.append(outcome)
+            if error is None:
+                break
+            if len(finished) == len(launched) and (len(launched) == 2 or not attempts["backup"]):
+                # Everything failed: hand back invalid output for the caller to
+                # report, otherwise the first error
+                for _, bad_result, _ in finished:
+                    if bad_result is not None:
+                        return bad_result
+                raise finished[0][2]
+            outcome = None
+    finally:
+        # Requests still waiting for rate limit capacity give up; one already
+        # sent finishes on its own thread
+        abandoned.set()
+    
+    PROFILER.record("api.hedged", time.perf_counter() - start)
+    if name == "backup":
+        PROFILER.count("hedge.won_by_backup")
+    return result
+
+
+class GenerationError(Exception):
+    """A failed generation, with a user-facing message and the raw model output if any"""
+    
+    def __init__(self, message, raw_output=None):
+        super().__init__(message)
+        self.raw_output = raw_output
+
+
+# Give up waiting for API capacity after this many seconds
+RATE_LIMIT_TIMEOUT = 300
+# How many times a 429 response is retried before it is reported as an error
+MAX_RATE_LIMIT_RETRIES = 3
+# Send one short worked example with every request (see prompts.py)
+FEW_SHOT_PROMPT = os.getenv("EXAMPREP_FEW_SHOT", "0") == "1"
+
+# Rough completion size of one question, used to reserve tokens up front
+COMPLETION_TOKENS_PER_QUESTION = 400
+# Follow-up requests for questions whose worked answers do not add up
+ANSWER_RETRIES = int(os.getenv("EXAMPREP_ANSWER_RETRIES", "1"))
+
+
+@st.cache_resource
+def get_rate_limiter():
+    """Process-wide limiter for the shared GROQ_API_KEY (shared by all sessions)"""
+    return GroqRateLimiter(rpm=GROQ_RPM, tpm=GROQ_TPM)
+
+
+def current_session_id():
+    """Streamlit session id of the running script (None outside streamlit run)"""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
+
+def estimate_prompt_tokens(messages):
+    """Cheap prompt token estimate (about 4 characters per token)"""
+    return sum(len(m['content']) for m in messages) // 4 + 4 * len(messages)
+
+
+def record_prompt_usage(messages, result):
+    """Count prompt tokens per request: the API's figure and our estimate"""
+    usage = result.get("usage") or {}
+    PROFILER.count("prompt.requests")
+    PROFILER.count("prompt.estimated_tokens", estimate_prompt_tokens(messages))
+    if usage.get("prompt_tokens"):
+        PROFILER.count("prompt.tokens", usage["prompt_tokens"])
+
+
+def api_headers(api_key):
+    return {
+        "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
+
+
+def request_limiter(api_key):
+    """The rate limiter a request with ``api_key`` waits for, or None"""
+    # Only the shared key is limited; users who bring their own key skip the queue
+    return get_rate_limiter() if api_key == os.getenv("GROQ_API_KEY") else None
+
+
+def api_key_identity(api_key):
+    """"shared" for the app's own key, otherwise a short hash of the user's key"""
+    if api_key is None or api_key == os.getenv("GROQ_API_KEY"):
+        return "shared"
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def request_token_estimate(payload, expected_completion_tokens=None):
+    """Tokens reserved for a request: estimated prompt plus expected completion"""
+    completion_tokens = expected_completion_tokens or payload.get("max_tokens", 0)
+    return estimate_prompt_tokens(payload["messages"]) + completion_tokens
+
+
+def rate_limited_delay(limiter, estimated_tokens, headers, attempt):
+    """
+    Handle a 429 response: returns the seconds the caller should sleep
+    before retrying (0 when the limiter holds everyone back instead).
+    """
+    PROFILER.count("api.rate_limited")
+    try:
+        retry_after = float(headers.get("Retry-After", ""))
+    except ValueError:
+        retry_after = 2 ** attempt
+    if limiter is None:
+        return retry_after
+    # The rejected request used no tokens; hold everyone back instead
+    release_reservation(limiter, estimated_tokens)
+    limiter.penalize(retry_after)
+    return 0
+
+
+def release_reservation(limiter, estimated_tokens):
+    """Give back the tokens reserved for a request that reported no usage"""
+    if limiter is not None:
+        limiter.settle(estimated_tokens, 0)
+
+
+def settle_usage(limiter, estimated_tokens, result):
+    """Correct the token reservation with the real usage"""
+    used_tokens = result.get("usage", {}).get("total_tokens")
+    if limiter is not None and used_tokens:
+        limiter.settle(estimated_tokens, used_tokens)
+
+
+def post_chat_completion(payload, api_key, session_id=None, on_queue=None, expected_completion_tokens=None,
+                         http=None):
+    """
+    Send a chat completion request and return the decoded JSON response.
     
-    # Prepare difficulty string
-    difficulty_str = ""
-    if difficulty != "Mixed":
-        difficulty_str = f"All questions should be of {difficulty} difficulty level."
-    else:
-        difficulty_str = "Mix the difficulty levels with approximately equal numbers of Easy, Medium, and Hard questions."
+    Requests made with the shared key first wait for capacity in the
+    process-wide rate limiter (fair across sessions; ``on_queue(position, eta)``
+    reports progress while queued).  429 responses are retried after the
+    provider's Retry-After instead of failing straight away.  ``http`` is an
+    optional requests.Session to send the request with.
+    """
+    headers = api_headers(api_key)
+    limiter = request_limiter(api_key)
+    estimated_tokens = request_token_estimate(payload, expected_completion_tokens)
     
-    # Prepare question type string
-    question_type_str = ""
-    if question_type != "Mixed":
-        question_type_str = f"All questions should be in the {question_type} format: {QUESTION_FORMATS[question_type]}"
-    else:
-        question_type_str = "Mix question types including multiple choice, short answer, calculation, and extended response formats."
-    
-    # Prepare topics string
-    topics_str = ", ".join(topics)
-    
-    # Create the prompt
-    prompt = f"""You are an exam question generator for {level} {subject}. Generate {num_questions} high-quality past paper style questions covering the following topics: {topics_str}.
-
-{difficulty_str}
-{question_type_str}
-
-The questions should:
-1. Match real {level} {subject} exam questions in style, format, and complexity
-2. Include a detailed mark scheme showing how points are awarded
-3. Be clearly labeled with their difficulty level (Easy, Medium, or Hard)
-4. Include diagrams where appropriate - describe any needed diagrams in detail by enclosing the description in [DIAGRAM: description] tags
-
-For each question, provide:
-- The question itself
-- The topic it covers
-- The difficulty level
-- A detailed mark scheme
-- Any diagram descriptions in [DIAGRAM: description] format
-
-Format your response as a JSON array of questions with the following structure:
-```json
-[
-  {{
-    "question": "The full text of the question...",
-    "topic": "The specific topic",
-    "difficulty": "Easy|Medium|Hard",
-    "mark_scheme": "The full mark scheme...",
-    "diagram_descriptions": ["Description 1", "Description 2"] // Only if diagrams are needed
-  }},
-  // More questions...
-]
-```
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        if limiter is not None:
+            with span("queue"):
+                limiter.acquire(session_id or "default", estimated_tokens,
+                                on_wait=on_queue, timeout=RATE_LIMIT_TIMEOUT)
+        
+        try:
+            with span("api"):
+                response = (http or requests).post(GROQ_API_URL, headers=headers, json=payload)
+            rate_limited = response.status_code == 429 and attempt < MAX_RATE_LIMIT_RETRIES
+            if not rate_limited:
+                # Check for successful response
+                response.raise_for_status()
+                result = response.json()
+        except BaseException:
+            # Errors, timeouts and a final 429 report no usage (e.g. a
+            # decommissioned model before the fallback is queued)
+            release_reservation(limiter, estimated_tokens)
+            raise
+        
+        if rate_limited:
+            time.sleep(rate_limited_delay(limiter, estimated_tokens, response.headers, attempt))
+            continue
+        settle_usage(limiter, estimated_tokens, result)
+        return result
 
-The generated questions should be challenging but fair, and should test understanding rather than just recall. Make the questions engaging and relevant to real-world applications where possible.
-"""
 
+# Function to call Groq API to generate questions
+def generate_questions_with_groq(subject, level, topics, num_questions, difficulty, question_type, model,
+                                 session_id=None, on_queue=None):
+    """
+    Generate questions using the Groq LLM API
+    """
+    try:
+        return run_generation(subject, level, topics, num_questions, difficulty, question_type, model,
+                              session_id=session_id, on_queue=on_queue)
+    except GenerationError as e:
+        st.error(str(e))
+        if e.raw_output:
+            st.text(e.raw_output)
+        return []
+
+
+def generation_request(subject, level, topics, num_questions, difficulty, question_type, model, slots=None,
+                       marks=None):
+    """
+    The chat completion payload for one generation and its expected
+    completion tokens.  ``slots`` and ``marks`` pin down each question (see
+    prompts.request_text).
+    """
+    # Constant system message (shared by every request) plus the request itself
+    messages = build_messages(level, subject, topics, num_questions, difficulty, question_type,
+                              QUESTION_FORMATS, few_shot=FEW_SHOT_PROMPT, slots=slots, marks=marks)
+    
     # Prepare the request payload
     payload = {
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": messages,
         "model": model,
         "temperature": 0.7,
         "max_tokens": 4000,
         "top_p": 1,
         "stream": False
     }
+    return payload, min(payload["max_tokens"], num_questions * COMPLETION_TOKENS_PER_QUESTION)
+
+
+def answer_retry_request(questions_data, failed, subject, level, topics, difficulty, model):
+    """
+    The request asking again for the ``failed`` questions (failed_answers):
+    (payload, expected completion tokens, slots).
+    """
+    slots = replacement_slots(questions_data, failed)
+    payload, expected_tokens = generation_request(subject, level, topics, len(failed), difficulty,
+                                                  "Calculation", model, slots=slots)
+    PROFILER.count("verify.rerequested", len(failed))
+    return payload, expected_tokens, slots
+
+
+def questions_from_completion(result, payload, subject, level, topics, difficulty, question_type, latency=None,
+                              slots=None, cached=False):
+    """
+    Parse the questions of a chat completion, drop near-duplicates (of each
+    other and of banked questions), validate diagram specs, check the arithmetic of Calculation answers and bank the
+    questions that pass (with the usage and the API ``latency`` in seconds,
+    if known).  Labels a question leaves out are taken from the ``slots`` it
+    was requested for.  A ``cached`` completion (already banked when it was
+    first parsed) is not checked against the bank.  Raises GenerationError
+    on malformed JSON.
+    """
+    record_prompt_usage(payload["messages"], result)
+    
+    # Extract the generated text
+    generated_text = result['choices'][0]['message']['content']
     
+    # Parse the JSON
+    json_str = generated_text
     try:
-        # Make the API request
-        response = requests.post("https://api.groq.com/openai/v1/chat/completions", 
-                               headers=headers, 
-                               json=payload)
-        
-        # Check for successful response
-        response.raise_for_status()
-        
-        # Parse the response
-        result = response.json()
+        with span("parse"):
+            # Extract JSON from response
+            json_str = extract_json_block(generated_text)
+            questions_data = json.loads(json_str)
+    except json.JSONDecodeError as e:
+        raise GenerationError(f"Error parsing JSON response: {e}", raw_output=json_str)
+    
+    # The same question twice in one batch (common when over-generating a pool)
+    if isinstance(questions_data, list):
+        for question, slot in zip(questions_data, slots or ()):
+            if isinstance(question, dict):
+                for field, value in slot._asdict().items():
+                    question.setdefault(field, value)
+        questions_data = drop_near_duplicates(questions_data)
+        # Nor one another student already had
+        if not cached:
+            questions_data = drop_banked_duplicates(questions_data)
+        check_diagram_specs(questions_data)
+        verify_answers(questions_data, question_type)
+    
+    # Keep every valid question for later papers
+    bank_questions(questions_data, subject, level, topics, difficulty, question_type,
+                   result.get('model', payload["model"]), usage=result.get("usage"), latency=latency)
+    return questions_data
+
+
+def run_generation(subject, level, topics, num_questions, difficulty, question_type, model,
+                   session_id=None, on_queue=None, on_progress=None, should_cancel=None, hedge=False,
+                   render=True, slots=None, marks=None):
+    """
+    The generation pipeline behind generate_questions_with_groq: prompt, API
+    call, JSON parsing and diagram rendering.  Raises GenerationError instead
+    of writing to the page, so it can run outside the script thread.
+    
+    ``on_progress(message, fraction, **details)`` reports progress and
+    ``should_cancel()`` is polled between steps (raising JobCancelled).  With
+    ``hedge`` a backup model races the selected one when it is slow;
+    decommissioned models always fall back to the next of GROQ_MODELS.
+    Without ``render`` the diagrams are left as descriptions.  ``slots`` and
+    ``marks`` are passed on to generation_request.
+    """
+    def report(message, fraction, **details):
+        if on_progress is not None:
+            on_progress(message, fraction, **details)
+    
+    def check_cancelled():
+        if should_cancel is not None and should_cancel():
+            raise JobCancelled("Generation cancelled")
+    
+    def queue_progress(position, eta):
+        # Leaving the queue is the cheapest point to honour a cancellation
+        check_cancelled()
+        if on_queue is not None:
+            on_queue(position, eta)
+    
+    payload, expected_tokens = generation_request(subject, level, topics, num_questions, difficulty,
+                                                  question_type, model, slots=slots, marks=marks)
+    
+    # Time the whole request (and cProfile it when EXAMPREP_PROFILE_DIR is set)
+    with PROFILER.request("generate", label=f"{level} {subject} {difficulty} {question_type}"):
+        check_cancelled()
+        report(f"Waiting for the model to write {num_questions} questions", 0.1)
+        # The same request may have just been answered, in this process or another
+        result = cached = cached_completion(payload, GROQ_API_KEY, session_id)
+        started = time.perf_counter()
+        try:
+            # Make the API request (queued behind the shared rate limiter)
+            if cached is None and hedge:
+                result = hedged_completion(
+                    payload, GROQ_API_KEY, validate=parse_model_output, session_id=session_id,
+                    on_queue=queue_progress, expected_completion_tokens=expected_tokens
+                )
+            elif cached is None:
+                result = complete_with_fallback(
+                    payload, GROQ_API_KEY, fallback_models(model), session_id=session_id,
+                    on_queue=queue_progress, expected_completion_tokens=expected_tokens
+                )
+        except RateLimitTimeout as e:
+            raise GenerationError(f"The API is busy right now, please try again in a minute. ({e})")
+        except requests.exceptions.RequestException as e:
+            raise GenerationError(f"API request error: {e}")
+        latency = time.perf_counter() - started if cached is None else None
+        check_cancelled()
+        questions_data = questions_from_completion(result, payload, subject, level, topics, difficulty, question_type,
+                                                   latency=latency, slots=slots, cached=cached is not None)
+        # Only share completions that parsed
+        if cached is None:
+            store_completion(payload, result, GROQ_API_KEY, session_id)
+        
+        # Ask again for just the questions whose worked answers do not add up
+        failed = failed_answers(questions_data)
+        for _ in range(ANSWER_RETRIES if failed else 0):
+            check_cancelled()
+            report(f"Rewriting {len(failed)} questions with inconsistent answers", 0.35)
+            retry_payload, retry_tokens, retry_slots = answer_retry_request(questions_data, failed, subject, level,
+                                                                            topics, difficulty, model)
+            try:
+                retry_result = complete_with_fallback(
+                    retry_payload, GROQ_API_KEY, fallback_models(model), session_id=session_id,
+                    on_queue=queue_progress, expected_completion_tokens=retry_tokens
+                )
+                replacements = questions_from_completion(retry_result, retry_payload, subject, level, topics,
+                                                         difficulty, "Calculation", slots=retry_slots)
+            except (RateLimitTimeout, requests.exceptions.RequestException, GenerationError):
+                # The flagged questions are still usable, just marked
+                break
+            failed = merge_replacements(questions_data, failed, replacements)
+            if not failed:
+                break
+        if not render:
+            return questions_data
         
-        # Extract the generated text
-        generated_text = result['choices'][0]['message']['content']
+        # Process diagrams for each question
+        def diagram_progress(done, total, per_question):
+            report(f"Rendering diagram {done} of {total}", 0.4 + 0.6 * done / total,
+                   questions=[list(counts) for counts in per_question])
         
-        # Extract JSON from response
-        # First, find the JSON part in the response
-        json_match = re.search(r'```json\s*([\s\S]*?)\s*```', generated_text)
-        if json_match:
-            json_str = json_match.group(1)
-        else:
-            # If not found in code blocks, try to extract anything that looks like JSON array
-            json_match = re.search(r'\[\s*{[\s\S]*}\s*\]', generated_text)
-            if json_match:
-                json_str = json_match.group(0)
-            else:
-                json_str = generated_text
+        report("Rendering diagrams", 0.4)
+        with span("render"):
+            render_question_diagrams(questions_data, on_diagram=diagram_progress, should_cancel=should_cancel)
         
-        # Parse the JSON
+        return questions_data
+
+
+# Identical generations that are in flight at the same time (e.g. a whole
+# class pressing Generate together) share a single API call.  Streamlit
+# re-executes this script on every rerun, so process-wide objects are created
+# through st.cache_resource to be shared by all sessions.
+@st.cache_resource
+def get_question_flights():
+    return SingleFlight()
+
+
+# Over-generate coalesced calls by this factor so each session can get its own
+# shuffled subset of the shared pool (1 disables over-generation)
+POOL_FACTOR = float(os.getenv("EXAMPREP_POOL_FACTOR", "1"))
+MAX_POOL_QUESTIONS = 15
+
+
+def generation_key(subject, level, topics, num_questions, difficulty, question_type, model, slots=None,
+                   marks=None, api_key=None):
+    """
+    Normalized identity of a generation request: case, whitespace and topic
+    order do not matter.  Requests made with different API keys never share
+    a call (see api_key_identity).
+    """
+    return (
+        api_key_identity(api_key),
+        level.strip().lower(),
+        subject.strip().lower(),
+        tuple(sorted({t.strip().lower() for t in topics})),
+        int(num_questions),
+        difficulty.strip().lower(),
+        question_type.strip().lower(),
+        model,
+        tuple(slots or ()),
+        marks,
+    )
+
+
+def copy_question(question):
+    """Copy a question so sessions never share dicts (diagram bytes are immutable and shared)"""
+    copied = dict(question)
+    if question.get('diagrams'):
+        copied['diagrams'] = list(question['diagrams'])
+    return copied
+
+
+def generate_questions_coalesced(subject, level, topics, num_questions, difficulty, question_type, model,
+                                 session_id=None, on_queue=None, on_progress=None, should_cancel=None,
+                                 hedge=False, slots=None, marks=None, render=True):
+    """
+    Same as run_generation, but identical requests that overlap in time are
+    served by one API call.  With EXAMPREP_POOL_FACTOR > 1 the shared call
+    over-generates and every caller gets a different random subset of the
+    pool (not for requests pinned down by ``slots``).  Raises
+    GenerationError on failure.
+    """
+    pool_size = num_questions
+    if POOL_FACTOR > 1 and not slots:
+        pool_size = max(num_questions, min(MAX_POOL_QUESTIONS, math.ceil(num_questions * POOL_FACTOR)))
+    
+    key = (generation_key(subject, level, topics, num_questions, difficulty, question_type, model, slots, marks,
+                          api_key=GROQ_API_KEY),
+           render)
+    flights = get_question_flights()
+    
+    def leader_should_cancel():
+        # The shared call is only abandoned when nobody else is waiting on it
+        return should_cancel is not None and should_cancel() and not flights.in_flight().get(key)
+    
+    if key in flights.in_flight() and on_progress is not None:
+        on_progress("Joining an identical request from another session", 0.1)
+    
+    while True:
         try:
-            questions_data = json.loads(json_str)
-            
-            # Process diagrams for each question
-            for question in questions_data:
-                # Convert diagram descriptions to actual diagrams
-                if 'diagram_descriptions' in question and question['diagram_descriptions']:
-                    question['diagrams'] = []
-                    for i, desc in enumerate(question['diagram_descriptions'], 1):
-                        diagram_io = generate_diagram(desc, i)
-                        question['diagrams'].append(diagram_io)
-                    
-                # Also check if there are diagram descriptions in the question text
-                question_text, diagram_descs = process_diagram_text(question['question'])
-                if diagram_descs:
-                    if 'diagrams' not in question:
-                        question['diagrams'] = []
-                    
-                    # Start index after any existing diagrams
-                    start_idx = len(question.get('diagrams', [])) + 1
-                    for i, desc in enumerate(diagram_descs, start_idx):
-                        diagram_io = generate_diagram(desc, i)
-                        question['diagrams'].append(diagram_io)
-                    
-                    # Update question text with cleaned version
-                    question['question'] = question_text
-            
-            return questions_data
-            
-        except json.JSONDecodeError as e:
-            st.error(f"Error parsing JSON response: {e}")
-            st.text(json_str)
-            return []
-            
-    except requests.exceptions.RequestException as e:
-        st.error(f"API request error: {e}")
+            pool, shared = flights.do(
+                key,
+                lambda: run_generation(subject, level, topics, pool_size, difficulty, question_type, model,
+                                       session_id=session_id, on_queue=on_queue, on_progress=on_progress,
+                                       should_cancel=leader_should_cancel, hedge=hedge, slots=slots,
+                                       marks=marks, render=render),
+                should_cancel=should_cancel
+            )
+            break
+        except JobCancelled:
+            # The call we joined was cancelled by its own session; start again
+            # unless this caller was cancelled too
+            if should_cancel is not None and should_cancel():
+                raise
+    PROFILER.count("singleflight.shared" if shared else "singleflight.leader")
+    
+    # Hand each caller its own shuffled subset of the pool
+    if len(pool) > num_questions:
+        pool = random.sample(pool, num_questions)
+    return [copy_question(q) for q in pool]
+
+
+# Every validated question is kept in a local SQLite bank (EXAMPREP_BANK_PATH,
+# empty to disable) so papers can be assembled without calling the API
+@st.cache_resource
+def get_question_bank():
+    return open_question_bank()
+
+
+# LLM completions, diagrams and PDFs are cached by a backend shared by every
+# process on the node (EXAMPREP_CACHE; by default the bank file, see cache_backend)
+@st.cache_resource
+def get_cache(namespace):
+    return open_cache(namespace)
+
+
+def cache_get(namespace, key):
+    """Cached bytes or None, counting hits and misses (read errors are misses)"""
+    cache = get_cache(namespace)
+    if cache is None:
+        return None
+    try:
+        value = cache.get(key)
+    except sqlite3.Error:
+        value = None
+    PROFILER.count(f"cache.{namespace}.hits" if value is not None else f"cache.{namespace}.misses")
+    return value
+
+
+def cache_set(namespace, key, value, ttl=None):
+    """Cache bytes (failures only cost the cache entry)"""
+    cache = get_cache(namespace)
+    if cache is None:
+        return
+    try:
+        cache.set(key, value, ttl)
+    except sqlite3.Error:
+        PROFILER.count("cache.write_errors")
+
+
+# Identical generation requests within this many seconds share one completion,
+# across processes too (0 disables)
+LLM_CACHE_TTL = int(os.getenv("EXAMPREP_LLM_CACHE_TTL", "60"))
+
+
+def completion_cache_key(payload, api_key=None):
+    """Cache key of a completion: the request and the identity of the key it was made with"""
+    keyed = {"api_key": api_key_identity(api_key), "payload": payload}
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+@st.cache_resource
+def get_served_completions():
+    """{(session id, completion cache key): time served}, kept for LLM_CACHE_TTL"""
+    return {}
+
+
+def served_recently(session_id, key):
+    """True if ``session_id`` got the completion ``key`` within LLM_CACHE_TTL"""
+    served = get_served_completions()
+    now = time.time()
+    for entry, served_at in list(served.items()):
+        if now - served_at > LLM_CACHE_TTL:
+            served.pop(entry, None)
+    return (session_id, key) in served
+
+
+def cached_completion(payload, api_key=None, session_id=None):
+    """
+    A recent completion of the same request, or None.  A session is never
+    handed the same completion twice, so pressing Generate again always
+    asks for new questions.
+    """
+    if not LLM_CACHE_TTL:
+        return None
+    key = completion_cache_key(payload, api_key)
+    if session_id is not None and served_recently(session_id, key):
+        PROFILER.count("cache.llm.repeat_bypassed")
+        return None
+    cached = cache_get("llm", key)
+    if cached is None:
+        return None
+    if session_id is not None:
+        get_served_completions()[(session_id, key)] = time.time()
+    return json.loads(cached)
+
+
+def store_completion(payload, result, api_key=None, session_id=None):
+    if LLM_CACHE_TTL:
+        key = completion_cache_key(payload, api_key)
+        cache_set("llm", key, json.dumps(result).encode("utf-8"), ttl=LLM_CACHE_TTL)
+        if session_id is not None:
+            get_served_completions()[(session_id, key)] = time.time()
+
+
+# Near-duplicates (estimated Jaccard similarity of question + mark scheme
+# shingles at or above this) are rejected
+DUPLICATE_THRESHOLD = float(os.getenv("EXAMPREP_DUPLICATE_THRESHOLD", "0.8"))
+MINHASHER = MinHasher()
+
+
+@st.cache_resource
+def get_duplicate_index():
+    """LSH index over the MinHash signatures of every banked question"""
+    index = LSHIndex(MINHASHER.num_perm, threshold=DUPLICATE_THRESHOLD)
+    bank = get_question_bank()
+    if bank is None:
+        return index
+    
+    with span("dedupe.load"):
+        # Sign questions banked before signatures were stored
+        unsigned = bank.unsigned()
+        if unsigned:
+            signatures = MINHASHER.signatures([f"{question}\n{mark_scheme}" for _, question, mark_scheme in unsigned])
+            bank.set_minhashes([(key, sig.tobytes()) for (key, _, _), sig in zip(unsigned, signatures)])
+        
+        for rows in bank.minhashes():
+            index.add_many([key for key, _ in rows],
+                           np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.uint32))
+    return index
+
+
+def drop_near_duplicates(questions):
+    """Keep the first of every group of near-identical questions"""
+    if len(questions) < 2:
+        return questions
+    with span("dedupe"):
+        keep = unique_mask(MINHASHER.signatures([question_text(q) for q in questions]), DUPLICATE_THRESHOLD)
+    PROFILER.count("dedupe.dropped", int((~keep).sum()))
+    return [q for q, kept in zip(questions, keep) if kept]
+
+
+def drop_banked_duplicates(questions):
+    """
+    Drop questions that nearly repeat one already in the bank, i.e. one
+    another student may have been given
+    """
+    if not questions or get_question_bank() is None:
+        return questions
+    index = get_duplicate_index()
+    if not len(index):
+        return questions
+    with span("dedupe"):
+        signatures = MINHASHER.signatures([question_text(q) for q in questions])
+        keep = [not index.query(signature) for signature in signatures]
+    PROFILER.count("dedupe.banked", keep.count(False))
+    return [q for q, kept in zip(questions, keep) if kept]
+
+
+def diagram_cache_key(description, index, width, height, seed=None):
+    # Diagrams are deterministic given their inputs, so the inputs are the key
+    if isinstance(description, dict):
+        description = json.dumps(description, sort_keys=True)
+    key = f"{index}|{width}x{height}|{description.strip()}"
+    if seed is not None:
+        key = f"{seed}|{key}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def diagram_references(question_text, descriptions, width=600, height=400):
+    """
+    Diagram cache keys of a question's diagrams, numbered as
+    plan_question_diagrams numbers them
+    """
+    _, text_descriptions = process_diagram_text(question_text)
+    return [diagram_cache_key(desc, i, width, height)
+            for i, desc in enumerate(list(descriptions) + text_descriptions, 1)]
+
+
+def render_diagram(description, index, width=600, height=400, seed=None):
+    """
+    PNG bytes of generate_diagram through the shared diagram cache.  The
+    bytes are immutable, so the UI, PDFs and copies of a question all share
+    them.
+    """
+    key = diagram_cache_key(description, index, width, height, seed)
+    png = cache_get("diagrams", key)
+    if png is not None:
+        return png
+    
+    png = generate_diagram(description, index, width, height, seed).getvalue()
+    cache_set("diagrams", key, png)
+    return png
+
+
+def pdf_cache_key(questions):
+    """Everything create_pdf prints, including the date on the paper"""
+    digest = hashlib.sha256(datetime.now().strftime("%Y-%m-%d").encode("utf-8"))
+    for question in questions:
+        fields = {k: v for k, v in question.items() if k != 'diagrams'}
+        digest.update(json.dumps(fields, sort_keys=True, default=str).encode("utf-8"))
+        for diagram in question.get('diagrams') or []:
+            digest.update(hashlib.sha1(diagram_png(diagram)).digest())
+    return digest.hexdigest()
+
+
+def cached_pdf(questions):
+    """create_pdf through the shared PDF cache (reruns and other sessions reuse it)"""
+    key = pdf_cache_key(questions)
+    pdf = cache_get("pdf", key)
+    if pdf is not None:
+        return io.BytesIO(pdf)
+    
+    buffer = create_pdf(questions)
+    cache_set("pdf", key, buffer.getvalue())
+    return buffer
+
+
+def bank_questions(questions_data, subject, level, topics, difficulty, question_type, model,
+                   usage=None, latency=None):
+    """
+    Store freshly generated questions in the bank, skipping near-duplicates
+    of what is already there and answers that failed verify_answers
+    (failures only cost the bank entry).  The completion's ``usage`` and
+    ``latency`` (seconds) are kept for exports.
+    """
+    bank = get_question_bank()
+    if bank is None or not isinstance(questions_data, list):
+        return 0
+
+    rows = []
+    for question in questions_data:
+        if isinstance(question, dict) and not question.get('answer_check'):
+            row = bank.normalize(question, level, subject, topics, difficulty, question_type,
+                                 list(QUESTION_FORMATS))
+            if row is not None:
+                rows.append(row)
+    
+    # Check each question against the LSH index and index the new ones
+    index = get_duplicate_index()
+    new_rows = []
+    with span("dedupe"):
+        signatures = MINHASHER.signatures([f"{row['question']}\n{row['mark_scheme']}" for row in rows])
+        for row, signature in zip(rows, signatures):
+            if index.add_unless_duplicate(row["content_hash"], signature):
+                PROFILER.count("dedupe.rejected")
+                continue
+            row["minhash"] = signature.tobytes()
+            new_rows.append(row)
+    
+    usage = usage or {}
+    generation = {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "latency_ms": latency * 1000 if latency is not None else None,
+        "questions": len(questions_data),
+    }
+    try:
+        with span("bank"):
+            added = bank.add_many(new_rows, model=model, generation=generation)
+    except sqlite3.Error:
+        PROFILER.count("bank.write_errors")
+        return 0
+    PROFILER.count("bank.stored", added)
+    return added
+
+
+# Largest paper one request may ask for (also the sidebar's maximum)
+MAX_QUESTIONS = int(os.getenv("EXAMPREP_MAX_QUESTIONS", "60"))
+# Questions per API request in long papers: one completion has to fit max_tokens
+CHUNK_QUESTIONS = int(os.getenv("EXAMPREP_CHUNK_QUESTIONS", "8"))
+# Extra requests a long paper may make for questions dropped as duplicates
+CHUNK_RETRIES = 1
+# Formats a "Mixed" paper is spread over
+MIXED_FORMATS = [name for name in QUESTION_FORMATS if name != "Practical"]
+# Banked candidates fetched per question, so the planner has a choice
+BANK_CANDIDATES_PER_QUESTION = 4
+
+
+def paper_dimensions(difficulty, question_type):
+    """The difficulties and formats a paper is spread over ("Mixed" means several)"""
+    difficulties = list(DIFFICULTIES) if difficulty == "Mixed" else [difficulty]
+    formats = MIXED_FORMATS if question_type == "Mixed" else [question_type]
+    return difficulties, formats
+
+
+def bank_candidates(subject, level, topics, num_questions, difficulty, question_type):
+    """
+    Random banked questions that could go into this paper, a few times what
+    each topic needs.  "Mixed" difficulty/format means any.
+    """
+    bank = get_question_bank()
+    if bank is None:
         return []
+    
+    # Per topic, so one well-stocked topic cannot crowd out the others
+    per_topic = math.ceil(num_questions / len(topics)) * BANK_CANDIDATES_PER_QUESTION
+    candidates = []
+    with span("bank"):
+        for topic in topics:
+            candidates += bank.sample(
+                level, subject, [topic], per_topic,
+                difficulty=None if difficulty == "Mixed" else difficulty,
+                question_format=None if question_type == "Mixed" else question_type,
+            )
+    return candidates
+
+
+def generate_chunked(subject, level, topics, slots, difficulty, question_type, model, marks=None, paper=(),
+                     session_id=None, on_queue=None, on_progress=None, should_cancel=None, hedge=False,
+                     render=True):
+    """
+    Generate the questions for ``slots`` CHUNK_QUESTIONS at a time, so every
+    completion fits the model's output limit.  The diagrams of one chunk
+    are drawn on a second thread while the next chunk is being written.  A
+    question that nearly repeats one already in ``paper`` or an earlier
+    chunk is dropped and its slot asked for again in a later chunk (at most
+    CHUNK_RETRIES extra requests).
+    
+    Progress goes to ``on_progress`` with ``chunks=[[first, last, state]]``,
+    numbered after ``paper``.  Returns the new questions in order; if a
+    chunk fails, the ones before it are returned (GenerationError if the
+    first one fails).
+    """
+    def check_cancelled():
+        if should_cancel is not None and should_cancel():
+            raise JobCancelled("Generation cancelled")
+    
+    chunks = []  # [first, last, state] of every chunk so far
+    
+    def report(message):
+        if on_progress is not None:
+            ready = sum(last - first + 1 for first, last, state in chunks if state == "ready")
+            on_progress(message, 0.05 + 0.95 * ready / len(slots), chunks=[list(chunk) for chunk in chunks])
+    
+    def finish_rendering(wait):
+        # Mark chunks whose diagrams are drawn as ready (waiting for them if asked)
+        for chunk, future in list(rendering):
+            if wait or future.done():
+                future.result()
+                chunk[2] = "ready"
+                rendering.remove((chunk, future))
+    
+    pending = list(slots)
+    requests_left = math.ceil(len(slots) / CHUNK_QUESTIONS) + CHUNK_RETRIES
+    known = MINHASHER.signatures([question_text(q) for q in paper]) if paper else None
+    generated = []
+    rendering = []
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="render") as renderer:
+        while pending and requests_left:
+            check_cancelled()
+            requests_left -= 1
+            chunk_slots, pending = pending[:CHUNK_QUESTIONS], pending[CHUNK_QUESTIONS:]
+            first = len(paper) + len(generated) + 1
+            chunk = [first, first + len(chunk_slots) - 1, "writing"]
+            chunks.append(chunk)
+            report(f"Writing questions {chunk[0]}-{chunk[1]} of {len(paper) + len(slots)}")
+            try:
+                with span("chunk"):
+                    questions = generate_questions_coalesced(
+                        subject, level, [t for t in topics if any(slot.topic == t for slot in chunk_slots)],
+                        len(chunk_slots), difficulty, question_type, model, session_id=session_id,
+                        on_queue=on_queue, should_cancel=should_cancel, hedge=hedge, slots=chunk_slots,
+                        marks=marks, render=False
+                    )
+            except GenerationError:
+                chunks.remove(chunk)
+                if not generated:
+                    raise
+                PROFILER.count("chunks.failed")
+                break
+            finish_rendering(wait=False)
+            questions, off_plan = paper_plan.assign(chunk_slots, questions)
+            PROFILER.count("paper.off_plan", off_plan)
+            
+            # Near-duplicates of earlier questions give their slot back to the queue
+            signatures = MINHASHER.signatures([question_text(q) for q in questions])
+            if known is None:
+                keep = unique_mask(signatures, DUPLICATE_THRESHOLD)
+            else:
+                keep = unique_mask(np.vstack([known, signatures]), DUPLICATE_THRESHOLD)[len(known):]
+            pending += [slot for slot, kept in zip(chunk_slots, keep) if not kept] + chunk_slots[len(questions):]
+            PROFILER.count("dedupe.cross_chunk", int((~keep).sum()))
+            questions = [q for q, kept in zip(questions, keep) if kept]
+            known = signatures[keep] if known is None else np.vstack([known, signatures[keep]])
+            
+            if not questions:
+                chunks.remove(chunk)
+                continue
+            chunk[1] = first + len(questions) - 1
+            generated += questions
+            if render:
+                chunk[2] = "drawing diagrams"
+                rendering.append((chunk, renderer.submit(render_question_diagrams, questions,
+                                                         should_cancel=should_cancel)))
+            else:
+                chunk[2] = "ready"
+            report(f"Questions {chunk[0]}-{chunk[1]} written")
+        
+        finish_rendering(wait=True)
+    report(f"{len(generated)} questions ready")
+    PROFILER.count("chunks.requested", len(chunks))
+    return generated
+
+
+def generate_paper(subject, level, topics, num_questions, difficulty, question_type, model,
+                   session_id=None, on_queue=None, on_progress=None, should_cancel=None, hedge=False,
+                   use_bank=True, target_marks=None, render=True):
+    """
+    Assemble a paper spread evenly over the selected topics, difficulties
+    and formats (see paper_plan), aiming for ``target_marks`` in total if
+    given.  Questions come from the question bank where it can supply them;
+    the API is only asked for the rest, each one pinned to the topic,
+    difficulty and format it fills, in chunks when there are more than
+    CHUNK_QUESTIONS (see generate_chunked, which also asks again for the
+    slots of fresh questions that repeat banked ones).  If that top-up
+    fails, the banked questions are still returned.  Raises GenerationError
+    when nothing could be produced.  Without ``render`` the diagrams are
+    left as descriptions.
+    """
+    difficulties, formats = paper_dimensions(difficulty, question_type)
+    candidates = bank_candidates(subject, level, topics, num_questions, difficulty, question_type) if use_bank else []
+    # Seeded by the request, so identical requests ask for identical top-ups and can share them
+    rng = random.Random(repr(generation_key(subject, level, topics, num_questions, difficulty, question_type,
+                                            model, marks=target_marks)))
+    with span("plan"):
+        banked, slots, marks = paper_plan.assemble(num_questions, topics, difficulties, formats, candidates,
+                                                   target_marks=target_marks, rng=rng)
+    PROFILER.count("bank.hits", len(banked))
+    
+    if banked:
+        if on_progress is not None:
+            on_progress(f"Found {len(banked)} of {num_questions} questions in the question bank", 0.05)
+        if render:
+            render_question_diagrams(banked, should_cancel=should_cancel)
+    
+    if not slots:
+        return banked
+    
+    # Top up from the API with exactly the questions still missing (a single
+    # chunk for short papers); near-duplicates are dropped before their
+    # diagrams are drawn and their slots asked for again
+    try:
+        generated = generate_chunked(
+            subject, level, topics, slots, difficulty, question_type, model, marks=marks, paper=banked,
+            session_id=session_id, on_queue=on_queue, on_progress=on_progress, should_cancel=should_cancel,
+            hedge=hedge, render=render
+        )
+    except GenerationError:
+        if not banked:
+            raise
+        PROFILER.count("bank.topup_failed")
+        return banked
+    paper = banked + generated
+    # Long papers keep their order, so the numbers reported while they streamed in hold
+    if len(slots) <= CHUNK_QUESTIONS:
+        random.shuffle(paper)
+    return paper
+
+
+# Generation runs as a background job so the script thread stays responsive
+# while the API call and the diagram rendering are in progress
+GENERATION_WORKERS = int(os.getenv("EXAMPREP_JOB_WORKERS", "4"))
+
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(max_workers=GENERATION_WORKERS)
+
+
+def generation_job(job, subject, level, topics, num_questions, difficulty, question_type, model, session_id=None,
+                   hedge=False, use_bank=True, target_marks=None):
+    """
+    Background job body: bank lookup plus coalesced generation, reporting
+    progress on the job.  Returns (questions, num_questions), since a long
+    paper can come back short.
+    """
+    def on_queue(position, eta):
+        job.update(message=f"Waiting for API capacity: position {position} in queue, about {math.ceil(eta)}s",
+                   fraction=0.05)
+    
+    def on_progress(message, fraction, **details):
+        job.update(message=message, fraction=fraction, **details)
+    
+    questions = generate_paper(
+        subject, level, topics, num_questions, difficulty, question_type, model,
+        session_id=session_id, on_queue=on_queue, on_progress=on_progress,
+        should_cancel=lambda: job.cancelled, hedge=hedge, use_bank=use_bank, target_marks=target_marks
+    )
+    return questions, num_questions
+
+
+@st.fragment(run_every=0.5)
+def show_generation_progress():
+    """Poll the session's generation job; rerun the whole app once it finishes"""
+    job = get_job_queue().get(st.session_state.generation_job_id)
+    if job is None:
+        st.session_state.generation_job_id = None
+        st.rerun()
+    
+    if not job.done:
+        progress = job.snapshot()
+        st.markdown(f"**Generating {job.description}...**")
+        st.progress(progress["fraction"], text=progress["message"])
+        
+        # Per-question diagram progress
+        for i, (done, total) in enumerate(progress["details"].get("questions", []), 1):
+            if total:
+                st.caption(f"Question {i}: {done}/{total} diagrams rendered")
+        
+        # Long papers arrive in chunks
+        for first, last, state in progress["details"].get("chunks", []):
+            st.caption(f"Questions {first}-{last}: {state}")
+        
+        if st.button("Cancel generation"):
+            job.cancel()
+            st.session_state.generation_job_id = None
+            st.session_state.generation_notice = ("info", "Generation cancelled.", None)
+            st.rerun()
+        return
+    
+    # Collect the finished job and redraw the page with its results
+    st.session_state.generation_job_id = None
+    if job.status == DONE:
+        questions, requested = job.result
+        st.session_state.generated_questions = questions
+        st.session_state.question_page = 1
+        if len(questions) < requested:
+            st.session_state.generation_notice = ("warning", f"Generated {len(questions)} of {requested} questions",
+                                                  None)
+        else:
+            st.session_state.generation_notice = ("success", f"Successfully generated {len(questions)} questions!",
+                                                  None)
+    elif job.status == CANCELLED:
+        st.session_state.generation_notice = ("info", "Generation cancelled.", None)
+    else:
+        raw_output = getattr(job.error, "raw_output", None)
+        st.session_state.generation_notice = ("error", f"{job.error}\n\nFailed to generate questions. Please try again.",
+                                              raw_output)
+    st.rerun()
+
+
+# Questions shown per page of results (only the current page is rendered)
+QUESTIONS_PER_PAGE = int(os.getenv("EXAMPREP_QUESTIONS_PER_PAGE", "10"))
+# Width of the diagrams on the page; the PDF keeps them at full size
+THUMBNAIL_WIDTH = 480
+
+
+@st.cache_data(max_entries=2048, show_spinner=False)
+def question_html(number, topic, difficulty, text):
+    """The question box markup, shared by every rerun and session showing it"""
+    return f"""
+        <div class="question-box">
+            <h3>Question {number}</h3>
+            <p><strong>Topic:</strong> {topic}</p>
+            <p><strong>Difficulty:</strong> <span class="difficulty-{difficulty.lower()}">{difficulty}</span></p>
+            <p>{text.replace(chr(10), '<br>')}</p>
+        </div>
+        """
+
+
+@st.cache_data(max_entries=2048, show_spinner=False)
+def mark_scheme_html(mark_scheme):
+    return f"""
+            <div class="mark-scheme">
+                {mark_scheme.replace(chr(10), '<br>')}
+            </div>
+            """
+
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def diagram_thumbnail(png, width=THUMBNAIL_WIDTH):
+    """A diagram's PNG scaled down to ``width`` pixels wide (smaller ones are kept as they are)"""
+    with PILImage.open(io.BytesIO(png)) as img:
+        if img.width <= width:
+            return png
+        thumbnail = img.resize((width, round(img.height * width / img.width)), PILImage.LANCZOS)
+    buf = io.BytesIO()
+    thumbnail.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def show_question(number, question):
+    """Render one generated question with its diagrams and mark scheme"""
+    st.markdown(question_html(number, question.get('topic', 'General'), question.get('difficulty', 'Medium'),
+                              question['question']), unsafe_allow_html=True)
+    
+    # Display diagrams if any
+    if 'diagrams' in question and question['diagrams']:
+        st.markdown('<div class="diagram-box">', unsafe_allow_html=True)
+        for j, diagram_data in enumerate(question['diagrams'], 1):
+            st.image(diagram_thumbnail(diagram_png(diagram_data)), caption=f"Diagram {j}")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    # Worked answers whose arithmetic did not check out
+    if question.get('answer_check'):
+        st.warning("Check this mark scheme, its working does not add up: "
+                   + "; ".join(question['answer_check']))
+    
+    # Mark scheme - initially hidden, with a button to show
+    with st.expander("Show Mark Scheme"):
+        st.markdown(mark_scheme_html(question.get('mark_scheme', 'Mark scheme not available')),
+                    unsafe_allow_html=True)
+    
+    st.markdown("<hr>", unsafe_allow_html=True)
 
 
 # Main app layout
@@ -1554,7 +2921,10 @@ selected_topics = st.sidebar.multiselect(
 st.session_state.selected_topics = selected_topics
 
 # Number of questions
-num_questions = st.sidebar.slider("Number of Questions", 1, 10, 3)
+num_questions = st.sidebar.slider(
+    "Number of Questions", 1, MAX_QUESTIONS, 3,
+    help=f"Papers of more than {CHUNK_QUESTIONS} new questions are written in parts of {CHUNK_QUESTIONS}."
+)
 
 # Difficulty level
 difficulty_options = ["Mixed", "Easy", "Medium", "Hard"]
@@ -1564,9 +2934,35 @@ difficulty = st.sidebar.selectbox("Difficulty Level", difficulty_options)
 question_format_options = ["Mixed"] + list(QUESTION_FORMATS.keys())
 question_format = st.sidebar.selectbox("Question Format", question_format_options)
 
+# Total marks to aim for (the paper's length)
+target_marks = st.sidebar.number_input(
+    "Target total marks", min_value=0, max_value=500, value=0, step=5,
+    help="0 leaves the marks to the questions. Otherwise questions are chosen and requested so the paper adds "
+         "up to about this many marks."
+)
+if target_marks:
+    st.sidebar.caption(f"About {paper_plan.paper_minutes(target_marks)} minutes")
+
 # Model selection
 model = st.sidebar.selectbox("Select LLM Model", GROQ_MODELS, index=1)  # Default to llama3-70b
 
+# Race a second model when the selected one is slow
+hedge_requests = st.sidebar.checkbox(
+    "Race a backup model when slow",
+    help="If the selected model takes longer than usual, the same request is also sent to the next model "
+         "and the first valid answer is used."
+)
+
+# Reuse previously generated questions from the local bank
+use_question_bank = False
+if get_question_bank() is not None:
+    use_question_bank = st.sidebar.checkbox(
+        "Use local question bank", value=True,
+        help="Take questions generated earlier for the same topics from the local bank and only ask the "
+             "model for the rest."
+    )
+    st.sidebar.caption(f"{get_question_bank().count(level, subject):,} {level} {subject} questions in the bank")
+
 # API key input (optional - can use the pre-defined key)
 custom_api_key = st.sidebar.text_input("Custom Groq API Key (optional)", type="password")
 if custom_api_key:
@@ -1585,85 +2981,118 @@ generate_button = st.sidebar.button("Generate Questions", type="primary")
 # Clear button
 clear_button = st.sidebar.button("Clear Results")
 
-# Download PDF button - only shown when questions are generated
+# Download PDF button - only shown when questions are generated.  The PDF is
+# built when the button is clicked rather than on every rerun
 if st.session_state.generated_questions:
-    pdf_buffer = create_pdf(st.session_state.generated_questions)
+    paper_questions = st.session_state.generated_questions
     st.sidebar.download_button(
         label="Download as PDF",
-        data=pdf_buffer,
+        data=lambda: cached_pdf(paper_questions),
         file_name=f"{level}_{subject}_questions.pdf",
-        mime="application/pdf"
+        mime="application/pdf",
+        on_click="ignore"
     )
 
-# Clear results if requested
+# Clear results if requested (cancelling any generation still running)
 if clear_button:
+    if st.session_state.generation_job_id:
+        get_job_queue().cancel(st.session_state.generation_job_id)
+        st.session_state.generation_job_id = None
     st.session_state.generated_questions = []
-    st.experimental_rerun()
+    st.session_state.question_page = 1
+    st.rerun()
 
 # Generate questions when the button is clicked
 if generate_button:
     if not selected_topics:
         st.warning("Please select at least one topic.")
     else:
-        with st.spinner(f"Generating {num_questions} questions for {level} {subject}..."):
-            # Show a progress bar
-            progress_bar = st.progress(0)
-            
-            # Generate the questions
-            questions = generate_questions_with_groq(
-                subject=subject,
-                level=level,
-                topics=selected_topics,
-                num_questions=num_questions,
-                difficulty=difficulty,
-                question_type=question_format,
-                model=model
-            )
-            
-            # Update progress
-            progress_bar.progress(100)
-            
-            # Store the generated questions in session state
-            st.session_state.generated_questions = questions
-            
-            # Success message
-            if questions:
-                st.success(f"Successfully generated {len(questions)} questions!")
-            else:
-                st.error("Failed to generate questions. Please try again.")
+        # Replace any generation this session still has running
+        if st.session_state.generation_job_id:
+            get_job_queue().cancel(st.session_state.generation_job_id)
+        
+        # Generate the questions in the background (sharing the API call with identical in-flight requests)
+        job = get_job_queue().submit(
+            generation_job,
+            subject=subject,
+            level=level,
+            topics=selected_topics,
+            num_questions=num_questions,
+            difficulty=difficulty,
+            question_type=question_format,
+            model=model,
+            session_id=current_session_id(),
+            hedge=hedge_requests,
+            use_bank=use_question_bank,
+            target_marks=target_marks or None,
+            description=f"{num_questions} {level} {subject} questions"
+        )
+        st.session_state.generation_job_id = job.id
+        st.session_state.generation_notice = None
+
+# Progress of the running generation, polled without blocking the script
+if st.session_state.generation_job_id:
+    show_generation_progress()
+
+# Outcome of the last finished generation (shown once)
+if st.session_state.generation_notice:
+    kind, message, raw_output = st.session_state.generation_notice
+    st.session_state.generation_notice = None
+    getattr(st, kind)(message)
+    if raw_output:
+        st.text(raw_output)
 
 # Display generated questions
 if st.session_state.generated_questions:
     st.markdown('<h2 class="sub-header">Generated Questions</h2>', unsafe_allow_html=True)
+    paper_marks = sum(paper_plan.question_marks(q) for q in st.session_state.generated_questions)
+    st.caption(f"{paper_marks} marks, about {paper_plan.paper_minutes(paper_marks)} minutes")
     
-    # Iterate through questions and display them
-    for i, question in enumerate(st.session_state.generated_questions, 1):
-        # Question box
-        st.markdown(f"""
-        <div class="question-box">
-            <h3>Question {i}</h3>
-            <p><strong>Topic:</strong> {question.get('topic', 'General')}</p>
-            <p><strong>Difficulty:</strong> <span class="difficulty-{question.get('difficulty', 'Medium').lower()}">{question.get('difficulty', 'Medium')}</span></p>
-            <p>{question['question'].replace(chr(10), '<br>')}</p>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        # Display diagrams if any
-        if 'diagrams' in question and question['diagrams']:
-            st.markdown('<div class="diagram-box">', unsafe_allow_html=True)
-            for j, diagram_data in enumerate(question['diagrams'], 1):
-                st.image(diagram_data, caption=f"Diagram {j}", use_container_width=True)
-            st.markdown('</div>', unsafe_allow_html=True)
-        
-        # Mark scheme - initially hidden, with a button to show
-        with st.expander("Show Mark Scheme"):
-            st.markdown(f"""
-            <div class="mark-scheme">
-                {question.get('mark_scheme', 'Mark scheme not available').replace(chr(10), '<br>')}
-            </div>
-            """, unsafe_allow_html=True)
+    # Only the current page is rendered, so reruns cost the same for any paper size
+    questions = st.session_state.generated_questions
+    pages = math.ceil(len(questions) / QUESTIONS_PER_PAGE)
+    page = min(st.session_state.question_page, pages)
+    if pages > 1:
+        page = st.selectbox(
+            "Page", range(1, pages + 1), index=page - 1,
+            format_func=lambda p: f"Questions {(p - 1) * QUESTIONS_PER_PAGE + 1}-"
+                                  f"{min(p * QUESTIONS_PER_PAGE, len(questions))} of {len(questions)}"
+        )
+    st.session_state.question_page = page
+    
+    first = (page - 1) * QUESTIONS_PER_PAGE
+    for i, question in enumerate(questions[first:first + QUESTIONS_PER_PAGE], first + 1):
+        show_question(i, question)
+
+# Debug view of the per-stage pipeline timings
+with st.expander("Debug: pipeline timings"):
+    timing_rows = PROFILER.snapshot()
+    if timing_rows:
+        st.dataframe(pd.DataFrame(timing_rows), use_container_width=True)
+        
+        # Histogram for one stage at a time
+        histograms = PROFILER.histograms()
+        stage_name = st.selectbox("Histogram for stage", sorted(histograms))
+        histogram_df = pd.DataFrame(histograms[stage_name], columns=["bucket", "count"]).set_index("bucket")
+        st.bar_chart(histogram_df)
+        
+        counters = PROFILER.counters()
+        if counters:
+            st.markdown("**Counters:**")
+            st.json(counters)
+        if counters.get("hedge.requests"):
+            st.caption(
+                f"Hedging: {counters.get('hedge.backups_launched', 0) / counters['hedge.requests']:.0%} extra requests, "
+                f"backup won {counters.get('hedge.won_by_backup', 0)} of {counters['hedge.requests']}. "
+                "Compare api.hedged with api.unhedged for the tail latency gain."
+            )
         
-        st.markdown("<hr>", unsafe_allow_html=True)
+        slowest = PROFILER.slowest_profiles()
+        if slowest:
+            st.markdown("**cProfile dumps of the slowest requests:**")
+            st.text("\n".join(slowest))
+    else:
+        st.info("No timings recorded yet. Generate some questions first.")
 
 # Footer
 st.markdown("""
@@ -0,0 +1,358 @@
+"""
+Persistent bank of validated generated questions.
+
+Every question that comes back from the model is stored in SQLite with its
+level, subject, topic, difficulty and format.  The (level, subject, topic,
+difficulty, format, rand) index makes filtered random sampling a couple of
+index range scans, so a paper can be assembled locally in milliseconds and
+the API is only needed for cells the bank cannot fill.  An FTS5 index over
+the question and mark scheme text supports full-text search.
+
+By default the same file also holds the shared caches (see cache_backend),
+so diagrams pre-rendered by prewarm.py are served without drawing them
+again.
+"""
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    level TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    format TEXT NOT NULL,
+    question TEXT NOT NULL,
+    mark_scheme TEXT NOT NULL DEFAULT '',
+    diagram_descriptions TEXT NOT NULL DEFAULT '[]',
+    model TEXT,
+    content_hash TEXT NOT NULL UNIQUE,
+    minhash BLOB,
+    generation_id INTEGER,
+    rand REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_questions_cell
+    ON questions (level, subject, topic, difficulty, format, rand);
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    model TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency_ms REAL,
+    questions INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# Columns of export_batches rows
+EXPORT_COLUMNS = (
+    "id", "level", "subject", "topic", "difficulty", "format", "question", "mark_scheme",
+    "diagram_descriptions", "model", "created_at", "generation_id", "prompt_tokens",
+    "completion_tokens", "latency_ms", "generation_questions",
+)
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+    question, mark_scheme, content='questions', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS questions_ai AFTER INSERT ON questions BEGIN
+    INSERT INTO questions_fts (rowid, question, mark_scheme) VALUES (new.id, new.question, new.mark_scheme);
+END;
+CREATE TRIGGER IF NOT EXISTS questions_ad AFTER DELETE ON questions BEGIN
+    INSERT INTO questions_fts (questions_fts, rowid, question, mark_scheme)
+        VALUES ('delete', old.id, old.question, old.mark_scheme);
+END;
+"""
+
+DIFFICULTIES = ("Easy", "Medium", "Hard")
+
+
+def content_hash(question_text, mark_scheme):
+    """Exact-duplicate key: whitespace and case insensitive"""
+    normalized = " ".join(f"{question_text}\n{mark_scheme}".lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _match_label(value, labels):
+    """Map free text from the model onto one of ``labels`` (or None)"""
+    value = (value or "").strip().lower()
+    if not value:
+        return None
+    for label in labels:
+        if value == label.lower():
+            return label
+    for label in labels:
+        if label.lower() in value or value in label.lower():
+            return label
+    return None
+
+
+class QuestionBank:
+    """SQLite-backed question store; safe to share between threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.has_fts = True
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        # Banks created before near-duplicate detection have no minhash column
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(questions)")}
+        if "minhash" not in columns:
+            conn.execute("ALTER TABLE questions ADD COLUMN minhash BLOB")
+        # ... nor the generation (usage and latency) they came from
+        if "generation_id" not in columns:
+            conn.execute("ALTER TABLE questions ADD COLUMN generation_id INTEGER")
+        try:
+            conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5: sampling still works, search does not
+            self.has_fts = False
+        conn.commit()
+
+    def _conn(self):
+        """One connection per thread (sqlite3 connections are not thread-safe)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def normalize(self, question, level, subject, topics, difficulty, question_format, formats):
+        """
+        Validate one generated question and map its labels onto the requested
+        topic/difficulty/format.  Returns a row dict or None if unusable.
+        """
+        text = question.get("question")
+        if not isinstance(text, str) or not text.strip():
+            return None
+        mark_scheme = question.get("mark_scheme") or ""
+        if not isinstance(mark_scheme, str):
+            mark_scheme = json.dumps(mark_scheme)
+
+        topic = _match_label(question.get("topic"), topics)
+        if topic is None:
+            topic = topics[0] if len(topics) == 1 else (question.get("topic") or topics[0])
+
+        level_of_difficulty = _match_label(question.get("difficulty"), DIFFICULTIES)
+        if level_of_difficulty is None:
+            level_of_difficulty = difficulty if difficulty in DIFFICULTIES else "Medium"
+
+        fmt = _match_label(question.get("format"), formats)
+        if fmt is None:
+            fmt = question_format if question_format in formats else "Mixed"
+
+        descriptions = question.get("diagram_descriptions") or []
+        if not isinstance(descriptions, list):
+            descriptions = [str(descriptions)]
+
+        return {
+            "level": level,
+            "subject": subject,
+            "topic": topic,
+            "difficulty": level_of_difficulty,
+            "format": fmt,
+            "question": text,
+            "mark_scheme": mark_scheme,
+            # Text descriptions or validated diagram specs (dicts)
+            "diagram_descriptions": json.dumps([d if isinstance(d, dict) else str(d) for d in descriptions]),
+            "content_hash": content_hash(text, mark_scheme),
+            "minhash": None,
+        }
+
+    def add_many(self, rows, model=None, generation=None):
+        """
+        Insert normalized rows, skipping exact duplicates; returns the number
+        added.  ``generation`` ({"prompt_tokens", "completion_tokens",
+        "latency_ms", "questions"}) records the API call they came from.
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            generation_id = None
+            if generation is not None and rows:
+                generation_id = conn.execute(
+                    """INSERT INTO generations (model, prompt_tokens, completion_tokens, latency_ms, questions, created_at)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (model, generation.get("prompt_tokens"), generation.get("completion_tokens"),
+                     generation.get("latency_ms"), generation.get("questions", len(rows)), now),
+                ).lastrowid
+            cursor = conn.executemany(
+                """INSERT OR IGNORE INTO questions
+                   (level, subject, topic, difficulty, format, question, mark_scheme,
+                    diagram_descriptions, model, content_hash, minhash, generation_id, rand, created_at)
+                   VALUES (:level, :subject, :topic, :difficulty, :format, :question, :mark_scheme,
+                           :diagram_descriptions, :model, :content_hash, :minhash, :generation_id, :rand,
+                           :created_at)""",
+                [dict(row, model=model, generation_id=generation_id, rand=random.random(), created_at=now)
+                 for row in rows],
+            )
+            return cursor.rowcount
+
+    def _filters(self, level, subject, topics=None, difficulty=None, question_format=None):
+        clauses = ["level = ?", "subject = ?"]
+        params = [level, subject]
+        if topics:
+            clauses.append(f"topic IN ({','.join('?' * len(topics))})")
+            params.extend(topics)
+        if difficulty:
+            clauses.append("difficulty = ?")
+            params.append(difficulty)
+        if question_format:
+            clauses.append("format = ?")
+            params.append(question_format)
+        return " AND ".join(clauses), params
+
+    def sample(self, level, subject, topics=None, count=1, difficulty=None, question_format=None,
+               exclude_ids=()):
+        """
+        Random sample of up to ``count`` questions from the matching cells.
+        ``None`` for topics/difficulty/format means "any".  Uses a random pivot
+        on the indexed ``rand`` column (wrapping around) instead of ORDER BY
+        RANDOM(), so the cost does not grow with the size of the bank.
+        """
+        where, params = self._filters(level, subject, topics, difficulty, question_format)
+        if exclude_ids:
+            where += f" AND id NOT IN ({','.join('?' * len(exclude_ids))})"
+            params = params + list(exclude_ids)
+
+        pivot = random.random()
+        conn = self._conn()
+        rows = conn.execute(
+            f"SELECT * FROM questions WHERE {where} AND rand >= ? ORDER BY rand LIMIT ?",
+            params + [pivot, count],
+        ).fetchall()
+        if len(rows) < count:
+            rows += conn.execute(
+                f"SELECT * FROM questions WHERE {where} AND rand < ? ORDER BY rand LIMIT ?",
+                params + [pivot, count - len(rows)],
+            ).fetchall()
+
+        questions = [self._to_question(row) for row in rows]
+        random.shuffle(questions)
+        return questions
+
+    @staticmethod
+    def _to_question(row):
+        """Turn a row back into the question dict shape the app uses"""
+        return {
+            "question": row["question"],
+            "topic": row["topic"],
+            "difficulty": row["difficulty"],
+            "format": row["format"],
+            "mark_scheme": row["mark_scheme"],
+            "diagram_descriptions": json.loads(row["diagram_descriptions"]),
+            "bank_id": row["id"],
+        }
+
+    def count(self, level=None, subject=None, topics=None, difficulty=None, question_format=None):
+        """Number of banked questions matching the filters"""
+        if level is None:
+            return self._conn().execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+        where, params = self._filters(level, subject, topics, difficulty, question_format)
+        return self._conn().execute(f"SELECT COUNT(*) FROM questions WHERE {where}", params).fetchone()[0]
+
+    def cell_counts(self, level=None, subject=None):
+        """{(level, subject, topic, difficulty, format): count} for inventory reports"""
+        sql = "SELECT level, subject, topic, difficulty, format, COUNT(*) FROM questions"
+        params = []
+        if level is not None:
+            sql += " WHERE level = ? AND subject = ?"
+            params = [level, subject]
+        sql += " GROUP BY level, subject, topic, difficulty, format"
+        return {tuple(row[:5]): row[5] for row in self._conn().execute(sql, params)}
+
+    def export_batches(self, batch_size=10000, level=None, subject=None, since=None):
+        """
+        Yield lists of EXPORT_COLUMNS tuples for every question (optionally of
+        one level/subject, created at or after the ``since`` timestamp), in id
+        order, with the usage and latency of the generation it came from.
+        Usage figures are for the whole generation of ``generation_questions``.
+        """
+        clauses, params = [], []
+        if level is not None:
+            clauses.append("q.level = ?")
+            params.append(level)
+        if subject is not None:
+            clauses.append("q.subject = ?")
+            params.append(subject)
+        if since is not None:
+            clauses.append("q.created_at >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        cursor = self._conn().execute(
+            f"""SELECT q.id, q.level, q.subject, q.topic, q.difficulty, q.format, q.question, q.mark_scheme,
+                       q.diagram_descriptions, q.model, q.created_at, q.generation_id, g.prompt_tokens,
+                       g.completion_tokens, g.latency_ms, g.questions
+                FROM questions q LEFT JOIN generations g ON g.id = q.generation_id
+                {where} ORDER BY q.id""",
+            params,
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+
+    def minhashes(self, batch_size=10000):
+        """Yield lists of (content_hash, minhash blob) for every signed question"""
+        cursor = self._conn().execute("SELECT content_hash, minhash FROM questions WHERE minhash IS NOT NULL")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+
+    def unsigned(self):
+        """(content_hash, question, mark_scheme) of questions stored without a minhash"""
+        return [tuple(row) for row in self._conn().execute(
+            "SELECT content_hash, question, mark_scheme FROM questions WHERE minhash IS NULL")]
+
+    def set_minhashes(self, pairs):
+        """Store (content_hash, minhash blob) pairs"""
+        conn = self._conn()
+        with conn:
+            conn.executemany("UPDATE questions SET minhash = ? WHERE content_hash = ?",
+                             [(blob, key) for key, blob in pairs])
+
+    def search(self, text, limit=20, level=None, subject=None):
+        """Full-text search over question and mark scheme text (FTS5 query syntax)"""
+        if not self.has_fts:
+            raise RuntimeError("This SQLite build has no FTS5 support")
+        sql = ("SELECT q.* FROM questions_fts f JOIN questions q ON q.id = f.rowid "
+               "WHERE questions_fts MATCH ?")
+        params = [text]
+        if level is not None:
+            sql += " AND q.level = ? AND q.subject = ?"
+            params += [level, subject]
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        return [self._to_question(row) for row in self._conn().execute(sql, params)]
+
+
+def bank_path():
+    """EXAMPREP_BANK_PATH, else question_bank.sqlite3 next to this file ("" when disabled)"""
+    return os.getenv("EXAMPREP_BANK_PATH",
+                     os.path.join(os.path.dirname(os.path.abspath(__file__)), "question_bank.sqlite3"))
+
+
+def open_question_bank(path=None):
+    """
+    Open the bank at ``path`` (default: bank_path()).  An empty
+    EXAMPREP_BANK_PATH disables the bank and returns None.
+    """
+    if path is None:
+        path = bank_path()
+    if not path:
+        return None
+    return QuestionBank(path)
@@ -0,0 +1,208 @@
+"""
+Process-wide rate limiting for the shared Groq API key.
+
+``GroqRateLimiter`` combines two token buckets, one for requests per minute
+and one for tokens per minute, with a fair queue in front of them.  Waiting
+requests are ordered by weighted fair queueing: each request gets a finish
+tag of ``max(virtual time, the session's last tag) + tokens`` and the
+smallest tag goes next.  That interleaves sessions (a classroom burst from
+one session cannot starve the others) and lets small requests overtake
+large ones.
+"""
+import asyncio
+import bisect
+import itertools
+import threading
+import time
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request waited longer than its timeout for capacity"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at ``rate`` per second"""
+
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount):
+        """Seconds until ``amount`` is available (call refill first)"""
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class _Ticket:
+    __slots__ = ("session_id", "tokens", "finish", "seq")
+
+    def __init__(self, session_id, tokens, finish, seq):
+        self.session_id = session_id
+        self.tokens = tokens
+        self.finish = finish
+        self.seq = seq
+
+
+class GroqRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter with a fair queue.
+
+    ``acquire`` blocks until the request is at the front of the queue and
+    both buckets have room (``acquire_async`` is the coroutine version; both
+    share one queue).  While waiting, ``on_wait(position, eta_seconds)``
+    is called about every ``poll_interval`` seconds so the UI can show the
+    queue position instead of failing.
+    """
+
+    def __init__(self, rpm, tpm, poll_interval=0.5, clock=time.monotonic):
+        self._clock = clock
+        now = clock()
+        self.requests = TokenBucket(rpm, rpm / 60, now)
+        self.tokens = TokenBucket(tpm, tpm / 60, now)
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._session_finish = {}
+        self._blocked_until = 0.0
+
+    def _cost(self, tokens):
+        # A single request can never need more than a full bucket
+        return min(tokens, self.tokens.capacity)
+
+    def _delay(self, tokens, now):
+        """Seconds until a request of ``tokens`` may be sent"""
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(
+            self._blocked_until - now,
+            self.requests.time_until(1),
+            self.tokens.time_until(self._cost(tokens)),
+        )
+
+    def _eta(self, position, now):
+        """Rough wait for the request at ``position`` (1-based) in the queue"""
+        ahead = self._waiting[:position]
+        tokens_ahead = sum(self._cost(t.tokens) for t in ahead)
+        return max(
+            self._blocked_until - now,
+            self.requests.time_until(len(ahead)),
+            self.tokens.time_until(tokens_ahead),
+            0.0,
+        )
+
+    def _enqueue(self, session_id, tokens):
+        with self._cond:
+            start = max(self._virtual_time, self._session_finish.get(session_id, 0.0))
+            ticket = _Ticket(session_id, tokens, start + tokens, next(self._seq))
+            self._session_finish[session_id] = ticket.finish
+            bisect.insort(self._waiting, ticket, key=lambda t: (t.finish, t.seq))
+        return ticket
+
+    def _poll(self, ticket):
+        """Grant ``ticket`` if it may go now; else return (position, eta)"""
+        with self._cond:
+            now = self._clock()
+            position = self._waiting.index(ticket) + 1
+            delay = self._delay(ticket.tokens, now) if position == 1 else None
+            if delay is not None and delay <= 0:
+                self._grant(ticket)
+                return None
+            return position, delay if delay is not None else self._eta(position, now)
+
+    def _check_deadline(self, deadline, position, eta):
+        if deadline is not None and self._clock() + eta > deadline:
+            raise RateLimitTimeout(
+                f"Waited too long for API capacity (position {position} in queue, ~{eta:.0f}s left)"
+            )
+
+    def _abandon(self, ticket):
+        with self._cond:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+    def acquire(self, session_id, tokens, on_wait=None, timeout=None):
+        """Wait for capacity to send one request of about ``tokens`` tokens"""
+        ticket = self._enqueue(session_id, tokens)
+        deadline = None if timeout is None else self._clock() + timeout
+        try:
+            while True:
+                waiting = self._poll(ticket)
+                if waiting is None:
+                    return
+                position, eta = waiting
+
+                if on_wait is not None:
+                    on_wait(position, eta)
+                self._check_deadline(deadline, position, eta)
+
+                with self._cond:
+                    self._cond.wait(min(max(eta, 0.01), self.poll_interval))
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    async def acquire_async(self, session_id, tokens, on_wait=None, timeout=None):
+        """
+        ``acquire`` for coroutines: waits with asyncio.sleep, so one event
+        loop can queue any number of requests without a thread each.
+        """
+        ticket = self._enqueue(session_id, tokens)
+        deadline = None if timeout is None else self._clock() + timeout
+        try:
+            while True:
+                waiting = self._poll(ticket)
+                if waiting is None:
+                    return
+                position, eta = waiting
+
+                if on_wait is not None:
+                    on_wait(position, eta)
+                self._check_deadline(deadline, position, eta)
+
+                await asyncio.sleep(min(max(eta, 0.01), self.poll_interval))
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    def _grant(self, ticket):
+        """Consume capacity for the front ticket (caller holds the lock)"""
+        self._waiting.pop(0)
+        self.requests.level -= 1
+        self.tokens.level -= self._cost(ticket.tokens)
+        self._virtual_time = ticket.finish - ticket.tokens
+
+        # Forget sessions that have fallen behind the virtual clock
+        if len(self._session_finish) > 1000:
+            self._session_finish = {
+                sid: tag for sid, tag in self._session_finish.items() if tag > self._virtual_time
+            }
+        self._cond.notify_all()
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real usage of a request is known"""
+        with self._cond:
+            self.tokens.level += self._cost(estimated_tokens) - actual_tokens
+            self._cond.notify_all()
+
+    def penalize(self, retry_after):
+        """Hold every request back for ``retry_after`` seconds (after a 429)"""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, self._clock() + retry_after)
+
+    def status(self):
+        """Queue length and waiting requests per session"""
+        with self._cond:
+            per_session = {}
+            for ticket in self._waiting:
+                per_session[ticket.session_id] = per_session.get(ticket.session_id, 0) + 1
+            return {"queued": len(self._waiting), "per_session": per_session}
@@ -0,0 +1,77 @@
+"""
+Single-flight call coalescing.
+
+When several sessions ask for exactly the same thing at the same time, only
+the first call (the leader) runs; everyone else waits for and shares its
+result.  Nothing is cached once the call finishes - this only collapses
+calls that overlap in time.  A waiter can stop waiting when its own job is
+cancelled; the leader keeps running for anyone still waiting.
+"""
+import threading
+
+from jobs import JobCancelled
+
+# How often (seconds) a waiter checks whether it has been cancelled
+CANCEL_POLL_INTERVAL = 0.2
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Collapse concurrent calls that share a key into one execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, should_cancel=None):
+        """
+        Run ``fn()`` unless a call with the same key is already in flight, in
+        which case wait for it.  Returns ``(result, shared)`` where ``shared``
+        is False for the leader and True for the callers that waited.
+        Exceptions raised by the leader are re-raised in every caller.  A
+        waiter whose ``should_cancel()`` turns true stops waiting and raises
+        JobCancelled.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            timeout = CANCEL_POLL_INTERVAL if should_cancel is not None else None
+            while not call.done.wait(timeout):
+                if should_cancel():
+                    with self._lock:
+                        call.waiters -= 1
+                    raise JobCancelled("Cancelled while waiting for a shared call")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Forget the key before waking waiters so later callers start a new flight
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        """Map of in-flight keys to the number of callers waiting on them"""
+        with self._lock:
+            return {key: call.waiters for key, call in self._calls.items()}